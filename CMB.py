@@ -1,24 +1,97 @@
 import numpy as np
 import os
+import hashlib
 from boltzmann import *
 from frw_metric import *
+from field_store import field_root, fields_exist, load_fields, save_fields
+from bessel_table import BesselTable
+from table_cache import file_lock, canonical
 from scipy.integrate import quad
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d, InterpolatedUnivariateSpline
 from scipy.special import spherical_jn
-from scipy.optimize import minimize
-from statsmodels.nonparametric.smoothers_lowess import lowess
-#from scipy.signal import savgol_filter
+from scipy.signal import savgol_filter
+try:
+    from statsmodels.nonparametric.smoothers_lowess import lowess
+except ImportError:
+    # only needed for isw_method='lowess'
+    lowess = None
 from multiprocessing import Pool
-import glob
 import math
 path = os.getcwd()
 
+
+def trapz_weights(x):
+    # np.trapz(y, x) == trapz_weights(x).dot(y)
+    dx = np.diff(x)
+    w = np.zeros(len(x))
+    w[:-1] += dx/2.
+    w[1:] += dx/2.
+    return w
+
+
+def isw_derivative(eta_f, pp, eta, method='spline', frac=0.008):
+    # d(Phi - Psi)/deta at eta from Phi - Psi tabulated on the ODE time grid eta_f, all linear time
+    # except 'lowess':
+    #   'spline': derivative of the cubic interpolating spline through pp
+    #   'savgol': Savitzky-Golay derivative (cubic, window frac of the points) of pp resampled on a
+    #             uniform grid with as many points as eta_f
+    #   'lowess': LOWESS (statsmodels) smoothing of the finite difference of pp, O(n^2 frac)
+    if method == 'spline':
+        return InterpolatedUnivariateSpline(eta_f, pp, k=3).derivative()(eta)
+    if method == 'savgol':
+        eta_u = np.linspace(eta_f[0], eta_f[-1], len(eta_f))
+        window = max(2*int(frac*len(eta_f)/2.) + 1, 5)
+        dpp = savgol_filter(np.interp(eta_u, eta_f, pp), window, 3, deriv=1, delta=eta_u[1] - eta_u[0])
+        return np.interp(eta, eta_u, dpp)
+    if method == 'lowess':
+        if lowess is None:
+            raise ImportError('isw_method=\'lowess\' requires statsmodels')
+        ppdot0 = np.insert(np.diff(pp) / np.diff(eta_f), 0, 0.)
+        return np.interp(eta, eta_f, lowess(ppdot0, eta_f, frac=frac, return_sorted=False))
+    raise ValueError('Unknown ISW derivative method: ' + method)
+
+
+def gauss_nodes(x, order=4):
+    # Gauss-Legendre nodes and weights with order points on every interval of the grid x, exact for
+    # polynomials of degree 2 order - 1 on each interval (e.g. the square of a cubic spline)
+    t, wt = np.polynomial.legendre.leggauss(order)
+    half = np.diff(x)[:, np.newaxis] / 2.
+    mid = (x[1:] + x[:-1])[:, np.newaxis] / 2.
+    return (mid + half*t).ravel(), (half*wt).ravel()
+
+
+def union_kgrid(*grids):
+    # Sorted union of k grids; values that share a per-k file name ({:.4e}) are merged
+    kall = np.sort(np.concatenate(grids))
+    names = ['{:.4e}'.format(k) for k in kall]
+    keep = [i for i in range(len(kall)) if i == 0 or names[i] != names[i-1]]
+    return kall[keep]
+
+
+def brane_tag(Nbrane, PressFac, eCDM, digits=None):
+    # Suffix of the per-k tables and outputs of a multiverse run: one digit of Nbrane and three of
+    # PressFac and eCDM, or digits + 1 of each (points closer than that share their files)
+    if digits is None:
+        return '_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}'.format(Nbrane, PressFac, eCDM)
+    return '_Nbrane_{0:.{3:d}e}_PressFac_{1:.{3:d}e}_eCDM_{2:.{3:d}e}'.format(Nbrane, PressFac, eCDM, digits)
+
+
+def output_files(Ftag, tag=''):
+    # (Theta_l(k) table, C_l table, matter power spectrum) of a run, tag from brane_tag for multiverse
+    # runs
+    root = path + '/OutputFiles/' + Ftag
+    return (root + tag + '_ThetaCMB_Table.dat', root + '_CL_Table' + tag + '.dat',
+            root + '_MatterPowerSpectrum' + tag + '.dat')
+
+
 class CMB(object):
 
     def __init__(self, OM_b, OM_c, OM_g, OM_L, kmin=5e-3, kmax=0.5, knum=200,
                  lmax=2500, lvals=250,
                  Ftag='StandardUniverse', lmax_Pert=5, multiverse=False,
-                 OM_b2=0., OM_c2=0., OM_g2=0., OM_L2=0., Nbrane=0):
+                 OM_b2=0., OM_c2=0., OM_g2=0., OM_L2=0., Nbrane=0, kbatch=1, tau_points=None, cs_table=False,
+                 bessel_dx=0.2, src_vis_points=800, src_per_period=16., isw_method='spline',
+                 ell_step=None, mps_grid=None, z_out=(0.,), out_tag=None, thermal=True):
         
         self.OM_b = OM_b
         self.OM_c = OM_c
@@ -53,35 +126,67 @@ class CMB(object):
         self.H_0 = 2.2348e-4 # units Mpc^-1
         self.lmax_Pert = lmax_Pert
         self.lmin = 10
+        # Number of neighbouring k modes integrated together by KBatch_Universe
+        self.kbatch = kbatch
+        # Pool tasks of k_batches: largest k of a batch -> its k values
+        self.batches = {}
+        # Points of the a grid for the optical depth / visibility tables (None: Universe default)
+        self.tau_points = tau_points
+        # Tabulate the baryon sound speed(s) in the shared context instead of evaluating Cs_Sqr per step
+        self.cs_table = cs_table
+        # x spacing of the cached j_l(x) table used by theta_integration (None: exact spherical_jn)
+        self.bessel_dx = bessel_dx
+        self.bessel = None
+        # Shared eta grid of the line of sight sources (see source_grid): points across the visibility
+        # function, and points per period of j_l(kmax (eta_0 - eta)) elsewhere
+        self.src_vis_points = src_vis_points
+        self.src_per_period = src_per_period
+        self.eta_src = None
+        # Backend of d(Phi - Psi)/deta in the ISW source, see isw_derivative
+        self.isw_method = isw_method
         
         self.multiverse = multiverse
         self.init_pert = -1/6.
         
-#        ell_val = range(self.lmin, self.lmax, 10)
-        ell_val = np.logspace(np.log10(self.lmin), np.log10(self.lmax), 120)
-        self.clearfiles()
+        if ell_step is None:
+            ell_val = np.logspace(np.log10(self.lmin), np.log10(self.lmax), 120)
+        else:
+            # e.g. ell_step=1: every multipole from lmin to lmax
+            ell_val = np.arange(self.lmin, self.lmax + 1, ell_step)
         
-        self.ThetaFile = path + '/OutputFiles/' + self.Ftag
-        if self.multiverse:
-            self.ThetaFile += '_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}_ThetaCMB_Table.dat'.format(self.Nbrane, self.PressFac, self.eCDM)
+        if out_tag is not None:
+            # e.g. brane_tag of the input parameters with more digits (ParamSweep tag_digits)
+            self.out_tag = out_tag
+        elif self.multiverse:
+            self.out_tag = brane_tag(self.Nbrane, self.PressFac, self.eCDM)
         else:
-            self.ThetaFile += '_ThetaCMB_Table.dat'
+            self.out_tag = ''
+        self.ThetaFile, self.ClFile, self.MPSFile = output_files(self.Ftag, self.out_tag)
 
         self.ThetaTabTot = np.zeros((self.knum+1, len(ell_val)))
         self.ThetaTabTot[0,:] = ell_val
+        # Shared, memory-mapped version of ThetaTabTot filled in place by theta_integration
+        self.ThetaStore = self.ThetaFile[:-4] + '_work.npy'
+        self.theta_store = None
+        # Theta_l(k) and C_l use kgrid_cmb, MatterPower uses kgrid_mps (default: the same grid) at the
+        # redshifts z_out. The Boltzmann solves run once over kgrid, the union of both.
+        self.kgrid_cmb = np.logspace(np.log10(self.kmin), np.log10(self.kmax), self.knum)
+        if mps_grid is None:
+            self.kgrid_mps = self.kgrid_cmb
+        else:
+            self.kgrid_mps = np.sort(np.asarray(mps_grid, dtype=float))
+        self.kgrid = union_kgrid(self.kgrid_cmb, self.kgrid_mps)
+        self.z_out = list(z_out)
 
         self.fill_inx = 0
-        self.loadfiles()
+        # thermal=False: the background is set later by loadfiles(universe), e.g. after a thermal_sweep
+        # over many cosmologies (see ParamSweep.setup)
+        if thermal:
+            self.loadfiles()
     
     def runall(self, kVAL=None, compute_LP=False, compute_TH=False,
                compute_CMB=False, compute_MPS=False):
         
-        if compute_MPS:
-            self.kgrid = np.logspace(np.log10(self.kmin), np.log10(self.kmax), self.knum)
-        else:
-            #self.kgrid = np.linspace(self.kmin, self.kmax, self.knum)
-            self.kgrid = np.logspace(np.log10(self.kmin), np.log10(self.kmax), self.knum)
-        
         if compute_LP:
             print 'Computing Perturbation Fields...\n'
             self.kspace_linear_pert(kVAL)
@@ -90,9 +195,10 @@ class CMB(object):
             print 'Computing Theta Files...\n'
             
             if kVAL is not None:
-                self.theta_integration(kVAL, kVAL=kVAL)
+                if self.has_theta_row(kVAL):
+                    self.theta_integration(kVAL, kVAL=kVAL)
             else:
-                for k in self.kgrid:
+                for k in self.kgrid_cmb:
                     self.theta_integration(k)
                     
         if compute_CMB:
@@ -103,72 +209,89 @@ class CMB(object):
             self.MatterPower()
         return
     
+    def has_theta_row(self, k):
+        # k values of the union grid that only serve the matter power spectrum have no Theta row
+        return np.min(np.abs(self.kgrid_cmb/k - 1.)) < 1e-4
+
+    def k_batches(self, kgrid=None):
+        # kgrid (default: the union grid) cut into runs of kbatch neighbouring k values, one Pool task
+        # each (see run_batch). A batch is keyed by its largest k, which sets its cost for the scheduler.
+        # Call it before starting the Pool so that the workers inherit the batches.
+        kgrid = np.sort(self.kgrid if kgrid is None else kgrid)
+        self.batches = dict((kgrid[min(i + self.kbatch, len(kgrid)) - 1], kgrid[i:i + self.kbatch])
+                            for i in range(0, len(kgrid), self.kbatch))
+        return sorted(self.batches.keys())
+
+    def run_batch(self, kval, compute_LP=True, compute_TH=True):
+        # Pool task: fields of the batch keyed kval, integrated together by KBatch_Universe when kbatch > 1,
+        # then their Theta_l rows
+        klist = self.batches[kval]
+        if compute_LP:
+            self.kspace_linear_pert(klist=klist)
+        if compute_TH:
+            for k in klist:
+                if self.has_theta_row(k):
+                    self.theta_integration(k)
+        return
+
     def clearfiles(self):
-        if os.path.isfile(path + '/precomputed/xe_working' + self.f_tag + '.dat'):
-            os.remove(path + '/precomputed/xe_working' + self.f_tag + '.dat')
-        if os.path.isfile(path + '/precomputed/tb_working' + self.f_tag + '.dat'):
-            os.remove(path + '/precomputed/tb_working' + self.f_tag + '.dat')
-
-        if os.path.isfile(path + '/precomputed/working_expOpticalDepth' + self.f_tag + '.dat'):
-            os.remove(path + '/precomputed/working_expOpticalDepth' + self.f_tag + '.dat')
-        if os.path.isfile(path + '/precomputed/working_VisibilityFunc' + self.f_tag + '.dat'):
-            os.remove(path + '/precomputed/working_VisibilityFunc' + self.f_tag + '.dat')
-    
-    def loadfiles(self):
-    
+        remove_legacy_tables(self.f_tag)
+
+    def background_universe(self, thermal=True):
+        # k-independent Universe of this cosmology; thermal=False leaves its thermal history to
+        # boltzmann.thermal_sweep
         if not self.multiverse:
-            SingleUni = Universe(1., self.OM_b, self.OM_c, self.OM_g, self.OM_L, self.OM_nu)
-            self.ct_to_scale = lambda x: SingleUni.ct_to_scale(x)
-            self.scale_to_ct = lambda x: SingleUni.scale_to_ct(x)
-            SingleUni.tau_functions()
-            self.eta0 = SingleUni.eta_0
-        else:
-            ManyUni = ManyBrane_Universe(self.Nbrane, 1., [self.OM_b, self.OM_b2], [self.OM_c, self.OM_c2],
-                                          [self.OM_g, self.OM_g2], [self.OM_L, self.OM_L2],
-                                          [self.OM_nu, self.OM_nu2])
-            self.ct_to_scale = lambda x: ManyUni.ct_to_scale(x)
-            self.scale_to_ct = lambda x: ManyUni.scale_to_ct(x)
-            ManyUni.tau_functions()
-            self.eta0 = ManyUni.eta_0
-    
-        opt_depthL = np.loadtxt(path + '/precomputed/working_expOpticalDepth' + self.f_tag + '.dat')
-        self.opt_depth = interp1d(np.log10(opt_depthL[:,0]), opt_depthL[:,1], kind='cubic',
-                                  bounds_error=False, fill_value='extrapolate')
+            return Universe(1., self.OM_b, self.OM_c, self.OM_g, self.OM_L, self.OM_nu, thermal=thermal)
+        return ManyBrane_Universe(self.Nbrane, 1., [self.OM_b, self.OM_b2], [self.OM_c, self.OM_c2],
+                                  [self.OM_g, self.OM_g2], [self.OM_L, self.OM_L2],
+                                  [self.OM_nu, self.OM_nu2], thermal=thermal)
 
-        visfunc = np.loadtxt(path + '/precomputed/working_VisibilityFunc' + self.f_tag + '.dat')
-        self.Vfunc = interp1d(np.log10(visfunc[:,0]), visfunc[:,1], kind='cubic', bounds_error=False, fill_value=0.)
-        self.eta_start = 10.**self.scale_to_ct(np.log10(np.min(visfunc[:,0])))
+    def loadfiles(self, universe=None):
+        # Background and thermal history are k-independent: build them once into a BackgroundContext
+        # that every Universe of this run (and every Pool worker) shares. universe: a
+        # background_universe whose thermal history is already set.
+        ctx_opts = {'tabulate_cs': self.cs_table}
+        if self.tau_points is not None:
+            ctx_opts['n_tau'] = self.tau_points
+        if universe is None:
+            universe = self.background_universe()
+        self.context = universe.background_context(**ctx_opts)
+        self.ct_to_scale = self.context.background.ct_to_scale
+        self.scale_to_ct = self.context.background.scale_to_ct
+        self.eta0 = self.context.eta_0
+    
+        self.opt_depth = self.context.opt_depth
+        self.Vfunc = self.context.Vfunc
+        self.eta_start = 10.**self.scale_to_ct(np.log10(np.min(self.context.tables['tau'][:,0])))
         
         return
 
-    def kspace_linear_pert(self, kVAL=None):
+    def kspace_linear_pert(self, kVAL=None, klist=None):
         #kgrid = np.logspace(np.log10(self.kmin), np.log10(self.kmax), self.knum)
         if kVAL is not None:
             kgrid = [kVAL]
+        elif klist is not None:
+            kgrid = klist
         else:
             kgrid = self.kgrid
+        todo = []
         for k in kgrid:
-            if self.multiverse:
-                fileName = path + '/OutputFiles/' + self.Ftag + \
-                         '_FieldEvolution_{:.4e}_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(k, self.Nbrane,
-                                                                                                       self.PressFac, self.eCDM)
-            else:
-                fileName = path + '/OutputFiles/' + self.Ftag + '_FieldEvolution_{:.4e}.dat'.format(k)
-            if os.path.isfile(fileName):
+            if self.solved(k):
                 continue
+            todo.append(k)
+        
+        todo = np.sort(todo)
+        for i in range(0, len(todo), self.kbatch):
+            kset = todo[i:i + self.kbatch]
             stepsize = 1e-2
             success = False
             while not success:
-                print 'Working on k = {:.3e}, step size = {:.3e}'.format(k, stepsize)
+                print 'Working on k = {:.3e} - {:.3e}, step size = {:.3e}'.format(kset[0], kset[-1], stepsize)
                 try:
-                    if not self.multiverse:
-                        SingleUni = Universe(k, self.OM_b, self.OM_c, self.OM_g, self.OM_L, self.OM_nu,
-                                             stepsize=stepsize, accuracy=1e-3, lmax=self.lmax_Pert).solve_system()
+                    if len(kset) == 1:
+                        self.perturbation_universe(kset[0], stepsize).solve_system(z_out=self.z_out)
                     else:
-                        ManyBrane_Universe(self.Nbrane, k, [self.OM_b, self.OM_b2], [self.OM_c, self.OM_c2],
-                                          [self.OM_g, self.OM_g2], [self.OM_L, self.OM_L2],
-                                          [self.OM_nu, self.OM_nu2], accuracy=1e-3,
-                                          stepsize=stepsize, lmax=self.lmax_Pert).solve_system()
+                        KBatch_Universe([self.perturbation_universe(k, stepsize) for k in kset]).solve_system(z_out=self.z_out)
                     success = True
                 except ValueError:
                     stepsize /= 2.
@@ -176,129 +299,267 @@ class CMB(object):
         print 'All k values computed!'
         return
 
+    def solved(self, k):
+        # Field table on disk and a Transfer summary holding every z_out (z = 0 alone can fall back to
+        # the field table)
+        if not fields_exist(self.field_file(k)):
+            return False
+        if self.z_out == [0.]:
+            return True
+        if not fields_exist(self.field_file(k, kind='Transfer')):
+            return False
+        zs = load_fields(self.field_file(k, kind='Transfer'))[:, 0]
+        return all(np.min(np.abs(zs - z)) < 1e-6 for z in self.z_out)
+
+    def field_file(self, k, kind='FieldEvolution'):
+        # Root name of the per-k table of k (see field_store): 'FieldEvolution', 'LOSSource' or 'Transfer'
+        return field_root(path + '/OutputFiles', self.Ftag, k, self.out_tag, kind=kind)
+
+    def perturbation_universe(self, k, stepsize):
+        if not self.multiverse:
+            return Universe(k, self.OM_b, self.OM_c, self.OM_g, self.OM_L, self.OM_nu,
+                            stepsize=stepsize, accuracy=1e-3, lmax=self.lmax_Pert, context=self.context)
+        uni = ManyBrane_Universe(self.Nbrane, k, [self.OM_b, self.OM_b2], [self.OM_c, self.OM_c2],
+                                 [self.OM_g, self.OM_g2], [self.OM_L, self.OM_L2],
+                                 [self.OM_nu, self.OM_nu2], accuracy=1e-3,
+                                 stepsize=stepsize, lmax=self.lmax_Pert, context=self.context)
+        uni.out_tag = self.out_tag
+        return uni
+
 
     def theta_integration(self, k, kVAL=None):
-        filename = path + '/OutputFiles/' + self.Ftag + '_ThetaFile_kval_{:.4e}'.format(k)
-        if self.multiverse:
-            filename += '_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(self.Nbrane, self.PressFac, self.eCDM)
-        else:
-            filename += '.dat'
-        
-        if os.path.isfile(filename):
-            return
-        if kVAL is not None:
-            #kgrid = np.logspace(np.log10(self.kmin), np.log10(self.kmax), self.knum)
-            index = np.where(self.kgrid == kVAL)[0][0] + 1
+        # Theta_l(k) for every ell, written into row (position of k in kgrid_cmb) + 1 of theta_table
+        store = self.theta_table()
+        index = np.argmin(np.abs(self.kgrid_cmb - k)) + 1
+        if not np.isnan(store[index, 1]):
+            return store[index, 1:]
+        thetaVals = self.theta_row(k)
+        store[index, 1:] = thetaVals
+        store.flush()
+        return thetaVals
+
+    def theta_row(self, k):
+        # Theta_l(k) for every ell of ThetaTabTot[0]
         ell_tab = self.ThetaTabTot[0,:]
         
-        fileNme = path + '/OutputFiles/' + self.Ftag + '_FieldEvolution_{:.4e}'.format(k)
-        if self.multiverse:
-            fileNme += '_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(self.Nbrane, self.PressFac, self.eCDM)
-        else:
-            fileNme += '.dat'
-        fields = np.loadtxt(fileNme)
-
-        thetaVals = np.zeros(len(ell_tab))
-        indx_min = np.argmin(np.abs(fields[:, 0] - 50.))
-        vis = self.visibility(fields[indx_min:, 0])
+        # Line of sight projection for all multipoles at once: with the trapezoid weights w of the eta
+        # grid, Theta_l = sum_eta w [ S_j j_l + S_2 (j_{l-1} - (l+1) j_l / x) ]
+        eta, src_j, src_2 = self.los_source(k).T
+        x = k * (self.eta0 - eta)
+        src_2x = np.zeros_like(src_2)
+        src_2x[x != 0.] = src_2[x != 0.] / x[x != 0.]
         
-        deta0 = np.diff(fields[:,0])
-        h1 = deta0[indx_min+1:]
-        h2 = deta0[indx_min:-1]
-        pre_2nd_derTerm = (fields[:, 7] + fields[:, 12] + fields[:, 13])*self.visibility(fields[:, 0])
+        w = trapz_weights(eta)
+        if self.bessel_dx is None:
+            jl = spherical_jn(ell_tab.astype(int)[:, np.newaxis], x)
+            jl_m1 = spherical_jn((ell_tab - 1.).astype(int)[:, np.newaxis], x)
+            proj = jl.dot(np.column_stack((w*src_j, w*src_2x)))
+            thetaVals = proj[:,0] - (ell_tab + 1.)*proj[:,1] + jl_m1.dot(w*src_2)
+        else:
+            # j_{l-1} = j_l' + (l+1) j_l / x for the integer l of each ell
+            jl, jl_p = self.load_bessel().lookup(x)
+            proj = jl.dot(np.column_stack((w*src_j, w*src_2x)))
+            thetaVals = proj[:,0] + (ell_tab.astype(int) - ell_tab)*proj[:,1] + jl_p.dot(w*src_2)
+        return thetaVals
         
-        sec_DerTerm = 2.*(h2*pre_2nd_derTerm[indx_min+2:] - (h1+h2)*pre_2nd_derTerm[indx_min+1:-1] + h1*pre_2nd_derTerm[indx_min:-2])/(h1*h2*(h1+h2))
-        sec_DerTerm = np.insert(sec_DerTerm, 0, 0.)
-        sec_DerTerm = np.insert(sec_DerTerm, 0, 0.)
+
+    def source_grid(self):
+        # eta grid shared by the sources of every k, from eta = 50 to eta_0. The point density is
+        # src_vis_points * g(eta) / int g (dense across recombination and reionisation) plus a uniform
+        # floor of src_per_period points per period of j_l(kmax (eta_0 - eta)), so its size is set by
+        # the accuracy of the projection, not by the ODE step count.
+        if self.eta_src is None:
+            eta = np.linspace(50., self.eta0, 100000)
+            vis = np.nan_to_num(self.visibility(eta))
+            vis[vis < 0.] = 0.
+            dens = self.src_vis_points * vis / np.trapz(vis, eta) + self.src_per_period * self.kmax / (2.*np.pi)
+            cdf = np.concatenate(([0.], np.cumsum((dens[1:] + dens[:-1]) * np.diff(eta) / 2.)))
+            self.eta_src = np.interp(np.linspace(0., cdf[-1], int(cdf[-1]) + 1), cdf, eta)
+        return self.eta_src
+
+    def los_source(self, k):
+        # Line of sight sources of k on source_grid, columns (eta, S_j, S_2):
+        #   S_j = g (Theta_0 + Psi + Pi/4 + 3/(4k^2) d^2(g Pi)/deta^2) - e^{-tau} d(Phi - Psi)/deta
+        #   S_2 = g v_b
+        # The fields are interpolated from the ODE time grid, g and e^{-tau} are evaluated on the new
+        # grid and the second derivative is that of a spline through g Pi. Cached next to the fields,
+        # under a name that carries source_key.
+        fileroot = self.field_file(k, kind='LOSSource') + '_' + self.source_key(k)
+        if fields_exist(fileroot):
+            return load_fields(fileroot, mmap=False)
+        fields = load_fields(self.field_file(k), mmap=False)
         
+        indx_min = np.argmin(np.abs(fields[:, 0] - 50.))
+        eta_f = fields[indx_min:, 0]
         tpsi0 = fields[indx_min:, 6] + fields[indx_min:, -1]
         pipolar = fields[indx_min:, 7] + fields[indx_min:, 12] + fields[indx_min:, 13]
         vb0 = fields[indx_min:, 5]
-        expD0 = self.exp_opt_depth(fields[indx_min:, 0])
+        phipsi = fields[indx_min:, 1] - fields[indx_min:, -1]
         
-        ppdot0 = (np.diff(fields[indx_min:, 1]) - np.diff(fields[indx_min:, -1])) / np.diff(fields[indx_min:, 0])
-        ppdot0 = np.insert(ppdot0, 0, 0.)
-        
-        s_filter = 0.008
-        smthed_ppdot0 = lowess(fields[indx_min:, 0], ppdot0, frac=s_filter, return_sorted=True)
-        
-        for i,ell in enumerate(ell_tab):
-            integ1 = vis * (tpsi0 + pipolar/4. + 3./4./k**2.*sec_DerTerm) * spherical_jn(int(ell), k * (self.eta0 - fields[indx_min:, 0]))
-            integ2 = vis * vb0 * (spherical_jn(int(ell - 1.), k * (self.eta0 - fields[indx_min:, 0])) - \
-                    (ell+1.)*spherical_jn(int(ell), k * (self.eta0 - fields[indx_min:, 0]))/(k * (self.eta0 - fields[indx_min:, 0])))
-            integ3 = -expD0 * smthed_ppdot0[:,0] * spherical_jn(int(ell), k * (self.eta0 - fields[indx_min:, 0]))
-            integ1[np.isnan(integ1)] = 0.
-            integ2[np.isnan(integ2)] = 0.
-            integ3[np.isnan(integ3)] = 0.
-
-            term1 = np.trapz(integ1, fields[indx_min:, 0])
-            term2 = np.trapz(integ2, fields[indx_min:, 0])
-            term3 = np.trapz(integ3, fields[indx_min:, 0])
-            thetaVals[i] = term1 + term2 + term3
-    
-        np.savetxt(filename, thetaVals)
-        return
+        eta = self.source_grid()
+        eta = eta[(eta >= eta_f[0]) & (eta <= eta_f[-1])]
+        resampled = interp1d(eta_f, np.column_stack((tpsi0, pipolar, vb0)), kind='cubic', axis=0)(eta)
+        ppdot = isw_derivative(eta_f, phipsi, eta, method=self.isw_method)
+        vis = self.visibility(eta)
+        expD0 = self.exp_opt_depth(eta)
+        sec_DerTerm = InterpolatedUnivariateSpline(eta, np.nan_to_num(resampled[:,1] * vis), k=3).derivative(2)(eta)
         
+        src_j = vis * (resampled[:,0] + resampled[:,1]/4. + 3./4./k**2.*sec_DerTerm) - expD0 * ppdot
+        src_2 = vis * resampled[:,2]
+        for src in (src_j, src_2):
+            src[np.isnan(src)] = 0.
+        source = np.column_stack((eta, src_j, src_2))
+        save_fields(fileroot, source)
+        return source
+
+    def source_key(self, k):
+        # Digest of what the sources of k depend on besides k and the cosmology: the source eta grid
+        # (src_vis_points, src_per_period, kmax, the visibility), the ISW backend, lmax_Pert and the
+        # field table it is computed from (size and time, so that regenerated fields are not reused)
+        fields = self.field_file(k)
+        fields += '.npy' if os.path.isfile(fields + '.npy') else '.dat'
+        stat = os.stat(fields)
+        params = {'eta': hashlib.md5(np.ascontiguousarray(self.source_grid()).tobytes()).hexdigest(),
+                  'isw_method': self.isw_method, 'lmax_Pert': self.lmax_Pert,
+                  'fields': (stat.st_size, stat.st_mtime)}
+        return hashlib.md5(repr(canonical(params)).encode()).hexdigest()[:12]
+
+    def load_bessel(self):
+        # Build (or map the cached) BesselTable for the ell grid and every x = k (eta_0 - eta) of the
+        # k range. Call it before starting a Pool so that workers share the mapped table.
+        if self.bessel is None and self.bessel_dx is not None:
+            self.bessel = BesselTable(self.ThetaTabTot[0,:].astype(int), self.kmax*self.eta0, dx=self.bessel_dx)
+        return self.bessel
+
+    def theta_table(self):
+        # (knum+1, nell+1) table shared by the theta_integration calls of every Pool worker: row 0 holds
+        # the ells, row i+1 k = kgrid_cmb[i] followed by Theta_l(k), NaN until computed. Memory-mapped
+        # and written in place; call it before starting a Pool so that the workers inherit one mapping.
+        if self.theta_store is None:
+            shape = (self.knum+1, self.ThetaTabTot.shape[1]+1)
+            # one process creates (or replaces a stale) table, the others wait and map that file: a
+            # second rename over it would orphan the mapping of the first
+            with file_lock(self.ThetaStore + '.lock'):
+                if os.path.isfile(self.ThetaStore):
+                    tab = np.load(self.ThetaStore, mmap_mode='r')
+                    stale = (tab.shape != shape or not np.array_equal(tab[0, 1:], self.ThetaTabTot[0]) or
+                             not np.array_equal(tab[1:, 0], self.kgrid_cmb))
+                    del tab
+                    if stale:
+                        os.remove(self.ThetaStore)
+                if not os.path.isfile(self.ThetaStore):
+                    tmpName = self.ThetaStore + '.{:d}.tmp'.format(os.getpid())
+                    tab = np.lib.format.open_memmap(tmpName, mode='w+', dtype=np.float64, shape=shape)
+                    tab[0, 0] = 0.
+                    tab[0, 1:] = self.ThetaTabTot[0]
+                    tab[1:, 0] = self.kgrid_cmb
+                    tab[1:, 1:] = np.nan
+                    tab.flush()
+                    del tab
+                    os.rename(tmpName, self.ThetaStore)
+                self.theta_store = np.load(self.ThetaStore, mmap_mode='r+')
+        return self.theta_store
 
     def SaveThetaFile(self, test=False):
-        
-        kgrid = np.logspace(np.log10(self.kmin), np.log10(self.kmax), self.knum)
-        if os.path.isfile(self.ThetaFile):
-            os.remove(self.ThetaFile)
-        
-        t_file_nmes = path + '/OutputFiles/' + self.Ftag + '_ThetaFile_kval_*'
-        if self.multiverse:
-            extraTG = '_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(self.Nbrane, self.PressFac, self.eCDM)
-        else:
-            extraTG = '.dat'
-        t_file_nmes += extraTG
-        
-        ThetaFiles = glob.glob(t_file_nmes)
-        klist = np.array([])
-        for i in range(len(ThetaFiles)):
-            if not self.multiverse:
-                kval = float(ThetaFiles[i][ThetaFiles[i].find('kval_')+5:ThetaFiles[i].find('.dat')])
-            else:
-                kval = float(ThetaFiles[i][ThetaFiles[i].find('kval_')+5:ThetaFiles[i].find('_Nbrane_')])
-            klist = np.append(klist, kval)
-        
-        klist = np.sort(klist)
-        for i in range(len(ThetaFiles)):
-            dat = np.loadtxt(path + '/OutputFiles/' + self.Ftag + '_ThetaFile_kval_{:.4e}'.format(klist[i]) + extraTG)
-            self.ThetaTabTot[i+1,:] = dat
-            os.remove(path + '/OutputFiles/' + self.Ftag + '_ThetaFile_kval_{:.4e}'.format(klist[i]) + extraTG)
+        store = self.theta_table()
+        missing = np.isnan(store[1:, 1])
+        if np.any(missing):
+            # keep the partial table, a rerun only computes the missing rows
+            print 'Theta table incomplete, missing k = ', self.kgrid_cmb[missing]
+            return
+        self.ThetaTabTot[1:] = store[1:, 1:]
         np.savetxt(self.ThetaFile, self.ThetaTabTot, fmt='%.4e')
+        self.theta_store = None
+        del store
+        os.remove(self.ThetaStore)
         
         if test:
-            np.savetxt(path + '/OutputFiles/TESTING_THETA.dat', np.column_stack((kgrid, self.ThetaTabTot[1:,:])))
+            np.savetxt(path + '/OutputFiles/TESTING_THETA.dat', np.column_stack((self.kgrid_cmb, self.ThetaTabTot[1:,:])))
+        return
+
+    def set_cmb_kgrid(self, kgrid):
+        # Replace the CMB k grid (e.g. by adaptive_kgrid): resizes ThetaTabTot and the Theta table. A
+        # matter power grid that was the CMB grid follows it.
+        kgrid = np.sort(np.asarray(kgrid, dtype=float))
+        if self.kgrid_mps is self.kgrid_cmb:
+            self.kgrid_mps = kgrid
+        self.kgrid_cmb = kgrid
+        self.knum = len(self.kgrid_cmb)
+        ell_val = self.ThetaTabTot[0,:]
+        self.ThetaTabTot = np.zeros((self.knum+1, len(ell_val)))
+        self.ThetaTabTot[0,:] = ell_val
+        self.theta_store = None
+        self.kgrid = union_kgrid(self.kgrid_cmb, self.kgrid_mps)
         return
 
+    def adaptive_kgrid(self, knum0=64, tol=1e-2, max_points=None, max_rounds=10, solve_map=None):
+        # Adaptive CMB k grid between kmin and kmax. Starting from knum0 log-spaced k values, every interval
+        # whose midpoint (in ln k) has cubic and linear interpolants of Theta_l(k) differing by more than
+        # tol (relative to max_k |Theta_l|, worst ell) is bisected, until no interval is flagged or the
+        # grid holds max_points (default knum) values. Fields and line of sight sources already on disk
+        # are reused. Each round adds its k values to kgrid_cmb and the Theta table (keeping the rows of
+        # earlier rounds), then computes their fields and Theta_l rows with run_batch, here or through
+        # solve_map(klist), e.g. a Pool started inside it (after k_batches(klist)) so that the workers
+        # inherit the round's grid and table. Ends with kgrid_cmb and the Theta table on the final grid
+        # (see SaveThetaFile).
+        if max_points is None:
+            max_points = self.knum
+        new = np.logspace(np.log10(self.kmin), np.log10(self.kmax), knum0)
+        rows = {}
+        for rnd in range(max_rounds):
+            self.set_cmb_kgrid(np.concatenate((list(rows.keys()), new)))
+            store = self.theta_table()
+            for i, k in enumerate(self.kgrid_cmb):
+                if k in rows:
+                    store[i + 1, 1:] = rows[k]
+            store.flush()
+            if solve_map is None:
+                for kval in self.k_batches(new):
+                    self.run_batch(kval)
+            else:
+                solve_map(list(new))
+            kvals = self.kgrid_cmb
+            theta = np.array(store[1:, 1:])
+            missing = np.isnan(theta).any(axis=1)
+            if np.any(missing):
+                raise IOError('Adaptive k grid: no Theta_l for k = ' + ' '.join('{:.4e}'.format(k) for k in kvals[missing]))
+            rows = dict(zip(kvals, theta))
+            
+            lnk = np.log(kvals)
+            mid = (lnk[1:] + lnk[:-1]) / 2.
+            scale = np.max(np.abs(theta), axis=0)
+            scale[scale == 0.] = 1.
+            cubic = interp1d(lnk, theta, kind='cubic', axis=0)(mid)
+            err = np.max(np.abs(cubic - (theta[1:] + theta[:-1])/2.) / scale, axis=1)
+            above = np.where(err > tol)[0]
+            # worst intervals first when the point budget runs out
+            flagged = above[np.argsort(-err[above])][:max(max_points - len(kvals), 0)]
+            print 'Adaptive k grid: {:d} k values, {:d} intervals above tolerance, {:d} refined'.format(len(kvals), len(above), len(flagged))
+            if len(flagged) == 0:
+                break
+            new = np.exp(mid[flagged])
+        return kvals
+
     def computeCMB(self):
         thetaTab = np.loadtxt(self.ThetaFile)
         ell_tab = self.ThetaTabTot[0,:]
-        CL_table = np.zeros((len(ell_tab), 2))
         if not self.multiverse:
             GF = ((self.OM_b+self.OM_c) / self.growthFactor(1.))**2.
         else:
             GF = ((self.OM_b+self.OM_c + (self.OM_b2 + self.OM_c2)*self.Nbrane) / self.growthFactor(1.))**2.
         
-        for i,ell in enumerate(ell_tab):
-            cL_interp = interp1d(self.kgrid, (thetaTab[1:, i]/self.init_pert), kind='cubic', fill_value=0.)
-            CLint = quad(lambda x: (x/self.H_0)**(0.96605-1.)*100.*np.pi/(9.)*cL_interp(x)**2./x, self.kgrid[0], self.kgrid[-1], limit=300)
-            CL_table[i] = [ell, ell*(ell+1)/(2.*np.pi)*CLint[0]*GF]
-            if math.isnan(CLint[0]):
-                print i, ell
-                print np.abs(thetaTab[1:, i]/self.init_pert)**2.
-                print thetaTab[1:, i]
-                print cL_interp(np.log10(self.kgrid))
-                exit()
-
-        Cl_name = path + '/OutputFiles/' + self.Ftag + '_CL_Table'
-        if self.multiverse:
-            Cl_name += '_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(self.Nbrane, self.PressFac, self.eCDM)
-        else:
-            Cl_name += '.dat'
-        np.savetxt(Cl_name, CL_table)
+        # C_l = int dk/k (k/H_0)^(n_s-1) 100 pi/9 Theta_l(k)^2 for all ells at once: the cubic spline of
+        # Theta_l(k) is evaluated at fixed Gauss-Legendre nodes of every k interval, one matrix product
+        kq, wq = gauss_nodes(self.kgrid_cmb)
+        theta_q = interp1d(self.kgrid_cmb, thetaTab[1:, :]/self.init_pert, kind='cubic', axis=0)(kq)
+        prim = (kq/self.H_0)**(0.96605-1.)*100.*np.pi/(9.)/kq
+        CLint = (wq*prim).dot(theta_q**2.)
+        CL_table = np.column_stack((ell_tab, ell_tab*(ell_tab+1)/(2.*np.pi)*CLint*GF))
+        if np.any(np.isnan(CLint)):
+            print 'NaN C_l at ell =', ell_tab[np.isnan(CLint)]
+            exit()
+
+        np.savetxt(self.ClFile, CL_table)
         return
 
     def growthFactor(self, a):
@@ -330,39 +591,31 @@ class CMB(object):
         return etaL[np.argmax(visEval)]
 
     def MatterPower(self):
-        # T(k) = \Phi(k, a=1) / \Phi(k = Large, a= 1)
-        # P(k,a=1) = 2 pi^2 * \delta_H^2 * k / H_0^4 * T(k)^2
-        Tktab = self.TransferFuncs()
-        #kgrid = np.logspace(np.log10(self.kmin), np.log10(self.kmax), self.knum)
-        PS = np.zeros_like(self.kgrid)
-        for i,k in enumerate(self.kgrid):
-            PS[i] = k*Tktab[i]**2.
-        if self.multiverse:
-            np.savetxt(path + '/OutputFiles/' + self.Ftag +
-                       '_MatterPowerSpectrum_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(self.Nbrane,self.PressFac,self.eCDM),
-                       np.column_stack((self.kgrid, PS)))
-        else:
-            np.savetxt(path + '/OutputFiles/' + self.Ftag + '_MatterPowerSpectrum.dat', np.column_stack((self.kgrid, PS)))
+        # T(k, z) = a(z) \Phi(k, z) / \Phi(k = Large, a = 1)
+        # P(k,z) = 2 pi^2 * \delta_H^2 * k / H_0^4 * T(k, z)^2, one column per z_out
+        PS = np.column_stack([self.kgrid_mps*self.TransferFuncs(z)**2. for z in self.z_out])
+        header = 'k ' + ' '.join('P(k,z={:.3g})'.format(z) for z in self.z_out)
+        np.savetxt(self.MPSFile, np.column_stack((self.kgrid_mps, PS)), header=header)
         return
 
-    def TransferFuncs(self):
-        if self.multiverse:
-            Minfields = np.loadtxt(path + '/OutputFiles/' + self.Ftag +
-                        '_FieldEvolution_{:.4e}_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(self.kmin, self.Nbrane,
-                        self.PressFac, self.eCDM))
-        else:
-            Minfields = np.loadtxt(path + '/OutputFiles/' + self.Ftag + '_FieldEvolution_{:.4e}.dat'.format(self.kmin))
-        LargeScaleVal = Minfields[-1, 1]
-        #kgrid = np.logspace(np.log10(self.kmin), np.log10(self.kmax), self.knum)
-        Tktab = np.zeros_like(self.kgrid)
-        for i,k in enumerate(self.kgrid):
-            if self.multiverse:
-                field =  np.loadtxt(path + '/OutputFiles/'+ self.Ftag +
-                                    '_FieldEvolution_{:.4e}_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(k, self.Nbrane,
-                                    self.PressFac, self.eCDM))
-            else:
-                field =  np.loadtxt(path + '/OutputFiles/' + self.Ftag + '_FieldEvolution_{:.4e}.dat'.format(k))
-            Tktab[i] = field[-1,1] / LargeScaleVal
+    def TransferFuncs(self, z=0.):
+        LargeScaleVal = self.transfer_phi(self.kgrid_mps[0])
+        Tktab = np.zeros_like(self.kgrid_mps)
+        for i,k in enumerate(self.kgrid_mps):
+            Tktab[i] = self.transfer_phi(k, z) / (1. + z) / LargeScaleVal
         return Tktab
 
+    def transfer_phi(self, k, z=0.):
+        # Phi(k, z) from the Transfer summary written at solve time; runs without one fall back to the
+        # last row of the memory-mapped field table (z = 0 only)
+        if fields_exist(self.field_file(k, kind='Transfer')):
+            summary = load_fields(self.field_file(k, kind='Transfer'))
+            row = np.argmin(np.abs(summary[:, 0] - z))
+            if np.abs(summary[row, 0] - z) > 1e-6:
+                raise ValueError('No transfer output at z = {:.3g} for k = {:.4e}'.format(z, k))
+            return summary[row, 1]
+        if z != 0.:
+            raise ValueError('No transfer summary for k = {:.4e}'.format(k))
+        return load_fields(self.field_file(k))[-1, 1]
+
 
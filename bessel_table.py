@@ -0,0 +1,77 @@
+import numpy as np
+import os
+import hashlib
+from scipy.special import spherical_jn
+from table_cache import file_lock
+
+path = os.getcwd()
+
+
+class BesselTable(object):
+    # j_l(x) and j_l'(x) for a fixed set of integer multipoles on a uniform x grid [0, x_max], stored
+    # as one (nx, 2, nl) .npy in precomputed/ and memory-mapped. The file name is a hash of
+    # (ells, x_max, dx), so every CMB run and every Pool worker with the same ell grid and k range
+    # shares one table. Lookups use cubic Hermite interpolation in (j_l, j_l'), error ~ dx^4.
+
+    def __init__(self, ells, x_max, dx=0.2, directory=None):
+        self.ells = np.asarray(ells, dtype=int)
+        self.dx = dx
+        # round x_max up so that small changes of eta_0 reuse the same file
+        self.x_max = np.ceil(x_max / 100.) * 100.
+        self.nx = int(np.ceil(self.x_max / dx)) + 2
+        if directory is None:
+            directory = path + '/precomputed'
+        key = hashlib.md5(self.ells.tobytes() + repr((self.x_max, dx)).encode()).hexdigest()[:12]
+        self.fileName = directory + '/BesselTable_' + key + '.npy'
+        if not os.path.isfile(self.fileName):
+            # one process builds the table, the others wait for it instead of building it too
+            with file_lock(self.fileName[:-4] + '.lock'):
+                if not os.path.isfile(self.fileName):
+                    self.build()
+        self.table = np.load(self.fileName, mmap_mode='r')
+
+    def build(self, chunk=2000):
+        # Written to a temporary name and renamed, so a concurrent reader never sees a partial table
+        tmpName = self.fileName + '.{:d}.tmp'.format(os.getpid())
+        tab = np.lib.format.open_memmap(tmpName, mode='w+', dtype=np.float64, shape=(self.nx, 2, len(self.ells)))
+        lcol = self.ells[:, np.newaxis]
+        for i in range(0, self.nx, chunk):
+            x = np.arange(i, min(i + chunk, self.nx)) * self.dx
+            tab[i:i+len(x), 0, :] = spherical_jn(lcol, x).T
+            tab[i:i+len(x), 1, :] = spherical_jn(lcol, x, derivative=True).T
+        tab.flush()
+        del tab
+        os.rename(tmpName, self.fileName)
+        return
+
+    def lookup(self, x, max_elements=2**22):
+        # Returns j_l(x), j_l'(x), each (nl, len(x)). Evaluated over chunks of x so that the gathered
+        # table rows and the Hermite temporaries hold about max_elements values each, whatever the
+        # number of ells (e.g. every multipole to l = 2500)
+        x = np.maximum(np.asarray(x, dtype=float), 0.)
+        if np.max(x) > self.x_max:
+            raise ValueError('BesselTable covers x <= {:.1f}, got {:.1f}'.format(self.x_max, np.max(x)))
+        jl = np.empty((len(self.ells), len(x)))
+        jl_p = np.empty((len(self.ells), len(x)))
+        chunk = max(max_elements // (2*len(self.ells)), 1)
+        for s in range(0, len(x), chunk):
+            jl[:, s:s+chunk], jl_p[:, s:s+chunk] = self.hermite(x[s:s+chunk])
+        return jl, jl_p
+
+    def hermite(self, x):
+        # Cubic Hermite interpolation of one chunk of lookup, results (len(x), nl) transposed
+        u = x / self.dx
+        i = np.minimum(u.astype(int), self.nx - 2)
+        t = (u - i)[:, np.newaxis]
+        lo = self.table[i]
+        hi = self.table[i + 1]
+        h00 = (1. + 2.*t)*(1. - t)**2.
+        h10 = t*(1. - t)**2.
+        h01 = t**2.*(3. - 2.*t)
+        h11 = t**2.*(t - 1.)
+        jl = h00*lo[:, 0] + h10*self.dx*lo[:, 1] + h01*hi[:, 0] + h11*self.dx*hi[:, 1]
+        g00 = 6.*t*(t - 1.)
+        g10 = (1. - t)*(1. - 3.*t)
+        g11 = t*(3.*t - 2.)
+        jl_p = (g00*(lo[:, 0] - hi[:, 0]))/self.dx + g10*lo[:, 1] + g11*hi[:, 1]
+        return jl.T, jl_p.T
@@ -6,21 +6,442 @@ import sympy
 import scipy
 import scipy.linalg
 from scipy.optimize import fsolve
-from scipy.linalg import lu_solve, lu_factor, inv
+from scipy.linalg import lu_solve, lu_factor, inv, solve_banded
 from scipy.integrate import ode, quad, odeint
 from scipy.interpolate import interp1d
 from constants import *
+from frw_metric import frw_background
+from field_store import field_root, save_fields
+from table_cache import TableCache, file_lock
 #import time
 import warnings
 warnings.filterwarnings("error", category=UserWarning)
 
 path = os.getcwd()
 
+# Thermal history and optical depth tables of every cosmology, keyed by Universe.cache_params.
+# Bump TABLE_VERSION when a change of the code alters the tables.
+table_cache = TableCache(path + '/precomputed/cache')
+TABLE_VERSION = 1
+
+# tanh reionisation: hydrogen (and first helium) at Z_REION, second helium ionisation at Z_REION_HE
+Z_REION = 12.
+Z_REION_HE = 3.5
+
+
+# Scale factors multiplying the constant Jacobian templates (see Universe.jacobian_factors):
+# 1, 1/(Ha), 1/(Ha)^2, 1/(H^2 a^3), 1/(H^2 a^4), 1/a^2, 1/(H a^3), 1/(eta H a)
+# followed by dTa/(Ha), dTa/(H a^2), cs^2/(Ha) for each photon-baryon sector.
+F_ONE, F_KHA, F_KHA2, F_H2A3, F_H2A4, F_A2, F_HA3, F_ETA = range(8)
+
+
+def psi_template(nfac, nvars, k, rad_terms):
+    # PsiTerm = -Phi - 12 (a/k)^2 sum(rho * Theta_2/N_2), and k/(Ha) * PsiTerm, as factor templates.
+    # rad_terms: (index, omega*H_0^2) pairs of the radiation quadrupoles
+    psi = np.zeros((nfac, nvars))
+    psi[F_ONE, 0] = -1.
+    for indx, om_H2 in rad_terms:
+        psi[F_A2, indx] += -12.*om_H2/k**2.
+    kpsi = np.zeros_like(psi)
+    kpsi[F_KHA] = k*psi[F_ONE]
+    kpsi[F_HA3] = k*psi[F_A2]
+    return psi, kpsi
+
+
+def hierarchy_template(T, idx, k, lmax, kpsi, f_dta, f_dtaR, f_cs, R_inv):
+    # Fill rows 1...TotalVars-1 of one photon-baryon-neutrino sector (non-TCA equations) into the
+    # factor templates T[nfac, N, N]. Row 0 (Phi) must already be complete.
+    # idx maps the single universe variable layout onto the rows/cols of T, R_inv = 4 omega_g / (3 omega_b a).
+    def add(f, r, c, val):
+        T[f, idx[r], idx[c]] += val
+
+    # CDM/baryon density, Theta 0, Neu 0 all pick up the Phi time derivative
+    add(F_KHA, 1, 2, -k)
+    T[:, idx[1], :] += -3.*T[:, 0, :]
+    add(F_ONE, 2, 2, -1.)
+    T[:, idx[2], :] += kpsi
+    add(F_KHA, 3, 4, -k)
+    T[:, idx[3], :] += -3.*T[:, 0, :]
+    add(F_KHA, 5, 8, -k)
+    T[:, idx[5], :] += -T[:, 0, :]
+    add(F_KHA, 7, 10, -k)
+    T[:, idx[7], :] += -T[:, 0, :]
+    # Baryon velocity
+    add(F_ONE, 4, 4, -1.)
+    add(f_dtaR, 4, 4, R_inv)
+    T[:, idx[4], :] += kpsi
+    add(f_cs, 4, 3, k)
+    add(f_dtaR, 4, 8, -3.*R_inv)
+    # ThetaP 0
+    add(F_KHA, 6, 9, -k)
+    add(f_dta, 6, 6, 1./2.)
+    add(f_dta, 6, 11, -1./2.)
+    add(f_dta, 6, 12, -1./2.)
+    # Theta 1
+    add(F_KHA, 8, 5, k/3.)
+    add(f_dta, 8, 8, 1.)
+    add(f_dta, 8, 4, -1./3.)
+    add(F_KHA, 8, 11, -2.*k/3.)
+    T[:, idx[8], :] += kpsi/3.
+    # ThetaP 1
+    add(F_KHA, 9, 6, k/3.)
+    add(F_KHA, 9, 12, -2.*k/3.)
+    add(f_dta, 9, 9, 1.)
+    # Neu 1
+    add(F_KHA, 10, 7, k/3.)
+    add(F_KHA, 10, 13, -2.*k/3.)
+    T[:, idx[10], :] += kpsi/3.
+    # Theta 2, ThetaP 2
+    add(F_KHA, 11, 8, 2.*k/5.)
+    add(F_KHA, 11, 14, -3.*k/5.)
+    add(f_dta, 11, 11, 9./10.)
+    add(f_dta, 11, 6, -1./10.)
+    add(f_dta, 11, 12, -1./10.)
+    add(F_KHA, 12, 9, 2.*k/5.)
+    add(F_KHA, 12, 15, -3.*k/5.)
+    add(f_dta, 12, 12, 9./10.)
+    add(f_dta, 12, 11, -1./10.)
+    add(f_dta, 12, 6, -1./10.)
+    # Neu 2
+    add(F_KHA, 13, 10, 2.*k/5.)
+    add(F_KHA, 13, 16, -3.*k/5.)
+    # 2 < l < Lmax
+    elV = np.arange(3, lmax)
+    for j in range(3):
+        rows = idx[14 + 3*(elV - 3) + j]
+        T[F_KHA, rows, idx[14 + 3*(elV - 3) + j - 3]] += k*elV/(2.*elV + 1.)
+        T[F_KHA, rows, idx[14 + 3*(elV - 3) + j + 3]] += -k*(elV + 1.)/(2.*elV + 1.)
+        if j < 2:
+            T[f_dta, rows, rows] += 1.
+    # Lmax truncation
+    nvars = 8 + 3*lmax
+    for j in range(3):
+        add(F_KHA, nvars-3+j, nvars-6+j, k)
+        add(F_ETA, nvars-3+j, nvars-3+j, -(lmax + 1.))
+        if j < 2:
+            add(f_dta, nvars-3+j, nvars-3+j, 1.)
+    return
+
+
+def template_pattern(T):
+    # Union sparsity pattern of the factor templates T[nfac, N, N] (diagonal always included)
+    mask = np.any(T != 0., axis=0) | np.eye(T.shape[1], dtype=bool)
+    rows, cols = np.nonzero(mask)
+    coef = T[:, rows, cols].T
+    diag = np.where(rows == cols)[0]
+    return rows, cols, coef, diag
+
+
+class BandedSystem(object):
+    # Fixed sparsity pattern (rows, cols) of an N x N linear system, stored in LAPACK banded form
+    # after reordering the variables by perm.
+    def __init__(self, rows, cols, N, perm=None):
+        if perm is None:
+            perm = np.arange(N)
+        iperm = np.empty(N, dtype=int)
+        iperm[perm] = np.arange(N)
+        prow = iperm[rows]
+        pcol = iperm[cols]
+        self.lower = max(np.max(prow - pcol), 0)
+        self.upper = max(np.max(pcol - prow), 0)
+        self.shape = (self.lower + self.upper + 1, N)
+        self.flat_indx = np.ravel_multi_index((self.upper + prow - pcol, pcol), self.shape)
+        self.perm = perm
+
+    def solve(self, data, bvec):
+        ab = np.zeros(self.shape)
+        ab.flat[self.flat_indx] = data
+        ysol = np.empty_like(bvec)
+        ysol[self.perm] = solve_banded((self.lower, self.upper), ab, bvec[self.perm], check_finite=False)
+        return ysol
+
+
+def band_solve(Amat, bvec, perm=None):
+    # The Boltzmann hierarchy couples multipole l only to l+-1 (three slots apart), and the
+    # Phi/source couplings all live in the first few rows and columns, so the implicit system is
+    # banded with a bandwidth independent of Lmax. A banded LU is then linear in the number of multipoles.
+    # perm reorders the variables so that every coupling sits close to the diagonal.
+    rows, cols = np.nonzero(Amat)
+    return BandedSystem(rows, cols, Amat.shape[0], perm=perm).solve(Amat[rows, cols], bvec)
+
+
+def initial_vector(TotalVars, k, eta_0, rfactor, Psi):
+    # Adiabatic initial conditions for one sector in the Universe variable layout
+    yinit = np.zeros(TotalVars)
+    yinit[0] = -(1.+2.*rfactor/5.)*Psi
+    yinit[1] = -3./2.*Psi
+    yinit[2] = 1./2.*eta_0*k*Psi
+    yinit[3] = -3./2.*Psi
+    yinit[4] = 1./2*eta_0*k*Psi
+    yinit[5] = -1./2.*Psi
+    yinit[8] = 1./6.*eta_0*k*Psi
+    yinit[7] = -1./2.*Psi
+    yinit[10] = 1./6.*eta_0*k*Psi
+    yinit[13] = 1./30.*(k*eta_0)**2.*Psi
+    return yinit
+
+
+class StateHistory(object):
+    # Solution history as one contiguous (steps x nvars) float64 buffer, doubled when full
+    def __init__(self, nvars, size=4096):
+        self.data = np.zeros((size, nvars))
+        self.n = 0
+
+    def append(self, row):
+        if self.n == self.data.shape[0]:
+            self.data = np.concatenate((self.data, np.zeros_like(self.data)))
+        self.data[self.n] = row
+        self.n += 1
+
+    def last(self, back=1):
+        return self.data[self.n - back]
+
+    def values(self):
+        return self.data[:self.n]
+
+
+class BackgroundContext(object):
+    # k-independent state of one cosmology: the FRW_Background (eta(a), H(a)) and the thermal
+    # tables (Xe, Tb, optical depth, visibility, ...) as (a, value) columns. Build it once with
+    # Universe.background_context / ManyBrane_Universe.background_context and pass it to every
+    # Universe(k, ..., context=ctx). Only arrays are pickled, so it is cheap to ship to Pool workers.
+
+    def __init__(self, background, tables):
+        self.background = background
+        self.tables = tables
+        self.eta_0 = background.eta_0
+        self.build_interp()
+
+    def build_interp(self):
+        tau_tab = self.tables['tau']
+        self.opt_depth = interp1d(np.log10(tau_tab[:,0]), tau_tab[:,1], kind='cubic',
+                                  bounds_error=False, fill_value='extrapolate')
+        self.Vfunc = interp1d(np.log10(tau_tab[:,0]), tau_tab[:,2], kind='cubic', bounds_error=False, fill_value=0.)
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['opt_depth']
+        del state['Vfunc']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build_interp()
+
+    def hubble(self, a):
+        return self.background.hubble(a)
+
+    def conform_T(self, a):
+        return self.background.conform_T(a)
+
+    def scale_a(self, eta):
+        return self.background.scale_a(eta)
+
+    def exp_opt_depth(self, a):
+        return self.opt_depth(np.log10(a))
+
+    def visibility(self, a):
+        return self.Vfunc(np.log10(a))
+
+
+class RecombinationSolver(object):
+    # Stiff (x_e, T_b) recombination history for a set of independent sectors (the visible and
+    # dark sectors of one cosmology, or many cosmologies at once). Every argument is a per-sector
+    # array; the state is ordered [xe_0, T_0, xe_1, T_1, ...] in lgz = log10(z) and the analytic
+    # Jacobian is block diagonal (one 2x2 block per sector).
+    # lgz_freeze: x_e is held fixed above this redshift, clip: negative x_e, T_b are read as 0.
+
+    def __init__(self, omega_M, omega_R, omega_L, Yp, nb_fac, omega_Rat, T_cmb=2.7255,
+                 lgz_freeze=np.inf, clip=False, H_0=2.2348e-4):
+        sec = np.broadcast_arrays(omega_M, omega_R, omega_L, Yp, nb_fac, omega_Rat, T_cmb, lgz_freeze, clip)
+        (self.omega_M, self.omega_R, self.omega_L, self.Yp, self.nb_fac, self.omega_Rat,
+         self.T_cmb, self.lgz_freeze, self.clip) = [np.array(v, dtype=float) for v in sec]
+        self.clip = self.clip.astype(bool)
+        self.any_clip = np.any(self.clip)
+        self.lgz_first_freeze = np.min(self.lgz_freeze)
+        self.H_0 = H_0
+        self.nsec = len(self.omega_M)
+        self.constants()
+        return
+
+    @classmethod
+    def combine(cls, solvers):
+        keys = ['omega_M', 'omega_R', 'omega_L', 'Yp', 'nb_fac', 'omega_Rat', 'T_cmb', 'lgz_freeze', 'clip']
+        args = [np.concatenate([getattr(s, key) for s in solvers]) for key in keys]
+        return cls(*args, H_0=solvers[0].H_0)
+
+    def constants(self):
+        # Everything in xeDiff / dotT that does not depend on (x_e, T_b, z)
+        ep0 = 13.6/1e9  # GeV
+        kb = 8.617e-5/1e9 # Gev/K
+        GeV_cm = 5.06e13
+        Mpc_to_cm = 3.086e24
+        me = 5.11e-4 # GeV
+        FScsnt = 7.29e-3
+        thompson_xsec = 6.65e-25 # cm^2
+        self.x_T = ep0/kb  # ep0/(kb T) = x_T / T
+        self.c_alpha = 9.78*(FScsnt/me)**2./(GeV_cm**2.)
+        self.c_beta = (me*kb/(2.*np.pi))**(3./2.)*GeV_cm**3.
+        self.c_lalpha = (3.*ep0)**3. / (64.*np.pi**2*self.Yp) * GeV_cm**3.
+        self.L2g = 8.227 / 2.998e10 * Mpc_to_cm
+        self.Mpc_to_cm = Mpc_to_cm
+        self.n_b0 = 2.503e-7*self.nb_fac
+        self.c_T = (8./3.)/me*self.omega_Rat*thompson_xsec*Mpc_to_cm
+        self.mu_1 = 0.5*(1.-self.Yp) + self.Yp*1.33
+        self.mu_2 = 1.*(1.-self.Yp) + self.Yp*4.
+        return
+
+    def sectors(self, y):
+        xe = y[0::2]
+        T = y[1::2]
+        if self.any_clip and y.min() < 0.:
+            xe = np.where(self.clip & (xe < 0.), 0., xe)
+            T = np.where(self.clip & (T < 0.), 0., T)
+        return xe, T
+
+    def expansion(self, lgz):
+        yy = 10.**lgz
+        aval = 1. / (1. + yy)
+        hub = self.H_0*np.sqrt(self.omega_R*aval**-4.+self.omega_M*aval**-3.+self.omega_L)
+        return yy, aval, hub
+
+    def rates(self, xe, T, yy, aval, hub):
+        # Recombination / heating rates of xeDiff and dotT, one entry per sector
+        n_b = self.n_b0*(1.+yy)**3.
+        x = self.x_T / T
+        alpha2 = self.c_alpha*np.sqrt(x)*np.log(x)
+        Tfac = alpha2*self.c_beta*T*np.sqrt(T)
+        e4 = np.exp(-0.25*x)
+        beta2 = Tfac*e4*self.Mpc_to_cm
+        beta = Tfac*(e4*e4)**2
+        # Peebles C factor, 1 for x_e > 0.999 (where Lalpha is evaluated at 0.999 to stay finite)
+        full = xe > 0.999
+        if full.any():
+            Lsum = self.c_lalpha*hub/((1.-np.minimum(xe, 0.999))*n_b) + self.L2g
+            Cr = Lsum / (Lsum + beta2)
+            Cr[full] = 1.
+        else:
+            Lsum = self.c_lalpha*hub/((1.-xe)*n_b) + self.L2g
+            Cr = Lsum / (Lsum + beta2)
+        P = (-np.log(10.)*yy*aval*self.Mpc_to_cm)/hub
+        G = (1.-xe)*beta - xe*xe*n_b*alpha2
+        mu = self.mu_1*xe + self.mu_2*np.abs(1.16-xe)
+        K = self.c_T*n_b/hub
+        return n_b, x, alpha2, beta, beta2, full, Lsum, Cr, P, G, mu, K
+
+    def derivs(self, y, lgz):
+        xe, T = self.sectors(y)
+        yy, aval, hub = self.expansion(lgz)
+        n_b, x, alpha2, beta, beta2, full, Lsum, Cr, P, G, mu, K = self.rates(xe, T, yy, aval, hub)
+        jacF = - 1. * (yy * np.log(10.))
+        dy = np.empty_like(y)
+        dy[0::2] = Cr*P*G
+        if lgz > self.lgz_first_freeze:
+            dy[0::2][lgz > self.lgz_freeze] = 0.
+        dy[1::2] = (-2.*aval*T + K*mu*xe*(self.T_cmb*(1.+yy) - T))*jacF
+        return dy
+
+    def jacobian(self, y, lgz):
+        # d f_i / d y_j; block diagonal with one 2x2 block per sector
+        xe, T = self.sectors(y)
+        yy, aval, hub = self.expansion(lgz)
+        n_b, x, alpha2, beta, beta2, full, Lsum, Cr, P, G, mu, K = self.rates(xe, T, yy, aval, hub)
+        jacF = - 1. * (yy * np.log(10.))
+        # d/dT of alpha2, beta, beta2 and of the Peebles factor
+        lnx = np.log(x)
+        dla = -(lnx + 2.)/(2.*T*lnx)
+        dalpha2 = alpha2*dla
+        dbeta = beta*(dla + (1.5 + x)/T)
+        dbeta2 = beta2*(dla + (1.5 + x/4.)/T)
+        dCr_dxe = beta2/(Lsum + beta2)**2. * (Lsum - self.L2g)/(1.-np.minimum(xe, 0.999))
+        dCr_dT = -Lsum/(Lsum + beta2)**2. * dbeta2
+        dCr_dxe[full] = 0.
+        dCr_dT[full] = 0.
+        dmu = self.mu_1 - self.mu_2*np.sign(1.16-xe)
+        free = np.where(lgz > self.lgz_freeze, 0., 1.)
+        on_xe = np.where(self.clip & (y[0::2] < 0.), 0., 1.)
+        on_T = np.where(self.clip & (y[1::2] < 0.), 0., 1.)
+        ix = np.arange(0, len(y), 2)
+        jac = np.zeros((len(y), len(y)))
+        jac[ix, ix] = free*on_xe*(dCr_dxe*G - Cr*(beta + 2.*xe*n_b*alpha2))*P
+        jac[ix, ix+1] = free*on_T*(dCr_dT*G + Cr*((1.-xe)*dbeta - xe**2.*n_b*dalpha2))*P
+        jac[ix+1, ix] = on_xe*K*(self.T_cmb*(1.+yy) - T)*(dmu*xe + mu)*jacF
+        jac[ix+1, ix+1] = -on_T*(2.*aval + K*mu*xe)*jacF
+        return jac
+
+    def solve(self, y0, tvals):
+        # y0: (nsec, 2) initial (x_e, T_b); returns (len(tvals), nsec, 2)
+        sln = odeint(self.derivs, np.asarray(y0, dtype=float).flatten(), tvals, Dfun=self.jacobian)
+        return sln.reshape(len(tvals), self.nsec, 2)
+
+
+def reverse_cumtrapz(y, x):
+    # int_{x_i}^{x_-1} y dx for every i with the trapezoid rule, in one pass
+    seg = 0.5*(y[1:] + y[:-1])*np.diff(x)
+    return np.concatenate((np.cumsum(seg[::-1])[::-1], [0.]))
+
+
+def output_rows(avals, table, z_out):
+    # Rows of table (one per time step, scale factors avals) at the redshifts z_out, linear in ln a.
+    # Redshifts past the end of the run (e.g. z = 0 when the last step stops short of eta_0) take the
+    # final row.
+    lna_out = -np.log1p(np.asarray(z_out, dtype=float))
+    return np.column_stack([np.interp(lna_out, np.log(avals), col) for col in table.T])
+
+
+def remove_legacy_tables(f_tag='', dark=False):
+    # Working text tables of older versions (thermal history and optical depth, now in table_cache).
+    # A file another process removed first is not an error.
+    names = ['xe_working', 'tb_working', 'working_expOpticalDepth', 'working_VisibilityFunc']
+    if dark:
+        names += ['xe_dark_working', 'tb_dark_working']
+    for name in names:
+        try:
+            os.remove(path + '/precomputed/' + name + f_tag + '.dat')
+        except OSError:
+            pass
+    return
+
+
+def class_thermodynamics():
+    # Visible sector of the static CLASS table (read-only), ascending in a: columns a, x_e, exp(-tau),
+    # visibility, T_b, cs^2
+    tab = np.loadtxt(path + '/precomputed/explanatory02_thermodynamics.dat')
+    avals = 1./(1. + tab[:,0])
+    return np.column_stack((avals, tab[:,2], tab[:,4], tab[:,5], tab[:,6], tab[:,7]))[np.argsort(avals)]
+
+
+def reionization_floor(tvals):
+    # tanh reionisation of hydrogen (z = Z_REION) and the second helium ionisation (z = Z_REION_HE)
+    zreion = Z_REION
+    tanhV = .5*(1. + 0.08112)*(1.+np.tanh(((1.+zreion)**(3./2.) - (1.+10.**tvals)**(3./2.)) / (3./2.)*np.sqrt(1.+zreion)*0.5))
+    zreionHE = Z_REION_HE
+    tanhV += .5*0.08112*(1.+np.tanh(((1.+zreionHE)**(3./2.) - (1.+10.**tvals)**(3./2.)) / (3./2.)*np.sqrt(1.+zreionHE)*0.5))
+    return tanhV
+
+
+def thermal_sweep(universes, tvals=None):
+    # Solve the recombination history of many cosmologies (e.g. a PressureFac or Nbrane sweep) in a
+    # single stiff integration and hand each Universe / ManyBrane_Universe its tables. The universes
+    # can be built with thermal=False so that nothing is integrated one cosmology at a time (see
+    # param_sweep; load_thermal picks up the ones table_cache already has).
+    if tvals is None:
+        tvals = universes[0].thermal_grid()
+    solver = RecombinationSolver.combine([uni.recombination_solver() for uni in universes])
+    y0 = [uni.thermal_init(tvals) for uni in universes]
+    sln = solver.solve(np.concatenate(y0), tvals)
+    i = 0
+    for uni, y in zip(universes, y0):
+        uni.store_thermal(tvals, sln[:, i:i+len(y)])
+        i += len(y)
+    return
+
 
 class Universe(object):
 
     def __init__(self, k, omega_b, omega_cdm, omega_g, omega_L, omega_nu, accuracy=1e-3,
-                 stepsize=0.01, lmax=5, testing=False):
+                 stepsize=0.01, lmax=5, testing=False, solver='banded', context=None, thermal=True):
         self.omega_b = omega_b
         self.omega_cdm = omega_cdm
         self.omega_g = omega_g
@@ -40,27 +461,30 @@ class Universe(object):
         self.TotalVars = 8 + 3*self.Lmax
         self.step = 0
         
-        self.Theta_Dot = np.zeros(self.Lmax+1 ,dtype=object)
-        self.Theta_P_Dot = np.zeros(self.Lmax+1 ,dtype=object)
-        self.Neu_Dot = np.zeros(self.Lmax+1 ,dtype=object)
-        
-        self.combined_vector = np.zeros(self.TotalVars ,dtype=object)
-        self.Psi_vec = []
-        self.combined_vector[0] = self.Phi_vec = []
-        self.combined_vector[1] = self.dot_rhoCDM_vec = []
-        self.combined_vector[2] = self.dot_velCDM_vec = []
-        self.combined_vector[3] = self.dot_rhoB_vec = []
-        self.combined_vector[4] = self.dot_velB_vec = []
-        for i in range(self.Lmax + 1):
-            self.combined_vector[5+i*3] = self.Theta_Dot[i] = []
-            self.combined_vector[6+i*3] = self.Theta_P_Dot[i] = []
-            self.combined_vector[7+i*3] = self.Neu_Dot[i] = []
-        
-        self.compute_funcs()
+        # 'banded': banded LU of the implicit system, 'dense': full LU
+        if solver not in ('banded', 'dense'):
+            raise ValueError('Unknown solver: {}'.format(solver))
+        self.solver = solver
+        self.band_perm = None
+        self.tflip_TCA = 1e-12
+        
+        # Phi, delta_c, v_c, delta_b, v_b, then (Theta_l, ThetaP_l, N_l) for l = 0...Lmax
+        self.history = StateHistory(self.TotalVars)
+        # Interpolated cs^2 when the context carries a 'cs2' table
+        self.cs_interp = None
+        # Redshifts of the Transfer summary written next to the field table by save_system
+        self.z_out = [0.]
+        
+        if context is None:
+            self.compute_funcs(thermal=thermal)
+        else:
+            self.load_context(context)
 #        print 'Matter-Radiation Eq: ', (self.omega_M/self.omega_R - 1.)
 #        print self.omega_M, self.omega_R
 #        exit()
 
+        self.jacobian_template()
+
         self.testing = testing
         if self.testing:
             self.aLIST = []
@@ -72,92 +496,106 @@ class Universe(object):
         
         return
 
-    def compute_funcs(self, preload=False):
-        a0_init = np.logspace(-14, 0, 1e4)
-        eta_list = np.zeros_like(a0_init)
-        for i in range(len(a0_init)):
-            eta_list[i] = self.conform_T(a0_init[i])
+    def compute_funcs(self, preload=False, thermal=True):
+        self.background = frw_background(self.omega_M, self.omega_R, self.omega_L, self.H_0)
+        self.eta_0 = self.background.eta_0
+        self.ct_to_scale = self.background.ct_to_scale
+        self.scale_to_ct = self.background.scale_to_ct
         
-        self.eta_0 = eta_list[-1]
-        self.ct_to_scale = interp1d(np.log10(eta_list), np.log10(a0_init), kind='linear',
-                                    bounds_error=False, fill_value='extrapolate')
-        self.scale_to_ct = interp1d(np.log10(a0_init), np.log10(eta_list), kind='linear',
-                                    bounds_error=False, fill_value='extrapolate')
-        
-        self.Thermal_sln()
         # DONT FORGET ABOUT THIS
+        # preload: x_e, T_b, exp(-tau), the visibility and the sound speed from the CLASS table
+        self.preload = preload
         if preload:
-            total_loaded = 0
-            while total_loaded < 1:
-                try:
-                    generic_full_files = np.loadtxt('precomputed/explanatory02_thermodynamics.dat')
-                    total_loaded += 1
-                except:
-                    pass
-            avals = 1./(1. + generic_full_files[:,0])
-            visfunc = generic_full_files[:,5]
-            exptau = generic_full_files[:,4]
-            temb = generic_full_files[:,6]
-            
-            csoundb = generic_full_files[:,7]
-            xe = generic_full_files[:,2]
-            self.Cs_Sqr = interp1d(avals, csoundb, kind='linear', bounds_error=False, fill_value='extrapolate')
-            np.savetxt(path + '/precomputed/tb_working.dat', np.column_stack((avals, temb)))
-            np.savetxt(path + '/precomputed/xe_working.dat', np.column_stack((avals, xe)))
-            np.savetxt(path + '/precomputed/working_VisibilityFunc.dat', np.column_stack((avals, visfunc)))
-            np.savetxt(path + '/precomputed/working_expOpticalDepth.dat', np.column_stack((avals, exptau)))
+            self.class_tab = class_thermodynamics()
+            self.Cs_Sqr = interp1d(self.class_tab[:,0], self.class_tab[:,5], kind='linear', bounds_error=False,
+                                   fill_value='extrapolate')
+        # thermal=False leaves the thermal history to thermal_sweep
+        if thermal:
+            self.Thermal_sln()
 
     def clearfiles(self):
-        if os.path.isfile(path + '/precomputed/xe_working.dat'):
-            os.remove(path + '/precomputed/xe_working.dat')
-        if os.path.isfile(path + '/precomputed/tb_working.dat'):
-            os.remove(path + '/precomputed/tb_working.dat')
-
-        if os.path.isfile(path + '/precomputed/working_expOpticalDepth.dat'):
-            os.remove(path + '/precomputed/working_expOpticalDepth.dat')
-        if os.path.isfile(path + '/precomputed/working_VisibilityFunc.dat'):
-            os.remove(path + '/precomputed/working_VisibilityFunc.dat')
+        remove_legacy_tables()
 
     def Thermal_sln(self):
-        self.tb_fileNme = path + '/precomputed/tb_working.dat'
-        self.Xe_fileNme = path + '/precomputed/xe_working.dat'
-        if not os.path.isfile(self.tb_fileNme) or not os.path.isfile(self.Xe_fileNme):
-#            tvals = np.linspace(5., -1, 500)
-            tvals = np.linspace(3.4, -1, 500)
-            y0 = [1.079, 2.7255 * (1. + 10.**tvals[0])]
-#            y0 = [1., 2.7255 * (1. + 10.**tvals[0]), 0., 1.]
-            val_sln = odeint(self.thermal_funcs, y0, tvals)
-            avals = 1. / (1. + 10.**tvals)
-            zreion = 12.
-            tanhV = .5*(1. + 0.08112)*(1.+np.tanh(((1.+zreion)**(3./2.) - (1.+10.**tvals)**(3./2.)) / (3./2.)*np.sqrt(1.+zreion)*0.5))
-            zreionHE = 3.5
-            tanhV += .5*0.08112*(1.+np.tanh(((1.+zreionHE)**(3./2.) - (1.+10.**tvals)**(3./2.)) / (3./2.)*np.sqrt(1.+zreionHE)*0.5))
-            val_sln[:,0] = np.maximum(val_sln[:,0], tanhV)
-            self.Tb_drk = np.column_stack((avals, val_sln[:, 1]))
-            np.savetxt(self.tb_fileNme, self.Tb_drk)
-            self.Xe_dark = np.column_stack((avals, val_sln[:,0]))
-            np.savetxt(self.Xe_fileNme, self.Xe_dark)
-    
-        else:
-            total_loaded = 0
-            while total_loaded < 1:
-                try:
-                    self.Tb_drk = np.loadtxt(self.tb_fileNme)
-                    self.Xe_dark = np.loadtxt(self.Xe_fileNme)
-                    total_loaded += 1
-                except:
-                    pass
-        
+        if self.load_thermal():
+            return
+        # one process solves, the others block on the lock and then load its table
+        with table_cache.lock('thermal', self.cache_params()):
+            if not self.load_thermal():
+                tvals = self.thermal_grid()
+                self.store_thermal(tvals, self.recombination_solver().solve(self.thermal_init(tvals), tvals))
+        return
+
+    def load_thermal(self):
+        # Thermal history from table_cache; False when it has none for this cosmology
+        cached = table_cache.load('thermal', self.cache_params())
+        if cached is None:
+            return False
+        self.Tb_drk = cached['Tb']
+        self.Xe_dark = cached['Xe']
+        self.thermal_interp()
+        return True
+
+    def cache_params(self):
+        # Every input of the thermal history, the table_cache key (tau_functions adds its grid size)
+        return {'model': 'StandardUniverse', 'version': TABLE_VERSION, 'omega_b': self.omega_b,
+                'omega_cdm': self.omega_cdm, 'omega_g': self.omega_g, 'omega_nu': self.omega_nu,
+                'omega_L': self.omega_L, 'H_0': self.H_0, 'Yp': 0.245, 'lgz_freeze': 3.5,
+                'reionization': (Z_REION, Z_REION_HE), 'tvals': self.thermal_grid(), 'preload': self.preload}
+
+    def thermal_grid(self):
+        return np.linspace(3.4, -1, 500)
+
+    def recombination_solver(self):
+        return RecombinationSolver([self.omega_M], [self.omega_R], [self.omega_L], 0.245, 1.,
+                                   self.omega_g / self.omega_b, lgz_freeze=3.5, H_0=self.H_0)
+
+    def thermal_init(self, tvals):
+        return np.array([[1.079, 2.7255 * (1. + 10.**tvals[0])]])
+
+    def store_thermal(self, tvals, sln):
+        # sln: (len(tvals), 1, 2) x_e, T_b from RecombinationSolver.solve
+        val_sln = sln.reshape(len(tvals), 2)
+        avals = 1. / (1. + 10.**tvals)
+        val_sln[:,0] = np.maximum(val_sln[:,0], reionization_floor(tvals))
+        self.Tb_drk = np.column_stack((avals, val_sln[:, 1]))
+        self.Xe_dark = np.column_stack((avals, val_sln[:,0]))
+        if self.preload:
+            self.Tb_drk = self.class_tab[:, [0, 4]]
+            self.Xe_dark = self.class_tab[:, [0, 1]]
+        table_cache.store('thermal', self.cache_params(), {'Tb': self.Tb_drk, 'Xe': self.Xe_dark})
+        self.thermal_interp()
+        return
+
+    def thermal_interp(self):
         self.Tb = interp1d(np.log10(self.Tb_drk[:,0]), np.log10(self.Tb_drk[:,1]), bounds_error=False, fill_value='extrapolate')
         self.Xe = interp1d(np.log10(self.Xe_dark[:,0]), np.log10(self.Xe_dark[:,1]), bounds_error=False, fill_value=np.log10(1.1622))
         return
 
+    def background_context(self, n_tau=10000, tabulate_cs=False):
+        # tabulate_cs: store cs^2 on the background grid so that Universes built from the context
+        # interpolate the sound speed instead of evaluating Cs_Sqr
+        self.tau_functions(n_tau)
+        tables = {'Tb': self.Tb_drk, 'Xe': self.Xe_dark, 'tau': self.tau_tab}
+        if tabulate_cs:
+            tables['cs2'] = self.cs_table()
+        return BackgroundContext(self.background, tables)
+
+    def load_context(self, context):
+        # Take the background and thermal history from a shared BackgroundContext instead of compute_funcs
+        self.background = context.background
+        self.eta_0 = self.background.eta_0
+        self.ct_to_scale = self.background.ct_to_scale
+        self.scale_to_ct = self.background.scale_to_ct
+        self.Tb_drk = context.tables['Tb']
+        self.Xe_dark = context.tables['Xe']
+        self.thermal_interp()
+        if 'cs2' in context.tables:
+            cs_tab = context.tables['cs2']
+            self.cs_interp = interp1d(cs_tab[:,0], cs_tab[:,1], kind='linear', bounds_error=False, fill_value='extrapolate')
+        return
+
 
-    def thermal_funcs(self, val, z):
-#        xe, T, xhe_1, xhe_2 = val
-        xe, T = val
-        return [self.xeDiff([xe], z, T)[0], self.dotT([T], z, xe)]
-    
     def dotT(self, T, lgz, xe):
         kb = 8.617e-5/1e9 # Gev/K
         thompson_xsec = 6.65e-25 # cm^2
@@ -174,78 +612,58 @@ class Universe(object):
         return (-2.*T[0]*aval + (1./hub)*(8./3.)*(mol_wei/5.11e-4)*omega_Rat*(xe*n_b*thompson_xsec)*(2.7255*(1.+10.**lgz) - T[0])*Mpc_to_cm)*jacF
     
     def Cs_Sqr(self, a):
+        # a may be a scalar or an array
+        if self.cs_interp is not None:
+            return self.cs_interp(a)
         kb = 8.617e-5/1e9 # GeV/K
+        a = np.asarray(a, dtype=float)
         facxe = 10.**self.Xe(np.log10(a))
         Yp = 0.245
 
         mol_wei = (0.5*(1.-Yp) + Yp*1.33)*facxe + (1.*(1.-Yp) + Yp*4.)*np.abs(1.16-facxe)
         Tb = 10.**self.Tb(np.log10(a))
-        if a < 1:
-            lgZ = np.log10(1./a - 1.)
-        else:
-            lgZ = -10
+        # lgZ = -10 for a >= 1
+        lgZ = np.log10(np.maximum(1./a - 1., 1e-10))
         extraPT = self.dotT([Tb], lgZ, facxe) *(-1./Tb)*(1.+10.**lgZ)/(np.log(10.) * 10.**lgZ)
         val_r = 2.*kb*Tb/mol_wei*(1. - 1./3. * extraPT/Tb)
-        if val_r < 0.:
-            return np.abs(val_r)
-        if val_r > 1:
-            return 1.
-        return val_r
-
-    def xeDiff(self, val, y, tgas, hydrogen=True, first=True):
-        if y > 3.5:
-            return [0.]
-        yy = 10.**y
-        ep0 = 13.6/1e9  # GeV
-        kb = 8.617e-5/1e9 # Gev/K
-        GeV_cm = 5.06e13
+        return np.where(val_r < 0., np.abs(val_r), np.minimum(val_r, 1.))
+
+    def cs_table(self):
+        # Baryon sound speed on the background a grid, columns a, cs^2
+        avals = self.background.a_tab
+        return np.column_stack((avals, self.Cs_Sqr(avals)))
+
+    def tau_functions(self, n_a=10000):
+        # n_a: points of the log-spaced a grid of the optical depth / visibility tables
+        if self.preload:
+            # columns a, exp(-tau), visibility of the CLASS table
+            self.tau_tab = self.class_tab[:, [0, 2, 3]]
+            return
+        params = dict(self.cache_params(), n_a=n_a)
+        cached = table_cache.load('tau', params)
+        if cached is None:
+            # one process builds the table, the others block on the lock and then load it
+            with table_cache.lock('tau', params):
+                cached = table_cache.load('tau', params)
+                if cached is None:
+                    self.tau_tab = self.optical_depth(n_a)
+                    table_cache.store('tau', params, {'tau': self.tau_tab})
+                    return
+        self.tau_tab = cached['tau']
+        return
+
+    def optical_depth(self, n_a):
+        # columns: a, exp(-tau), visibility on n_a log-spaced scale factors
         Mpc_to_cm = 3.086e24
-        me = 5.11e-4 # GeV
-        aval = 1. / (1.+yy)
+        avals = np.logspace(-7, 0, n_a)
         Yp = 0.245
-        
-        n_b = 2.503e-7 / aval**3.
-        hub = self.hubble(aval)
-        FScsnt = 7.29e-3
-        
-        alpha2 = 9.78*(FScsnt/me)**2.*np.sqrt(ep0/(kb*tgas))*np.log(ep0/(kb*tgas))/(GeV_cm**2.) # cm^2
-        beta = alpha2*(me*(kb*tgas)/(2.*np.pi))**(3./2.)*np.exp(-ep0/(kb*tgas))*GeV_cm**3. # 1/cm
-        beta2 = alpha2*(me*(kb*tgas)/(2.*np.pi))**(3./2.)*np.exp(-ep0/(4.*kb*tgas))*GeV_cm**3.*Mpc_to_cm
-        
-        if val[0] > 0.999:
-            Cr = 1.
-        else:
-            Lalpha = (3.*ep0)**3.*hub / (64.*np.pi**2*(1-val[0])*n_b*Yp) * GeV_cm**3.
-            L2g = 8.227 / 2.998e10 * Mpc_to_cm
-            Cr = (Lalpha + L2g) / (Lalpha + L2g + beta2)
-        
-        Value = Cr*np.log(10.)*yy*(-aval)/(hub)*((1.-val[0])*beta - val[0]**2.*n_b*alpha2)*Mpc_to_cm
-        return [Value]
-    
-    
-    def tau_functions(self):
-        self.fileN_optdep = path + '/precomputed/working_expOpticalDepth.dat'
-        self.fileN_visibil = path + '/precomputed/working_VisibilityFunc.dat'
-        Mpc_to_cm = 3.086e24
-        if not os.path.isfile(self.fileN_visibil) or not os.path.isfile(self.fileN_optdep):
-            avals = np.logspace(-7, 0, 10000)
-            Yp = 0.245
-            n_b = 2.503e-7 / avals**3.
-            thompson_xsec = 6.65e-25 # cm^2
-            xevals = 10.**self.Xe(np.log10(avals))
-            hubbs = self.hubble(avals)
-            dtau = -xevals * (1. - Yp) * n_b * thompson_xsec * avals * Mpc_to_cm
-            tau = np.zeros_like(dtau)
-            etavals = np.zeros_like(avals)
-            for i in range(len(avals)):
-                etavals[i] = self.conform_T(avals[i])
-            for i in range(len(dtau) - 1):
-                tau[i+1] = np.trapz(-dtau[i:], etavals[i:])
-            tau[0] = tau[1]
-            np.savetxt(self.fileN_optdep, np.column_stack((avals, np.exp(-tau))))
-            np.savetxt(self.fileN_visibil, np.column_stack((avals, -dtau * np.exp(-tau))))
-    
-        return
+        n_b = 2.503e-7 / avals**3.
+        thompson_xsec = 6.65e-25 # cm^2
+        xevals = 10.**self.Xe(np.log10(avals))
+        dtau = -xevals * (1. - Yp) * n_b * thompson_xsec * avals * Mpc_to_cm
+        # tau(eta_i) = int_{eta_i}^{eta_0} -dtau deta
+        tau = reverse_cumtrapz(-dtau, self.conform_T(avals))
+        return np.column_stack((avals, np.exp(-tau), -dtau * np.exp(-tau)))
 
     def init_conds(self, eta_0, aval):
         OM = self.omega_M * self.H_0**2./self.hubble(aval)**2./aval**3.
@@ -256,33 +674,17 @@ class Universe(object):
         HUB = self.hubble(aval)
 
         self.inital_perturb = -1./6.
-        for i in range(1):
-            self.Psi_vec.append(self.inital_perturb)
-            self.Phi_vec.append(-(1.+2.*rfactor/5.)*self.Psi_vec[-1])
-            self.dot_rhoCDM_vec.append(-3./2.*self.Psi_vec[-1])
-            self.dot_velCDM_vec.append(1./2.*eta_0*self.k*self.Psi_vec[-1])
-            self.dot_rhoB_vec.append(-3./2.*self.Psi_vec[-1])
-            self.dot_velB_vec.append(1./2*eta_0*self.k*self.Psi_vec[-1])
-            
-            self.Theta_Dot[0].append(-1./2.*self.Psi_vec[-1])
-            self.Theta_Dot[1].append(1./6.*eta_0*self.k*self.Psi_vec[-1])
-            self.Neu_Dot[0].append(-1./2.*self.Psi_vec[-1])
-            self.Neu_Dot[1].append(1./6.*eta_0*self.k*self.Psi_vec[-1])
-            self.Neu_Dot[2].append(1./30.*(self.k*eta_0)**2.*self.Psi_vec[-1])
-            
-
-            for i in range(self.Lmax + 1):
-                if i > 1:
-                    self.Theta_Dot[i].append(0.)
-                self.Theta_P_Dot[i].append(0.)
-                if i > 2:
-                    self.Neu_Dot[i].append(0.)
+        self.history.append(initial_vector(self.TotalVars, self.k, eta_0, rfactor, self.inital_perturb))
     
         self.step = 0
         return
     
     
-    def solve_system(self):
+    def solve_system(self, z_out=None):
+        # z_out: redshifts of the Transfer summary (default z = 0), interpolated from the in-memory
+        # history when the run is saved
+        if z_out is not None:
+            self.z_out = list(z_out)
         eta_st = np.min([1e-3/self.k, 1e-1/0.7]) # Initial conformal time in Mpc
         y_st = np.log(self.scale_a(eta_st))
         eta_st = self.conform_T(np.exp(y_st))
@@ -364,25 +766,81 @@ class Universe(object):
             tau_n = (self.y_vector[-1] - self.y_vector[-2]) / self.y_vector[-2]
         
         delt = (self.y_vector[-1] - self.y_vector[-2])
-        Ident = np.eye(self.TotalVars)
-        Jmat = self.matrix_J(self.y_vector[-1])
-        Amat = (1.+2.*tau_n)/(1.+tau_n)*Ident - delt*Jmat
+        diag = (1.+2.*tau_n)/(1.+tau_n)
         bvec = self.b_vector(tau_n)
-        ysol = np.matmul(inv(Amat),bvec)
-        for i in range(self.TotalVars):
-            self.combined_vector[i].append(ysol[i])
+        a_val = np.exp(self.y_vector[-1])
+        if self.solver == 'banded' and a_val > self.tflip_TCA:
+            Adata = -delt*self.jacobian_data(a_val)
+            Adata[self.J_diag] += diag
+            ysol = self.J_band.solve(Adata, bvec)
+        else:
+            Amat = -delt*self.matrix_J(self.y_vector[-1])
+            Amat[np.diag_indices_from(Amat)] += diag
+            if self.solver == 'banded':
+                ysol = band_solve(Amat, bvec, perm=self.band_perm)
+            else:
+                ysol = lu_solve(lu_factor(Amat), bvec)
+        self.history.append(ysol)
         return
     
     def b_vector(self, tau):
-        bvec = np.zeros(self.TotalVars)
-        for i in range(self.TotalVars):
-            if self.step == 0:
-                bvec[i] = (1.+tau)*self.combined_vector[i][-1]
-            else:
-                bvec[i] = (1.+tau)*self.combined_vector[i][-1] - tau**2./(1.+tau)*self.combined_vector[i][-2]
-        return bvec
+        if self.step == 0:
+            return (1.+tau)*self.history.last()
+        return (1.+tau)*self.history.last() - tau**2./(1.+tau)*self.history.last(2)
     
+    def jacobian_template(self):
+        # Every entry of matrix_J is a (k, Lmax) dependent constant times one of the scale factors
+        # returned by jacobian_factors, J = sum_f s_f(a) T_f. Tabulate the constants once on the
+        # non-zero pattern so that each step only costs a (nnz x nfac) matrix-vector product.
+        N = self.TotalVars
+        T = np.zeros((11, N, N))
+        psi, kpsi = psi_template(11, N, self.k, [(11, self.omega_g*self.H_0**2.), (13, self.omega_nu*self.H_0**2.)])
+        # Phi Time derivative
+        T[:, 0, :] += psi
+        T[F_KHA2, 0, 0] += -self.k**2./3.
+        T[F_H2A3, 0, 1] += self.omega_cdm*self.H_0**2./2.
+        T[F_H2A3, 0, 3] += self.omega_b*self.H_0**2./2.
+        T[F_H2A4, 0, 5] += 2.*self.omega_g*self.H_0**2.
+        T[F_H2A4, 0, 7] += 2.*self.omega_nu*self.H_0**2.
+        hierarchy_template(T, np.arange(N), self.k, self.Lmax, kpsi, 8, 9, 10, 4.*self.omega_g/(3.*self.omega_b))
+        
+        self.J_rows, self.J_cols, self.J_coef, self.J_diag = template_pattern(T)
+        self.J_band = BandedSystem(self.J_rows, self.J_cols, N, perm=self.band_perm)
+        self.Jbuf = np.zeros((N, N))
+        return
+
+    def jacobian_factors(self, a_val):
+        eta = self.conform_T(a_val)
+        HUB = self.hubble(a_val)
+        dTa = -10.**self.Xe(np.log10(a_val))*(1.-0.245)*2.503e-7*6.65e-29*1e4/a_val**2./3.24078e-25
+        CsndB = self.Cs_Sqr(a_val)
+        
+        if self.testing:
+            self.aLIST.append(a_val)
+            self.etaLIST.append(eta)
+            self.hubLIST.append(HUB)
+            self.csLIST.append(CsndB)
+            self.dtauLIST.append(dTa)
+            self.xeLIST.append(10.**self.Xe(np.log10(a_val)))
+        
+        # a_val may be an array of times: the factors are then (nfac, len(a_val))
+        Ha = HUB*a_val
+        return np.array([np.ones_like(Ha), 1./Ha, 1./Ha**2., 1./(HUB**2.*a_val**3.), 1./(HUB**2.*a_val**4.), 1./a_val**2.,
+                         1./(Ha*a_val**2.), 1./(eta*Ha), dTa/Ha, dTa/(Ha*a_val), CsndB/Ha])
+
+    def jacobian_data(self, a_val):
+        # Non-zero entries of the Jacobian, ordered as (self.J_rows, self.J_cols)
+        return self.J_coef.dot(self.jacobian_factors(a_val))
+
     def matrix_J(self, z_val):
+        # Dense Jacobian, filled in place from the template (overwritten on the next call)
+        a_val = np.exp(z_val)
+        if a_val <= self.tflip_TCA:
+            return self.matrix_J_full(z_val)
+        self.Jbuf[self.J_rows, self.J_cols] = self.jacobian_data(a_val)
+        return self.Jbuf
+
+    def matrix_J_full(self, z_val):
         a_val = np.exp(z_val)
         eta = self.conform_T(a_val)
         Jma = np.zeros((self.TotalVars, self.TotalVars))
@@ -401,8 +859,6 @@ class Universe(object):
             self.dtauLIST.append(dTa)
             self.xeLIST.append(10.**self.Xe(np.log10(a_val)))
         
-        tflip_TCA = 1e-12
-        
         PsiTerm = np.zeros(self.TotalVars)
         PsiTerm[0] += -1.
         PsiTerm[11] += -12.*(a_val/self.k)**2.*self.rhoG(a_val)
@@ -433,7 +889,7 @@ class Universe(object):
         Jma[5,:] += -Jma[0,:]
         
         # Baryon velocity
-        if a_val > tflip_TCA:
+        if a_val > self.tflip_TCA:
             Jma[4,4] += -1. + dTa / (Rfac*HUB*a_val)
             Jma[4,:] += self.k/(HUB*a_val)*PsiTerm
             Jma[4,3] += self.k * CsndB / (HUB * a_val)
@@ -465,7 +921,7 @@ class Universe(object):
         Jma[7,:] += -Jma[0,:]
 
         # Theta 1
-        if a_val > tflip_TCA:
+        if a_val > self.tflip_TCA:
             Jma[8,5] += self.k/ (3.*HUB*a_val)
             Jma[8,8] += dTa / (HUB*a_val)
             Jma[8,4] += -dTa / (3.*HUB*a_val)
@@ -530,10 +986,10 @@ class Universe(object):
         return Jma
 
     def scale_a(self, eta):
-        return 10.**self.ct_to_scale(np.log10(eta))
+        return self.background.scale_a(eta)
     
     def conform_T(self, a):
-        return quad(lambda x: 1./self.H_0 /np.sqrt(self.omega_R+self.omega_M*x+self.omega_L*x**4.), 0., a)[0]
+        return self.background.conform_T(a)
 
     def hubble(self, a):
         return self.H_0*np.sqrt(self.omega_R*a**-4.+self.omega_M*a**-3.+self.omega_L)
@@ -550,30 +1006,36 @@ class Universe(object):
     def rhoNeu(self, a):
         return self.omega_nu * self.H_0**2. * a**-4.
 
-    def epsilon_test(self, a):
+    def epsilon_test(self, a, yvec=None, k=None):
+        # yvec, k may also be a (nvars, nk) stack of states and an array of k (KBatch_Universe)
+        if yvec is None:
+            yvec = self.history.last()
+        if k is None:
+            k = self.k
         denom = (self.omega_M*a**-3. + self.omega_R*a**-4. + self.omega_L)
-        phiTerm = -2./3.*(self.k/(a*self.H_0))**2.*self.combined_vector[0][-1]
-        denTerm = (self.omega_cdm*self.combined_vector[1][-1]+self.omega_b*self.combined_vector[3][-1])*a**-3. +\
-                  4.*(self.omega_g*self.combined_vector[5][-1]+self.omega_nu*self.combined_vector[7][-1])*a**-4.
-        velTerm = 3.*a*self.hubble(a)/self.k*(
-                 (self.omega_cdm*self.combined_vector[2][-1]+self.omega_b*self.combined_vector[4][-1])*a**-3. +
-                 4.*(self.omega_g*self.combined_vector[8][-1]+self.omega_nu*self.combined_vector[10][-1])*a**-4.)
+        phiTerm = -2./3.*(k/(a*self.H_0))**2.*yvec[0]
+        denTerm = (self.omega_cdm*yvec[1]+self.omega_b*yvec[3])*a**-3. +\
+                  4.*(self.omega_g*yvec[5]+self.omega_nu*yvec[7])*a**-4.
+        velTerm = 3.*a*self.hubble(a)/k*(
+                 (self.omega_cdm*yvec[2]+self.omega_b*yvec[4])*a**-3. +
+                 4.*(self.omega_g*yvec[8]+self.omega_nu*yvec[10])*a**-4.)
         return (phiTerm + denTerm + velTerm)/denom
 
 
     def save_system(self):
-        psi_term = np.zeros(len(self.eta_vector))
-        for i in range(len(self.eta_vector)):
-            aval = 10.**self.ct_to_scale(np.log10(self.eta_vector[i]))
-            psi_term[i] = -12.*(aval**2./self.k**2.*(self.rhoNeu(aval)*self.combined_vector[13][i] +
-                                                       self.rhoG(aval)*self.combined_vector[11][i])) - self.combined_vector[0][i]
-        
-        sve_tab = np.zeros((len(self.eta_vector), self.TotalVars+2))
-        sve_tab[:,0] = self.eta_vector
-        sve_tab[:,-1] = psi_term
-        for i in range(self.TotalVars):
-            sve_tab[:,i+1] = self.combined_vector[i]
-        np.savetxt(path + '/OutputFiles/StandardUniverse_FieldEvolution_{:.4e}.dat'.format(self.k), sve_tab, fmt='%.8e', delimiter='    ')
+        fields = self.history.values()
+        etavals = np.asarray(self.eta_vector)
+        avals = 10.**self.ct_to_scale(np.log10(etavals))
+        psi_term = -12.*(avals**2./self.k**2.*(self.rhoNeu(avals)*fields[:,13] + self.rhoG(avals)*fields[:,11])) - fields[:,0]
+        
+        sve_tab = np.column_stack((etavals, fields, psi_term))
+        save_fields(field_root(path + '/OutputFiles', 'StandardUniverse', self.k), sve_tab)
+        
+        # Transfer summary, one row per z_out: z, Phi, Psi, delta_m, delta_c, delta_b
+        delta_m = (self.omega_cdm*fields[:,1] + self.omega_b*fields[:,3]) / self.omega_M
+        summary = output_rows(avals, np.column_stack((fields[:,0], psi_term, delta_m, fields[:,1], fields[:,3])), self.z_out)
+        save_fields(field_root(path + '/OutputFiles', 'StandardUniverse', self.k, kind='Transfer'),
+                    np.column_stack((self.z_out, summary)))
         
         if self.testing:
             np.savetxt(path+'/OutputFiles/StandardUniverse_Background.dat',
@@ -583,7 +1045,7 @@ class Universe(object):
 class ManyBrane_Universe(object):
     
     def __init__(self, Nbrane, k, omega_b, omega_cdm, omega_g, omega_L, omega_nu, accuracy=1e-3,
-                 stepsize=0.01, lmax=5, testing=False):
+                 stepsize=0.01, lmax=5, testing=False, solver='banded', context=None, thermal=True):
         self.omega_b_T = omega_b[0] + Nbrane*omega_b[1]
         self.omega_cdm_T = omega_cdm[0] + Nbrane*omega_cdm[1]
         self.omega_g_T = omega_g[0] + Nbrane*omega_g[1]
@@ -605,6 +1067,8 @@ class ManyBrane_Universe(object):
         
         self.ECDM = self.omega_cdm_T
         self.f_tag = '_Nbranes_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}'.format(self.Nbrane, self.PressureFac, self.ECDM)
+        # Suffix of the per-k tables; a caller that names points more finely (CMB out_tag) replaces it
+        self.out_tag = '_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}'.format(self.Nbrane, self.PressureFac, self.ECDM)
         
         ngamma_pr = 410.7 * (self.darkCMB_T/2.7255)**3.
         nbarys = 2.503e-7 * (omega_b[1]/omega_b[0])
@@ -629,39 +1093,29 @@ class ManyBrane_Universe(object):
         self.TotalVars = 8 + 3*self.Lmax
         self.step = 0
         
-        self.Theta_Dot = np.zeros(self.Lmax+1 ,dtype=object)
-        self.Theta_P_Dot = np.zeros(self.Lmax+1 ,dtype=object)
-        self.Neu_Dot = np.zeros(self.Lmax+1 ,dtype=object)
-        
-        self.Theta_Dot_D = np.zeros(self.Lmax+1 ,dtype=object)
-        self.Theta_P_Dot_D = np.zeros(self.Lmax+1 ,dtype=object)
-        self.Neu_Dot_D = np.zeros(self.Lmax+1 ,dtype=object)
-        
-        self.combined_vector = np.zeros(2*self.TotalVars-1 ,dtype=object)
-        self.Psi_vec = []
-        self.Phi_vec = []
-        self.combined_vector[0] = self.Phi_vec
-        self.combined_vector[1] = self.dot_rhoCDM_vec = []
-        self.combined_vector[2] = self.dot_velCDM_vec = []
-        self.combined_vector[3] = self.dot_rhoB_vec = []
-        self.combined_vector[4] = self.dot_velB_vec = []
-        for i in range(self.Lmax + 1):
-            self.combined_vector[5+i*3] = self.Theta_Dot[i] = []
-            self.combined_vector[6+i*3] = self.Theta_P_Dot[i] = []
-            self.combined_vector[7+i*3] = self.Neu_Dot[i] = []
-        
-        self.combined_vector[self.TotalVars] = self.dot_rhoCDM_vec_D = []
-        self.combined_vector[self.TotalVars+1] = self.dot_velCDM_vec_D = []
-        self.combined_vector[self.TotalVars+2] = self.dot_rhoB_vec_D = []
-        self.combined_vector[self.TotalVars+3] = self.dot_velB_vec_D = []
-        for i in range(self.Lmax + 1):
-            self.combined_vector[self.TotalVars+4+i*3] = self.Theta_Dot_D[i] = []
-            self.combined_vector[self.TotalVars+5+i*3] = self.Theta_P_Dot_D[i] = []
-            self.combined_vector[self.TotalVars+6+i*3] = self.Neu_Dot_D[i] = []
+        if solver not in ('banded', 'dense'):
+            raise ValueError('Unknown solver: {}'.format(solver))
+        self.solver = solver
+        # Interleave visible and dark copies of each variable (Phi is shared) so that the
+        # cross-sector couplings sit next to the diagonal
+        self.band_perm = np.concatenate(([0], np.column_stack((np.arange(1, self.TotalVars),
+                                        np.arange(self.TotalVars, 2*self.TotalVars-1))).flatten()))
+        self.tflip_TCA = 1e-11
+        
+        # Visible variables as in Universe, followed by the dark copies of variables 1...TotalVars-1
+        # (Phi is shared): the dark copy of variable m sits at TotalVars+m-1
+        self.history = StateHistory(2*self.TotalVars - 1)
+        self.cs_interp = None
+        self.z_out = [0.]
         
 #        self.load_funcs()
-        self.compute_funcs()
+        if context is None:
+            self.compute_funcs(thermal=thermal)
+        else:
+            self.load_context(context)
         
+        self.jacobian_template()
+
         self.testing = testing
         if self.testing:
             self.aLIST = []
@@ -676,105 +1130,98 @@ class ManyBrane_Universe(object):
 
         return
 
-    def compute_funcs(self, preload=True):
-        a0_init = np.logspace(-14, 0, 1e4)
-        eta_list = np.zeros_like(a0_init)
-        for i in range(len(a0_init)):
-            eta_list[i] = self.conform_T(a0_init[i])
-        self.eta_0 = eta_list[-1]
-        self.ct_to_scale = interp1d(np.log10(eta_list), np.log10(a0_init), kind='linear',
-                                    bounds_error=False, fill_value='extrapolate')
-        self.scale_to_ct = interp1d(np.log10(a0_init), np.log10(eta_list), kind='linear',
-                                    bounds_error=False, fill_value='extrapolate')
-
-        self.Thermal_sln()
+    def compute_funcs(self, preload=True, thermal=True):
+        self.background = frw_background(self.omega_M_T, self.omega_R_T, self.omega_L_T, self.H_0)
+        self.eta_0 = self.background.eta_0
+        self.ct_to_scale = self.background.ct_to_scale
+        self.scale_to_ct = self.background.scale_to_ct
+
          # DONT FORGET ABOUT THIS
+        # preload: the visible sector's x_e, T_b, exp(-tau), visibility and sound speed from the CLASS
+        # table; the dark sector is always solved here
+        self.preload = preload
         if preload:
-            self.preload = True
-            total_loaded = 0
-            while total_loaded < 1:
-                try:
-                    generic_full_files = np.loadtxt('precomputed/explanatory02_thermodynamics.dat')
-                    total_loaded += 1
-                except:
-                    pass
-            avals = 1./(1. + generic_full_files[:,0])
-            visfunc = generic_full_files[:,5]
-            exptau = generic_full_files[:,4]
-            temb = generic_full_files[:,6]
-            
-            csoundb = generic_full_files[:,7]
-            xe = generic_full_files[:,2]
-            self.Cs_Sqr_SM = interp1d(avals, csoundb, kind='linear', bounds_error=False, fill_value='extrapolate')
-            np.savetxt(path + '/precomputed/tb_working' + self.f_tag + '.dat', np.column_stack((avals, temb)))
-            np.savetxt(path + '/precomputed/xe_working' + self.f_tag + '.dat', np.column_stack((avals, xe)))
-            np.savetxt(path + '/precomputed/working_VisibilityFunc' + self.f_tag + '.dat', np.column_stack((avals, visfunc)))
-            np.savetxt(path + '/precomputed/working_expOpticalDepth' + self.f_tag + '.dat', np.column_stack((avals, exptau)))
-        else:
-            self.preload = False
+            self.class_tab = class_thermodynamics()
+            self.Cs_SM_tab = self.class_tab[:, [0, 5]]
+            self.Cs_Sqr_SM = interp1d(self.Cs_SM_tab[:,0], self.Cs_SM_tab[:,1], kind='linear', bounds_error=False,
+                                      fill_value='extrapolate')
+        # thermal=False leaves the thermal history to thermal_sweep
+        if thermal:
+            self.Thermal_sln()
         return
 
     def clearfiles(self):
-        if os.path.isfile(path + '/precomputed/xe_working' + self.f_tag + '.dat'):
-            os.remove(path + '/precomputed/xe_working' + self.f_tag + '.dat')
-        if os.path.isfile(path + '/precomputed/tb_working' + self.f_tag + '.dat'):
-            os.remove(path + '/precomputed/tb_working' + self.f_tag + '.dat')
-        
-        if os.path.isfile(path + '/precomputed/xe_dark_working' + self.f_tag + '.dat'):
-            os.remove(path + '/precomputed/xe_dark_working' + self.f_tag + '.dat')
-        if os.path.isfile(path + '/precomputed/tb_dark_working' + self.f_tag + '.dat'):
-            os.remove(path + '/precomputed/tb_dark_working' + self.f_tag + '.dat')
-
-        if os.path.isfile(path + '/precomputed/working_expOpticalDepth' + self.f_tag + '.dat'):
-            os.remove(path + '/precomputed/working_expOpticalDepth' + self.f_tag + '.dat')
-        if os.path.isfile(path + '/precomputed/working_VisibilityFunc' + self.f_tag + '.dat'):
-            os.remove(path + '/precomputed/working_VisibilityFunc' + self.f_tag + '.dat')
+        remove_legacy_tables(self.f_tag, dark=True)
         return
     
     def Thermal_sln(self):
-        self.tb_fileNme = path + '/precomputed/tb_working' + self.f_tag + '.dat'
-        self.Xe_fileNme = path + '/precomputed/xe_working' + self.f_tag + '.dat'
-        
-        self.tbDk_fileNme = path + '/precomputed/tb_dark_working' + self.f_tag + '.dat'
-        self.Xedk_fileNme = path + '/precomputed/xe_dark_working' + self.f_tag + '.dat'
-        
-        if not os.path.isfile(self.tb_fileNme) or not os.path.isfile(self.Xe_fileNme) \
-            or not os.path.isfile(self.Xedk_fileNme) or not os.path.isfile(self.tbDk_fileNme):
-            tvals = np.linspace(3.5, -1, 1000)
-            y0 = [1., 2.7255 * (1. + 10.**tvals[0]), 1., self.darkCMB_T * (1. + 10.**tvals[0])]
-         
-            val_sln = odeint(self.thermal_funcs, y0, tvals)
-            avals = 1. / (1. + 10.**tvals)
-            
-            #check sanity
-            val_sln[val_sln < 1e-50] = 1e-50
-            
-            zreion = 12.
-            tanhV = .5*(1. + 0.08112)*(1.+np.tanh(((1.+zreion)**(3./2.) - (1.+10.**tvals)**(3./2.)) / (3./2.)*np.sqrt(1.+zreion)*0.5))
-            zreionHE = 3.5
-            tanhV += .5*0.08112*(1.+np.tanh(((1.+zreionHE)**(3./2.) - (1.+10.**tvals)**(3./2.)) / (3./2.)*np.sqrt(1.+zreionHE)*0.5))
-            val_sln[:,0] = np.maximum(val_sln[:,0], tanhV)
-            
-            self.Tb_1 = np.column_stack((avals, val_sln[:, 1]))
-            np.savetxt(self.tb_fileNme, self.Tb_1)
-            self.Xe_1 = np.column_stack((avals, val_sln[:,0]))
-            np.savetxt(self.Xe_fileNme, self.Xe_1)
-            self.Xe_dark = np.column_stack((avals, val_sln[:,2]))
-            np.savetxt(self.Xedk_fileNme, self.Xe_dark)
-            self.Tb_drk = np.column_stack((avals, val_sln[:,3]))
-            np.savetxt(self.tbDk_fileNme, self.Tb_drk)
+        if self.load_thermal():
+            return
+        # one process solves, the others block on the lock and then load its table
+        with table_cache.lock('thermal', self.cache_params()):
+            if not self.load_thermal():
+                tvals = self.thermal_grid()
+                self.store_thermal(tvals, self.recombination_solver().solve(self.thermal_init(tvals), tvals))
+        return
+
+    def load_thermal(self):
+        # Thermal history from table_cache; False when it has none for this cosmology
+        cached = table_cache.load('thermal', self.cache_params())
+        if cached is None:
+            return False
+        self.Tb_1 = cached['Tb']
+        self.Xe_1 = cached['Xe']
+        self.Tb_drk = cached['Tb_dark']
+        self.Xe_dark = cached['Xe_dark']
+        self.thermal_interp()
+        return True
+
+    def cache_params(self):
+        # Every input of the visible and dark thermal histories, the table_cache key
+        return {'model': 'MultiBrane', 'version': TABLE_VERSION, 'Nbrane': self.Nbrane,
+                'omega_b': self.omega_b, 'omega_cdm': self.omega_cdm, 'omega_g': self.omega_g,
+                'omega_nu': self.omega_nu, 'omega_L': self.omega_L_T, 'H_0': self.H_0,
+                'PressureFac': self.PressureFac, 'Yp': (0.245, self.yp_prime), 'T_dark': self.darkCMB_T,
+                'reionization': (Z_REION, Z_REION_HE), 'tvals': self.thermal_grid(), 'preload': self.preload}
+
+    def thermal_grid(self):
+        return np.linspace(3.5, -1, 1000)
+
+    def recombination_solver(self):
+        # Visible and dark sector; both share the total expansion rate
+        if self.omega_b[1] != 0.:
+            omega_Rat_D = self.omega_g[1] / self.omega_b[1]
         else:
-            total_loaded = 0
-            while total_loaded < 1:
-                try:
-                    self.Tb_1 = np.loadtxt(self.tb_fileNme)
-                    self.Xe_1 = np.loadtxt(self.Xe_fileNme)
-                    self.Tb_drk = np.loadtxt(self.tbDk_fileNme)
-                    self.Xe_dark = np.loadtxt(self.Xedk_fileNme)
-                    total_loaded += 1
-                except:
-                    pass
-        
+            omega_Rat_D = self.omega_g[0] / self.omega_b[0]
+        return RecombinationSolver(self.omega_M_T, self.omega_R_T, self.omega_L_T, [0.245, self.yp_prime],
+                                   [1., self.omega_b[1]/self.omega_b[0]],
+                                   [self.omega_g[0] / self.omega_b[0], omega_Rat_D], clip=True, H_0=self.H_0)
+
+    def thermal_init(self, tvals):
+        return np.array([[1., 2.7255 * (1. + 10.**tvals[0])], [1., self.darkCMB_T * (1. + 10.**tvals[0])]])
+
+    def store_thermal(self, tvals, sln):
+        # sln: (len(tvals), 2, 2) x_e, T_b of the visible and dark sector from RecombinationSolver.solve
+        val_sln = sln.reshape(len(tvals), 4)
+        avals = 1. / (1. + 10.**tvals)
+        
+        #check sanity
+        val_sln[val_sln < 1e-50] = 1e-50
+        val_sln[:,0] = np.maximum(val_sln[:,0], reionization_floor(tvals))
+        
+        self.Tb_1 = np.column_stack((avals, val_sln[:, 1]))
+        self.Xe_1 = np.column_stack((avals, val_sln[:,0]))
+        self.Xe_dark = np.column_stack((avals, val_sln[:,2]))
+        self.Tb_drk = np.column_stack((avals, val_sln[:,3]))
+        if self.preload:
+            self.Tb_1 = self.class_tab[:, [0, 4]]
+            self.Xe_1 = self.class_tab[:, [0, 1]]
+        table_cache.store('thermal', self.cache_params(), {'Tb': self.Tb_1, 'Xe': self.Xe_1,
+                                                           'Tb_dark': self.Tb_drk, 'Xe_dark': self.Xe_dark})
+        self.thermal_interp()
+        return
+
+    def thermal_interp(self):
         self.Tb = interp1d(np.log10(self.Tb_1[:,0]), np.log10(self.Tb_1[:,1]), bounds_error=False, fill_value='extrapolate')
         #self.Xe = interp1d(np.log10(self.Xe_1[:,0]), np.log10(self.Xe_1[:,1]), bounds_error=False, fill_value='extrapolate')
         self.Xe = interp1d(np.log10(self.Xe_1[:,0]), self.Xe_1[:,1], bounds_error=False, fill_value='extrapolate')
@@ -782,29 +1229,44 @@ class ManyBrane_Universe(object):
         self.XE_DARK_B = interp1d(np.log10(self.Xe_dark[:,0]), self.Xe_dark[:,1], bounds_error=False, fill_value=0.)
         return
 
+    def background_context(self, n_tau=1000, tabulate_cs=False):
+        self.tau_functions(n_tau)
+        tables = {'Tb': self.Tb_1, 'Xe': self.Xe_1, 'Tb_dark': self.Tb_drk, 'Xe_dark': self.Xe_dark,
+                  'tau': self.tau_tab}
+        if self.preload:
+            tables['Cs_SM'] = self.Cs_SM_tab
+        if tabulate_cs:
+            tables['cs2'] = self.cs_table()
+        return BackgroundContext(self.background, tables)
+
+    def load_context(self, context):
+        # Take the background and thermal history from a shared BackgroundContext instead of compute_funcs
+        self.background = context.background
+        self.eta_0 = self.background.eta_0
+        self.ct_to_scale = self.background.ct_to_scale
+        self.scale_to_ct = self.background.scale_to_ct
+        self.Tb_1 = context.tables['Tb']
+        self.Xe_1 = context.tables['Xe']
+        self.Tb_drk = context.tables['Tb_dark']
+        self.Xe_dark = context.tables['Xe_dark']
+        self.thermal_interp()
+        self.preload = 'Cs_SM' in context.tables
+        if self.preload:
+            self.Cs_SM_tab = context.tables['Cs_SM']
+            self.Cs_Sqr_SM = interp1d(self.Cs_SM_tab[:,0], self.Cs_SM_tab[:,1], kind='linear',
+                                      bounds_error=False, fill_value='extrapolate')
+        if 'cs2' in context.tables:
+            cs_tab = context.tables['cs2']
+            self.cs_interp = [interp1d(cs_tab[:,0], cs_tab[:,i], kind='linear', bounds_error=False,
+                                       fill_value='extrapolate') for i in (1, 2)]
+        return
+
     def Tb_DARK(self, a):
-        
-        if a < 1:
-            z = (1./a - 1.)
-        else:
-            z = 0.1
-        
-        if z <= 10.**3.5:
-            return 10.**self.Tb_D(np.log10(a))
-        else:
-            return (z - (1./self.Tb_drk[0,0] - 1.))*self.Tb_drk[0,1] + self.Tb_drk[0,1]
-
-    def thermal_funcs(self, val, z):
-        xe, T, xeD, TD = val
-        if xeD < 0.:
-            xeD = 0.
-        if TD < 0.:
-            TD = 0.
-        if xe < 0.:
-            xe = 0.
-        if T < 0.:
-            T = 0.
-        return [self.xeDiff([xe], z, T)[0], self.dotT([T], z, xe), self.xeDiff([xeD], z, TD, dark=True)[0], self.dotT([TD], z, xeD, dark=True)]
+        # a may be a scalar or an array; linear in z above the dark thermal table
+        a = np.asarray(a, dtype=float)
+        z = np.where(a < 1, 1./a - 1., 0.1)
+        return np.where(z <= 10.**3.5, 10.**self.Tb_D(np.log10(a)),
+                        (z - (1./self.Tb_drk[0,0] - 1.))*self.Tb_drk[0,1] + self.Tb_drk[0,1])
 
     def dotT(self, T, lgz, xe, dark=False):
         kb = 8.617e-5/1e9 # Gev/K
@@ -832,10 +1294,14 @@ class ManyBrane_Universe(object):
         return (-2.*T[0]*aval + (1./hub)*(8./3.)*(mol_wei/5.11e-4)*omega_Rat*(xe*n_b*thompson_xsec)*(2.7255*(1.+10.**lgz) - T[0])*Mpc_to_cm)*jacF
     
     def Cs_Sqr(self, a, dark=False):
+        # a may be a scalar or an array
+        if self.cs_interp is not None:
+            return self.cs_interp[int(dark)](a)
         if self.preload == True and dark == False:
             return self.Cs_Sqr_SM(a)
         
         kb = 8.617e-5/1e9 # GeV/K
+        a = np.asarray(a, dtype=float)
         
         if not dark:
             #facxe = 10.**self.Xe(np.log10(a))
@@ -849,82 +1315,49 @@ class ManyBrane_Universe(object):
             Tb = self.Tb_DARK(a)
         
         mol_wei = (0.5*(1.-Yp) + Yp*1.33)*facxe + (1.*(1.-Yp) + Yp*4.)*np.abs(1.16-facxe)
-        if a < 1:
-            lgZ = np.log10(1./a - 1.)
-        else:
-            lgZ = -10
+        # lgZ = -10 for a >= 1
+        lgZ = np.log10(np.maximum(1./a - 1., 1e-10))
         
         extraPT = self.dotT([Tb], lgZ, facxe, dark=dark)*(-1./Tb)*(1.+10.**lgZ)/(np.log(10.) * 10.**lgZ)
         val_r = kb*Tb/mol_wei*(1. - 1./3. * extraPT)
-        if val_r < 0.:
-            return np.abs(val_r)
-        if val_r > 1:
-            return 1.
-        return val_r
-    
-    def xeDiff(self, val, y, tgas, dark=False, hydrogen=True, first=True):
-        yy = 10.**y
-     
-        if hydrogen:
-            ep0 = 13.6/1e9  # GeV
-        else:
-            if first:
-                ep0 = 54.4/1e9
-            else:
-                ep0 = 24.6/1e9
+        return np.where(val_r < 0., np.abs(val_r), np.minimum(val_r, 1.))
 
-        kb = 8.617e-5/1e9 # Gev/K
-        GeV_cm = 5.06e13
-        Mpc_to_cm = 3.086e24
-        me = 5.11e-4 # GeV
-        aval = 1. / (1.+yy)
-        if not dark:
-            Yp = 0.245
-        else:
-            Yp = self.yp_prime
-        n_b = 2.503e-7 / aval**3.
-        if dark:
-            n_b *= self.omega_b[1]/self.omega_b[0]
-        hub = self.hubble(aval)
-        FScsnt = 7.29e-3
-        
-        alpha2 = 9.78*(FScsnt/me)**2.*np.sqrt(ep0/(kb*tgas))*np.log(ep0/(kb*tgas))/(GeV_cm**2.) # cm^2
-        beta = alpha2*(me*(kb*tgas)/(2.*np.pi))**(3./2.)*np.exp(-ep0/(kb*tgas))*GeV_cm**3. # 1/cm
-        beta2 = alpha2*(me*(kb*tgas)/(2.*np.pi))**(3./2.)*np.exp(-ep0/(4.*kb*tgas))*GeV_cm**3.*Mpc_to_cm
-        
-        if val[0] > 0.999:
-            Cr = 1.
-        else:
-            Lalpha = (3.*ep0)**3.*hub / (64.*np.pi**2*(1-val[0])*n_b*Yp) * GeV_cm**3.
-            L2g = 8.227 / 2.998e10 * Mpc_to_cm
-            Cr = (Lalpha + L2g) / (Lalpha + L2g + beta2)
-        
-        Value = Cr*np.log(10.)*yy*(-aval)/(hub)*((1.-val[0])*beta - val[0]**2.*n_b*alpha2)*Mpc_to_cm
-        return [Value]
-    
-    
-    def tau_functions(self):
-        self.fileN_optdep = path + '/precomputed/working_expOpticalDepth' + self.f_tag + '.dat'
-        self.fileN_visibil = path + '/precomputed/working_VisibilityFunc' + self.f_tag + '.dat'
-        Mpc_to_cm = 3.086e24
-        if not os.path.isfile(self.fileN_visibil) or not os.path.isfile(self.fileN_optdep):
-            avals = np.logspace(-7, 0, 1000)
-            Yp = 0.245
-            n_b = 2.503e-7 / avals**3.
-            thompson_xsec = 6.65e-25 # cm^2
-            xevals = 10.**self.Xe(np.log10(avals))
-            hubbs = self.hubble(avals)
-            dtau = -xevals * (1. - Yp) * n_b * thompson_xsec * avals * Mpc_to_cm
-            dtau_I = interp1d(10.**self.scale_to_ct(np.log10(avals)), dtau, kind='linear', bounds_error=False, fill_value='extrapolate')
-            tau = np.zeros_like(dtau)
-            for i in range(len(dtau)):
-                tau[i] = -np.trapz(dtau[i:], 10.**self.scale_to_ct(np.log10(avals[i:])))
-            tau[0] = tau[1]
-            np.savetxt(self.fileN_optdep, np.column_stack((avals, np.exp(-tau))))
-            np.savetxt(self.fileN_visibil, np.column_stack((avals, -dtau * np.exp(-tau))))
+    def cs_table(self):
+        # Visible and dark baryon sound speed on the background a grid, columns a, cs^2, cs_dark^2
+        avals = self.background.a_tab
+        return np.column_stack((avals, self.Cs_Sqr(avals), self.Cs_Sqr(avals, dark=True)))
     
+    def tau_functions(self, n_a=1000):
+        if self.preload:
+            # columns a, exp(-tau), visibility of the CLASS table
+            self.tau_tab = self.class_tab[:, [0, 2, 3]]
+            return
+        params = dict(self.cache_params(), n_a=n_a)
+        cached = table_cache.load('tau', params)
+        if cached is None:
+            # one process builds the table, the others block on the lock and then load it
+            with table_cache.lock('tau', params):
+                cached = table_cache.load('tau', params)
+                if cached is None:
+                    self.tau_tab = self.optical_depth(n_a)
+                    table_cache.store('tau', params, {'tau': self.tau_tab})
+                    return
+        self.tau_tab = cached['tau']
         return
 
+    def optical_depth(self, n_a):
+        # columns: a, exp(-tau), visibility on n_a log-spaced scale factors
+        Mpc_to_cm = 3.086e24
+        avals = np.logspace(-7, 0, n_a)
+        Yp = 0.245
+        n_b = 2.503e-7 / avals**3.
+        thompson_xsec = 6.65e-25 # cm^2
+        # self.Xe interpolates x_e itself (not log10 x_e) for ManyBrane
+        xevals = self.Xe(np.log10(avals))
+        dtau = -xevals * (1. - Yp) * n_b * thompson_xsec * avals * Mpc_to_cm
+        tau = reverse_cumtrapz(-dtau, self.conform_T(avals))
+        return np.column_stack((avals, np.exp(-tau), -dtau * np.exp(-tau)))
+
     def init_conds(self, eta_0, aval):
         OM = self.omega_M_T * self.H_0**2./self.hubble(aval)**2./aval**3.
         OR = self.omega_R_T * self.H_0**2./self.hubble(aval)**2./aval**4.
@@ -932,48 +1365,19 @@ class ManyBrane_Universe(object):
         rfactor = ONu / (0.75*OM*aval + OR)
 
         self.inital_perturb = -1./6.
-        for i in range(1):
-            self.Psi_vec.append(self.inital_perturb)
-            self.Phi_vec.append(-(1.+2.*rfactor/5.)*self.Psi_vec[-1])
-            
-            self.dot_rhoCDM_vec.append(-3./2.*self.Psi_vec[-1])
-            self.dot_velCDM_vec.append(1./2*eta_0*self.k*self.Psi_vec[-1])
-            self.dot_rhoB_vec.append(-3./2.*self.Psi_vec[-1])
-            self.dot_velB_vec.append(1./2*eta_0*self.k*self.Psi_vec[-1])
-            self.Theta_Dot[0].append(-1./2.*self.Psi_vec[-1])
-            self.Theta_Dot[1].append(1./6*eta_0*self.k*self.Psi_vec[-1])
-            self.Neu_Dot[0].append(-1./2.*self.Psi_vec[-1])
-            self.Neu_Dot[1].append(1./6*eta_0*self.k*self.Psi_vec[-1])
-            self.Neu_Dot[2].append(1./30.*(self.k*eta_0)**2.*self.Psi_vec[-1])
-            
-            self.dot_rhoCDM_vec_D.append(-3./2.*self.Psi_vec[-1])
-            self.dot_velCDM_vec_D.append(1./2*eta_0*self.k*self.Psi_vec[-1])
-            self.dot_rhoB_vec_D.append(-3./2.*self.Psi_vec[-1])
-            self.dot_velB_vec_D.append(1./2*eta_0*self.k*self.Psi_vec[-1])
-            self.Theta_Dot_D[0].append(-1./2.*self.Psi_vec[-1])
-            self.Theta_Dot_D[1].append(1./6*eta_0*self.k*self.Psi_vec[-1])
-            self.Neu_Dot_D[0].append(-1./2.*self.Psi_vec[-1])
-            self.Neu_Dot_D[1].append(1./6*eta_0*self.k*self.Psi_vec[-1])
-            self.Neu_Dot_D[2].append(1./30.*(self.k*eta_0)**2.*self.Psi_vec[-1])
-            
-            for i in range(self.Lmax + 1):
-                if i > 1:
-                    self.Theta_Dot[i].append(0.)
-                    self.Theta_Dot_D[i].append(0.)
-                self.Theta_P_Dot[i].append(0.)
-                self.Theta_P_Dot_D[i].append(0.)
-                if i > 2:
-                    self.Neu_Dot[i].append(0.)
-                    self.Neu_Dot_D[i].append(0.)
-
-#        for i in range(1,self.TotalVars):
-#            print self.combined_vector[i], self.combined_vector[self.TotalVars+i-1]
-
+        yinit = initial_vector(self.TotalVars, self.k, eta_0, rfactor, self.inital_perturb)
+        # Dark sector starts from the same adiabatic initial conditions
+        self.history.append(np.concatenate((yinit, yinit[1:])))
+        
         self.step = 0
         return
     
     
-    def solve_system(self):
+    def solve_system(self, z_out=None):
+        # z_out: redshifts of the Transfer summary (default z = 0), interpolated from the in-memory
+        # history when the run is saved
+        if z_out is not None:
+            self.z_out = list(z_out)
         eta_st = np.min([1e-3/self.k, 1e-1/0.7]) # Initial conformal time in Mpc
         y_st = np.log(self.scale_a(eta_st))
         eta_st = self.conform_T(np.exp(y_st))
@@ -1045,29 +1449,102 @@ class ManyBrane_Universe(object):
             tau_n = (self.y_vector[-1] - self.y_vector[-2]) / self.y_vector[-2]
 
         delt = (self.y_vector[-1] - self.y_vector[-2])
-        Ident = np.eye(self.TotalVars*2 - 1)
-        Jmat = self.matrix_J(self.y_vector[-1])
-        
-        Amat = (1.+2.*tau_n)/(1.+tau_n)*Ident - delt*Jmat
+        diag = (1.+2.*tau_n)/(1.+tau_n)
         bvec = self.b_vector(tau_n)
-        ysol = np.matmul(inv(Amat),bvec)
-        for i in range(2*self.TotalVars - 1):
-            self.combined_vector[i].append(ysol[i])
-#        for i in range(1, self.TotalVars):
-#            print self.combined_vector[i][-1],self.combined_vector[self.TotalVars+i-1][-1]
-
+        a_val = np.exp(self.y_vector[-1])
+        if self.solver == 'banded' and a_val > self.tflip_TCA:
+            Adata = -delt*self.jacobian_data(a_val)
+            Adata[self.J_diag] += diag
+            ysol = self.J_band.solve(Adata, bvec)
+        else:
+            Amat = -delt*self.matrix_J(self.y_vector[-1])
+            Amat[np.diag_indices_from(Amat)] += diag
+            if self.solver == 'banded':
+                ysol = band_solve(Amat, bvec, perm=self.band_perm)
+            else:
+                ysol = lu_solve(lu_factor(Amat), bvec)
+        self.history.append(ysol)
         return
     
     def b_vector(self, tau):
-        bvec = np.zeros(2*self.TotalVars - 1)
-        for i in range(2*self.TotalVars - 1):
-            if self.step == 0:
-                bvec[i] = (1.+tau)*self.combined_vector[i][-1]
-            else:
-                bvec[i] = (1.+tau)*self.combined_vector[i][-1] - tau**2./(1.+tau)*self.combined_vector[i][-2]
-        return bvec
+        if self.step == 0:
+            return (1.+tau)*self.history.last()
+        return (1.+tau)*self.history.last() - tau**2./(1.+tau)*self.history.last(2)
     
+    def jacobian_template(self):
+        # Same factor decomposition as Universe.jacobian_template, with the dark sector filled
+        # through the index map of its variables (the dark copy of variable m sits at TotalVars+m-1)
+        N = 2*self.TotalVars - 1
+        T = np.zeros((14, N, N))
+        H2 = self.H_0**2.
+        psi, kpsi = psi_template(14, N, self.k, [(11, self.omega_g[0]*H2), (13, self.omega_nu[0]*H2),
+                                                 (self.TotalVars+10, self.omega_g[1]*H2*self.Nbrane),
+                                                 (self.TotalVars+12, self.omega_nu[1]*H2*self.Nbrane)])
+        # Phi Time derivative
+        T[:, 0, :] += psi
+        T[F_KHA2, 0, 0] += -self.k**2./3.
+        for uni, offset in ((0, 0), (1, self.TotalVars - 1)):
+            fac = [1., self.Nbrane][uni]
+            T[F_H2A3, 0, offset+1] += self.omega_cdm[uni]*H2/2.*fac
+            T[F_H2A3, 0, offset+3] += self.omega_b[uni]*H2/2.*fac
+            T[F_H2A4, 0, offset+5] += 2.*self.omega_g[uni]*H2*fac
+            T[F_H2A4, 0, offset+7] += 2.*self.omega_nu[uni]*H2*fac
+        
+        if self.omega_b[1] != 0:
+            R_inv_D = 4.*self.omega_g[1]/(3.*self.omega_b[1])
+        else:
+            R_inv_D = 4.*self.omega_g[0]/(3.*self.omega_b[0])
+        hierarchy_template(T, np.arange(self.TotalVars), self.k, self.Lmax, kpsi, 8, 9, 10,
+                           4.*self.omega_g[0]/(3.*self.omega_b[0]))
+        hierarchy_template(T, np.concatenate(([0], np.arange(self.TotalVars, N))), self.k, self.Lmax, kpsi,
+                           11, 12, 13, R_inv_D)
+        
+        self.J_rows, self.J_cols, self.J_coef, self.J_diag = template_pattern(T)
+        self.J_band = BandedSystem(self.J_rows, self.J_cols, N, perm=self.band_perm)
+        self.Jbuf = np.zeros((N, N))
+        return
+
+    def jacobian_factors(self, a_val):
+        eta = self.conform_T(a_val)
+        HUB = self.hubble(a_val)
+        Yp = 0.245
+        n_b = 2.503e-7
+        dTa = -self.Xe(np.log10(a_val))*(1. - Yp)*n_b*6.65e-29*1e4/a_val**2./3.24078e-25
+        xeDk = self.XE_DARK_B(np.log10(a_val))
+        dTa_D = -xeDk*(1.-self.yp_prime)*n_b*6.65e-29*1e4/ a_val**2./3.24078e-25*(self.omega_b[1]/self.omega_b[0])
+        CsndB = self.Cs_Sqr(a_val, dark=False)
+        CsndB_D = self.Cs_Sqr(a_val, dark=True)
+        
+        if self.testing:
+            self.aLIST.append(a_val)
+            self.etaLIST.append(eta)
+            self.hubLIST.append(HUB)
+            self.csLIST.append(CsndB)
+            self.dtauLIST.append(dTa)
+            self.xeLIST.append(self.xe_deta(a_val))
+            self.csD_LIST.append(CsndB_D)
+            self.dtauD_LIST.append(dTa_D)
+            self.xeD_LIST.append(xeDk)
+        
+        # a_val may be an array of times: the factors are then (nfac, len(a_val))
+        Ha = HUB*a_val
+        return np.array([np.ones_like(Ha), 1./Ha, 1./Ha**2., 1./(HUB**2.*a_val**3.), 1./(HUB**2.*a_val**4.), 1./a_val**2.,
+                         1./(Ha*a_val**2.), 1./(eta*Ha), dTa/Ha, dTa/(Ha*a_val), CsndB/Ha,
+                         dTa_D/Ha, dTa_D/(Ha*a_val), CsndB_D/Ha])
+
+    def jacobian_data(self, a_val):
+        # Non-zero entries of the Jacobian, ordered as (self.J_rows, self.J_cols)
+        return self.J_coef.dot(self.jacobian_factors(a_val))
+
     def matrix_J(self, z_val):
+        # Dense Jacobian, filled in place from the template (overwritten on the next call)
+        a_val = np.exp(z_val)
+        if a_val <= self.tflip_TCA:
+            return self.matrix_J_full(z_val)
+        self.Jbuf[self.J_rows, self.J_cols] = self.jacobian_data(a_val)
+        return self.Jbuf
+
+    def matrix_J_full(self, z_val):
         a_val = np.exp(z_val)
         eta = self.conform_T(a_val)
         HUB = self.hubble(a_val)
@@ -1107,9 +1584,6 @@ class ManyBrane_Universe(object):
             self.dtauD_LIST.append(dTa_D)
             self.xeD_LIST.append(xeDk)
         
-        #tflip_TCA = 1e-4
-        tflip_TCA = 1e-11
-        
         PsiTerm = np.zeros(2*self.TotalVars-1)
         PsiTerm[0] = -1.
         PsiTerm[11] = -12.*(a_val/self.k)**2.*self.omega_g[0]*self.H_0**2./a_val**4.
@@ -1160,7 +1634,7 @@ class ManyBrane_Universe(object):
         Jma[self.TotalVars+4,:] += -Jma[0,:]
         
         # Baryon velocity
-        if a_val > tflip_TCA:
+        if a_val > self.tflip_TCA:
             Jma[4,4] += -1. + dTa / (Rfac*HUB*a_val)
             Jma[4,:] += self.k/(HUB*a_val)*PsiTerm
             Jma[4,3] += self.k * CsndB / (HUB * a_val)
@@ -1218,7 +1692,7 @@ class ManyBrane_Universe(object):
         Jma[self.TotalVars+6,:] += -Jma[0,:]
 
         # Theta 1
-        if a_val > tflip_TCA:
+        if a_val > self.tflip_TCA:
             Jma[8,5] += self.k/ (3.*HUB*a_val)
             Jma[8,8] += dTa / (HUB*a_val)
             Jma[8,4] += -dTa / (3.*HUB*a_val)
@@ -1351,16 +1825,16 @@ class ManyBrane_Universe(object):
 #        return self.Csnd_interp(np.log10(a))/a
 
     def scale_a(self, eta):
-        return 10.**self.ct_to_scale(np.log10(eta))
+        return self.background.scale_a(eta)
     
     def conform_T(self, a):
-        return quad(lambda x: 1./self.H_0 /np.sqrt(self.omega_R_T+self.omega_M_T*x+self.omega_L_T*x**4.), 0., a)[0]
+        return self.background.conform_T(a)
     
     def hubble(self, a):
         return self.H_0*np.sqrt(self.omega_R_T*a**-4+self.omega_M_T*a**-3.+self.omega_L_T)
 
     def xe_deta(self, a):
-        return 10.**self.Xe(np.log10(a))
+        return self.Xe(np.log10(a))
 
     def rhoCDM(self, a):
         return self.omega_cdm_T * self.H_0**2. * a**-3.
@@ -1386,47 +1860,56 @@ class ManyBrane_Universe(object):
     def rhoNeu_Indiv(self, a, uni=0):
         return self.omega_nu[uni] * self.H_0**2. * a**-4.
 
-    def epsilon_test(self, a):
+    def epsilon_test(self, a, yvec=None, k=None):
+        # yvec, k may also be a (nvars, nk) stack of states and an array of k (KBatch_Universe)
+        if yvec is None:
+            yvec = self.history.last()
+        if k is None:
+            k = self.k
         denom = (self.omega_M_T*a**-3. + self.omega_R_T*a**-4. + self.omega_L_T)
         
-        phiTerm = -2./3.*(self.k/(a*self.H_0))**2.*self.combined_vector[0][-1]
-        denTerm = (self.omega_cdm[0]*self.combined_vector[1][-1]+self.omega_b[0]*self.combined_vector[3][-1])*a**-3. +\
-                  4.*(self.omega_g[0]*self.combined_vector[5][-1]+self.omega_nu[0]*self.combined_vector[7][-1])*a**-4.
-        denTerm_D = (self.omega_cdm[1]*self.combined_vector[self.TotalVars][-1]+
-                     self.omega_b[1]*self.combined_vector[self.TotalVars+2][-1])*a**-3. +\
-                  4.*(self.omega_g[1]*self.combined_vector[self.TotalVars+4][-1]+
-                    self.omega_nu[1]*self.combined_vector[self.TotalVars+6][-1])*a**-4.
-        
-        velTerm = 3.*a*self.hubble(a)/self.k*(
-                 (self.omega_cdm[0]*self.combined_vector[self.TotalVars+1][-1]+
-                 self.omega_b[0]*self.combined_vector[self.TotalVars+3][-1])*a**-3. +
-                 4.*(self.omega_g[0]*self.combined_vector[self.TotalVars+7][-1]+
-                 self.omega_nu[0]*self.combined_vector[self.TotalVars+9][-1])*a**-4.)
-        velTerm_D = 3.*a*self.hubble(a)/self.k*(
-                 (self.omega_cdm[1]*self.combined_vector[self.TotalVars+1][-1]+
-                 self.omega_b[1]*self.combined_vector[self.TotalVars+3][-1])*a**-3. +
-                 4.*(self.omega_g[1]*self.combined_vector[self.TotalVars+7][-1]+
-                 self.omega_nu[1]*self.combined_vector[self.TotalVars+9][-1])*a**-4.)
+        phiTerm = -2./3.*(k/(a*self.H_0))**2.*yvec[0]
+        denTerm = (self.omega_cdm[0]*yvec[1]+self.omega_b[0]*yvec[3])*a**-3. +\
+                  4.*(self.omega_g[0]*yvec[5]+self.omega_nu[0]*yvec[7])*a**-4.
+        denTerm_D = (self.omega_cdm[1]*yvec[self.TotalVars]+
+                     self.omega_b[1]*yvec[self.TotalVars+2])*a**-3. +\
+                  4.*(self.omega_g[1]*yvec[self.TotalVars+4]+
+                    self.omega_nu[1]*yvec[self.TotalVars+6])*a**-4.
+        
+        velTerm = 3.*a*self.hubble(a)/k*(
+                 (self.omega_cdm[0]*yvec[self.TotalVars+1]+
+                 self.omega_b[0]*yvec[self.TotalVars+3])*a**-3. +
+                 4.*(self.omega_g[0]*yvec[self.TotalVars+7]+
+                 self.omega_nu[0]*yvec[self.TotalVars+9])*a**-4.)
+        velTerm_D = 3.*a*self.hubble(a)/k*(
+                 (self.omega_cdm[1]*yvec[self.TotalVars+1]+
+                 self.omega_b[1]*yvec[self.TotalVars+3])*a**-3. +
+                 4.*(self.omega_g[1]*yvec[self.TotalVars+7]+
+                 self.omega_nu[1]*yvec[self.TotalVars+9])*a**-4.)
         return (phiTerm + denTerm + denTerm_D*self.Nbrane + velTerm + velTerm_D*self.Nbrane)/(denom)
 
     def save_system(self):
-        psi_term = np.zeros(len(self.eta_vector))
-        for i in range(len(self.eta_vector)):
-            aval = 10.**self.ct_to_scale(np.log10(self.eta_vector[i]))
-            psi_term[i] = -12.*(aval**2./self.k**2.)* \
-                        ((self.rhoNeu_Indiv(aval, uni=0)*self.combined_vector[13][i] + self.rhoG_Indiv(aval,uni=0)*self.combined_vector[11][i]) + \
-                        (self.rhoNeu_Indiv(aval, uni=1)*self.combined_vector[self.TotalVars+12][i] +
-                        self.rhoG_Indiv(aval, uni=1)*self.combined_vector[self.TotalVars+10][i])) - \
-                         self.combined_vector[0][i]
-        
-        sve_tab = np.zeros((len(self.eta_vector), 2*self.TotalVars+1))
-        sve_tab[:,0] = self.eta_vector
-        sve_tab[:,-1] = psi_term
-        for i in range(2*self.TotalVars-1):
-            sve_tab[:,i+1] = self.combined_vector[i]
-        np.savetxt(path + '/OutputFiles/MultiBrane_FieldEvolution_' +
-                  '{:.4e}_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(self.k, self.Nbrane, self.PressureFac, self.ECDM),
-                  sve_tab, fmt='%.8e', delimiter='    ')
+        fields = self.history.values()
+        etavals = np.asarray(self.eta_vector)
+        avals = 10.**self.ct_to_scale(np.log10(etavals))
+        psi_term = -12.*(avals**2./self.k**2.)* \
+                    ((self.rhoNeu_Indiv(avals, uni=0)*fields[:,13] + self.rhoG_Indiv(avals, uni=0)*fields[:,11]) + \
+                    (self.rhoNeu_Indiv(avals, uni=1)*fields[:,self.TotalVars+12] +
+                    self.rhoG_Indiv(avals, uni=1)*fields[:,self.TotalVars+10])) - fields[:,0]
+        
+        sve_tab = np.column_stack((etavals, fields, psi_term))
+        tag = self.out_tag
+        save_fields(field_root(path + '/OutputFiles', 'MultiBrane', self.k, tag), sve_tab)
+        
+        # Transfer summary, one row per z_out: z, Phi, Psi, delta_m (all branes), then delta_c, delta_b
+        # of the visible and of the dark sector
+        dark = self.TotalVars - 1
+        delta_m = (self.omega_cdm[0]*fields[:,1] + self.omega_b[0]*fields[:,3] +
+                   self.Nbrane*(self.omega_cdm[1]*fields[:,dark+1] + self.omega_b[1]*fields[:,dark+3])) / self.omega_M_T
+        summary = output_rows(avals, np.column_stack((fields[:,0], psi_term, delta_m, fields[:,1], fields[:,3],
+                                                      fields[:,dark+1], fields[:,dark+3])), self.z_out)
+        save_fields(field_root(path + '/OutputFiles', 'MultiBrane', self.k, tag, kind='Transfer'),
+                    np.column_stack((self.z_out, summary)))
         
         if self.testing:
             np.savetxt(path+'/OutputFiles/MultiBrane_Background_Nbranes_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(self.Nbrane, self.PressureFac, self.ECDM),
@@ -1434,3 +1917,127 @@ class ManyBrane_Universe(object):
                                          self.dtauLIST, self.xeD_LIST, self.csD_LIST, self.dtauD_LIST)))
         return
 
+
+class KBatch_Universe(object):
+    # Several k modes of one cosmology (Universe or ManyBrane_Universe instances built with the same
+    # context and lmax) advanced together on a shared time grid. The background factors of the Jacobian
+    # are evaluated once per step for the whole batch, and the stacked (nk, N, N) implicit systems are
+    # solved with one batched LAPACK call. The shared grid obeys the step-size limits of the largest k,
+    # so batches should hold neighbouring k values.
+
+    def __init__(self, universes):
+        self.unis = list(universes)
+        self.kvals = np.array([uni.k for uni in self.unis])
+        self.lead = self.unis[np.argmax(self.kvals)]
+        self.nk = len(self.unis)
+        self.N = self.lead.history.data.shape[1]
+        for uni in self.unis:
+            if not (np.array_equal(uni.J_rows, self.lead.J_rows) and np.array_equal(uni.J_cols, self.lead.J_cols)):
+                raise ValueError('All modes of a batch need the same Jacobian structure')
+        self.J_coef = np.array([uni.J_coef for uni in self.unis])
+        self.stepsize = np.min([uni.stepsize for uni in self.unis])
+        self.accuracy = np.min([uni.accuracy for uni in self.unis])
+        # Universe raises on a failed consistency test, ManyBrane_Universe instead grows the step when it is tiny
+        self.strict = not isinstance(self.lead, ManyBrane_Universe)
+        self.step = 0
+        return
+
+    def solve_system(self, z_out=None):
+        if z_out is not None:
+            for uni in self.unis:
+                uni.z_out = list(z_out)
+        lead = self.lead
+        eta_st = np.min([1e-3/lead.k, 1e-1/0.7]) # Initial conformal time in Mpc
+        y_st = np.log(lead.scale_a(eta_st))
+        eta_st = lead.conform_T(np.exp(y_st))
+        
+        for uni in self.unis:
+            uni.init_conds(eta_st, np.exp(y_st))
+        self.history = StateHistory(self.nk*self.N)
+        self.history.append(np.concatenate([uni.history.last() for uni in self.unis]))
+        self.eta_vector = [eta_st]
+        self.y_vector = [y_st]
+        self.step = 0
+        
+        try_count = 0.
+        try_max = 20.
+        FailRUN = False
+        last_step_up = False
+        while (self.eta_vector[-1] < (lead.eta_0-1.)):
+            if try_count > try_max:
+                print('FAIL TRY MAX....Breaking.')
+                FailRUN=True
+                # as in the per-k solvers: ManyBrane_Universe keeps going once the step is tiny
+                if self.strict or self.stepsize > 1e-4:
+                    break
+            y_use = self.y_vector[-1] + self.stepsize
+            eta_use = lead.conform_T(np.exp(y_use))
+            if (eta_use > lead.eta_0):
+                eta_use = lead.eta_0
+                y_use = np.log(lead.scale_a(eta_use))
+            self.eta_vector.append(eta_use)
+
+            y_diff = y_use - self.y_vector[-1]
+            self.y_vector.append(y_use)
+            
+            if self.step%3000 == 0:
+                print('Last a: {:.7e}, New a: {:.7e}'.format(np.exp(self.y_vector[-2]), np.exp(self.y_vector[-1])))
+            aH = np.exp(y_use)*lead.hubble(np.exp(y_use))
+            if (y_diff > eta_use*aH) or (y_diff > np.max([aH, aH/lead.k])):
+                self.stepsize *= 0.5
+                self.eta_vector.pop()
+                self.y_vector.pop()
+                try_count += 1
+                continue
+            self.step_solver()
+            
+            test_epsilon = np.max(np.abs(lead.epsilon_test(np.exp(self.y_vector[-1]),
+                                         yvec=self.history.last().reshape(self.nk, self.N).T, k=self.kvals)))
+            if self.strict and test_epsilon > self.accuracy and self.step > 10:
+                raise ValueError
+            self.step += 1
+            if not self.strict and (test_epsilon < 1e-4*self.accuracy) and not last_step_up:
+                self.stepsize *= 1.25
+                last_step_up = True
+            else:
+                last_step_up = False
+            try_count = 0.
+        
+        if not FailRUN:
+            print('Saving Files...')
+            self.save_system()
+        return
+
+    def step_solver(self):
+        if self.step > 0:
+            tau_n = (self.y_vector[-1] - self.y_vector[-2]) / (self.y_vector[-2] - self.y_vector[-3])
+        else:
+            tau_n = (self.y_vector[-1] - self.y_vector[-2]) / self.y_vector[-2]
+        delt = (self.y_vector[-1] - self.y_vector[-2])
+        
+        bvec = (1.+tau_n)*self.history.last().reshape(self.nk, self.N)
+        if self.step > 0:
+            bvec -= tau_n**2./(1.+tau_n)*self.history.last(2).reshape(self.nk, self.N)
+        
+        a_val = np.exp(self.y_vector[-1])
+        Amat = np.zeros((self.nk, self.N, self.N))
+        if a_val > self.lead.tflip_TCA:
+            Amat[:, self.lead.J_rows, self.lead.J_cols] = -delt*self.J_coef.dot(self.lead.jacobian_factors(a_val))
+        else:
+            Amat -= delt*np.array([uni.matrix_J_full(self.y_vector[-1]) for uni in self.unis])
+        diag = np.arange(self.N)
+        Amat[:, diag, diag] += (1.+2.*tau_n)/(1.+tau_n)
+        ysol = np.linalg.solve(Amat, bvec[:, :, np.newaxis])[:, :, 0]
+        self.history.append(ysol.flatten())
+        return
+
+    def save_system(self):
+        # Hand the shared grid and each mode's slice of the history back to its Universe
+        fields = self.history.values().reshape(-1, self.nk, self.N)
+        for i, uni in enumerate(self.unis):
+            uni.history.data = fields[:, i, :].copy()
+            uni.history.n = fields.shape[0]
+            uni.eta_vector = list(self.eta_vector)
+            uni.y_vector = list(self.y_vector)
+            uni.save_system()
+        return
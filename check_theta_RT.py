@@ -7,24 +7,22 @@ path = os.getcwd()
 inRUN = False
 
 if inRUN:
-    files = path + '/OutputFiles/*_ThetaFile_kval*.dat'
+    files = path + '/OutputFiles/*_ThetaCMB_Table_work.npy'
 else:
     files = path + '/OutputFiles/StandardUniverse_ThetaCMB_Table.dat'
 
 ell_indx = 0
-endarr = []
 
 file_list = glob.glob(files)
 for ff in file_list:
     if inRUN:
-        kval = float(ff[ff.find('_kval_')+6:ff.find('.dat')])
-        loadf = np.loadtxt(ff)[ell_indx]
-        endarr.append([kval, loadf])
+        # rows of the k values not computed yet are NaN
+        tab = np.load(ff, mmap_mode='r')
+        kvals = tab[1:, 0]
+        loadf = tab[1:, ell_indx+1]
+        finArr = np.column_stack((kvals, loadf))[~np.isnan(loadf)]
     else:
         kvals = np.logspace(-3, -1, 2000)
         finArr = np.column_stack((kvals, np.loadtxt(ff)[1:, ell_indx]))
 
-if inRUN:
-    finArr = np.asarray(endarr)[np.argsort(np.asarray(endarr)[:,0])]
-
 np.savetxt(path + '/OutputFiles/CHECK_THETA.dat', finArr)
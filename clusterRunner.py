@@ -1,6 +1,8 @@
 import numpy as np
 import os
 from CMB import *
+from k_scheduler import run_kgrid
+from param_sweep import multiverse_densities
 #from multiprocessing import Pool
 
 Multiverse = False
@@ -22,66 +24,74 @@ if not Multiverse:
 else:
     Ftag = 'MultiBrane'
     omega_cdm = 0.258
-    
-    OM_b = 0.0484
-    OM_c = 0.
-    OM_g = 5.38e-5
-    OM_L = 0.
-
-    if extraCDM == 0:
-        OM_b2 =  omega_cdm/Nbranes
-        OM_c2 = 0.
-        OM_g2 = PressureFac*(OM_g/OM_b)*OM_b2
-        OM_L2 = 0.
-    else:
-        OM_c = extraCDM / (1. + (omega_cdm - extraCDM)/OM_b)
-        OM_c2 = extraCDM / Nbranes * (1. - 1. / (1. + (omega_cdm - extraCDM)/OM_b))
-        OM_b2 = (omega_cdm - extraCDM) / Nbranes
-        OM_g2 = PressureFac*(OM_g/OM_b)*OM_b2
-        OM_L2 = 0.
+    # the same densities as the point (Nbranes, PressureFac, extraCDM) of a parameter sweep
+    densities = multiverse_densities(Nbranes, PressureFac, extraCDM, omega_cdm=omega_cdm)
+    OM_b, OM_c, OM_g, OM_L = [densities[key] for key in ('OM_b', 'OM_c', 'OM_g', 'OM_L')]
+    OM_b2, OM_c2, OM_g2, OM_L2 = [densities[key] for key in ('OM_b2', 'OM_c2', 'OM_g2', 'OM_L2')]
 
 lmax_Pert = 10
 process_Num = 1
+# Neighbouring k values integrated together on one shared time grid per Pool task
+kbatch = 1
 
 compute_LP = True
 compute_TH = True
 compute_CMB = True
 compute_MPS = False
-# Note, don't copute MPS and CMB at same time. This requires different kgrid...
+# CMB and MPS k grids are merged into one union grid, a single Boltzmann pass serves both
 
-if compute_MPS:
-    kmin = 1e-3
-    kmax = 1.
-    knum = 100
-else:
-    kmin = 1e-3
-    kmax = 1e-1
-    knum = 1000
+kmin = 1e-3
+kmax = 1e-1
+knum = 1000
+# Refine the CMB k grid adaptively from a coarse start, knum is then the point budget
+adaptive_k = False
+
+mps_kgrid = np.logspace(-3., 0., 100)
+z_out = [0., 0.5, 1., 2.]
 
 lmax = 1500
 lvals = 10 # Doesnt do anything right now
 
-
-if compute_MPS:
-    kgrid = np.logspace(np.log10(kmin), np.log10(kmax), knum)
-else:
-    #kgrid = np.linspace(kmin, kmax, knum)
-    kgrid = np.logspace(np.log10(kmin), np.log10(kmax), knum)
-
 def CMB_wrap(kval):
-    SetCMB.runall(kVAL=kval, compute_LP=compute_LP, compute_TH=compute_TH,
-               compute_CMB=False, compute_MPS=False)
+    SetCMB.run_batch(kval, compute_LP=compute_LP, compute_TH=compute_TH)
+    return
+
+def round_map(klist):
+    # One refinement round of SetCMB.adaptive_kgrid: a Pool started after k_batches inherits the round's
+    # k grid, batches and Theta table, and runs the fields and Theta_l rows of klist
+    batches = SetCMB.k_batches(klist)
+    round_pool = Pool(processes=process_Num)
+    run_kgrid(round_pool, CMB_wrap, batches, timing_log)
+    round_pool.close()
+    round_pool.join()
     return
 
 SetCMB = CMB(OM_b, OM_c, OM_g, OM_L, kmin=kmin, kmax=kmax, knum=knum, lmax=lmax,
              lvals=lvals, Ftag=Ftag, lmax_Pert=lmax_Pert, multiverse=Multiverse,
-             OM_b2=OM_b2, OM_c2=OM_c2, OM_g2=OM_g2, OM_L2=OM_L2, Nbrane=Nbranes)
+             OM_b2=OM_b2, OM_c2=OM_c2, OM_g2=OM_g2, OM_L2=OM_L2, Nbrane=Nbranes,
+             mps_grid=(mps_kgrid if compute_MPS else None), z_out=z_out, kbatch=kbatch)
+kgrid = SetCMB.kgrid
+# Per-k wall times of every run, also used to order the next run's tasks by cost
+timing_log = path + '/OutputFiles/' + Ftag + SetCMB.f_tag + '_kTimings.dat'
 
 if compute_LP or compute_TH:
-    pool = Pool(processes=process_Num)
-    pool.map(CMB_wrap, kgrid)
-    pool.close()
-    pool.join()
+    # Workers inherit SetCMB, and with it the BackgroundContext built once in CMB.loadfiles
+    # and the memory-mapped BesselTable, source eta grid and Theta table
+    if compute_TH:
+        SetCMB.load_bessel()
+        SetCMB.source_grid()
+        if not adaptive_k:
+            SetCMB.theta_table()
+    if adaptive_k and compute_TH:
+        SetCMB.adaptive_kgrid(solve_map=round_map)
+        if compute_MPS:
+            # k values of a separate matter power grid, which the refinement does not solve
+            round_map([k for k in SetCMB.kgrid if not SetCMB.solved(k)])
+    else:
+        pool = Pool(processes=process_Num)
+        run_kgrid(pool, CMB_wrap, SetCMB.k_batches(), timing_log)
+        pool.close()
+        pool.join()
     if compute_TH:
         SetCMB.SaveThetaFile()
 
@@ -0,0 +1,220 @@
+import numpy as np
+import os
+from scipy.linalg import cho_factor, cho_solve, LinAlgError
+from scipy.optimize import minimize
+from CMB import output_files
+from param_sweep import read_index
+
+# Surrogate for the C_l and P(k) outputs of a parameter sweep (see param_sweep). The log of every
+# output table is projected on its principal components over the training points, and each component
+# coefficient is interpolated in (log10 Nbrane, log10 PressureFac, eCDM), standardised to the training
+# set, by a Gaussian process (squared exponential kernel, hyperparameters from the marginal likelihood)
+# or a quadratic polynomial. A prediction is one small matrix product per point.
+#
+#   params, ells, Dl = load_sweep('MultiBrane', output='cl')
+#   emu = Emulator(params, ells, Dl)
+#   Dl_new = emu.predict([1e7, 3e-3, 0.])
+#   emu.cross_validate()                        # leave-one-out relative errors
+#   holdout_report('MultiBrane', holdout=0.2)   # errors against exact runs kept out of the training
+
+
+def load_sweep(Ftag='MultiBrane', output='cl', z=0., index_file=None):
+    # Parameters (n, 3) of the completed points listed in the sweep index, their output grid x (ell or
+    # k) and the outputs Y (n, len(x)): D_l = l (l+1) C_l / 2 pi ('cl') or P(k, z) ('mps')
+    if index_file is None:
+        index_file = os.getcwd() + '/OutputFiles/' + Ftag + '_SweepIndex.dat'
+    points = []
+    for p, digits, tag in read_index(index_file):
+        # a point solved under both default and finer names is one training point
+        if p not in [q for q, d, t in points]:
+            points.append((p, digits, tag))
+    params = np.array([p for p, digits, tag in points]).reshape(-1, 3)
+    x = None
+    Y = []
+    for p, digits, tag in points:
+        theta, cl, mps = output_files(Ftag, tag)
+        if output == 'cl':
+            tab = np.loadtxt(cl)
+            grid, vals = tab[:, 0], tab[:, 1]
+        elif output == 'mps':
+            tab = np.loadtxt(mps, ndmin=2)
+            with open(mps) as f:
+                header = f.readline()
+            zs = [float(col.split('=')[1].rstrip(')')) for col in header.split()[2:]]
+            if np.min(np.abs(np.array(zs) - z)) > 1e-6:
+                raise ValueError('No P(k) at z = {:.3g} in {}'.format(z, mps))
+            grid, vals = tab[:, 0], tab[:, 1 + np.argmin(np.abs(np.array(zs) - z))]
+        else:
+            raise ValueError('Unknown sweep output: ' + output)
+        if x is None:
+            x = grid
+        elif len(grid) != len(x) or not np.allclose(grid, x):
+            raise ValueError('Sweep outputs on different grids, e.g. ' + (cl if output == 'cl' else mps))
+        Y.append(vals)
+    return params, x, np.array(Y)
+
+
+def features(params):
+    # (log10 Nbrane, log10 PressureFac, eCDM) of (m, 3) parameter points
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    return np.column_stack((np.log10(params[:, 0]), np.log10(params[:, 1]), params[:, 2]))
+
+
+def from_features(F):
+    F = np.atleast_2d(np.asarray(F, dtype=float))
+    return np.column_stack((10.**F[:, 0], 10.**F[:, 1], F[:, 2]))
+
+
+def sq_exp(X1, X2, theta):
+    # amplitude^2 exp(-|x1 - x2|^2 / 2) with the coordinates scaled by the length scales, theta =
+    # (log length scales, log amplitude)
+    d = (X1[:, np.newaxis, :] - X2[np.newaxis, :, :]) / np.exp(theta[:-1])
+    return np.exp(2.*theta[-1] - 0.5*np.sum(d**2., axis=-1))
+
+
+class GPInterpolator(object):
+    # Zero mean Gaussian process regression of each column of Y on X, one kernel per column
+
+    def __init__(self, X, Y, nugget=1e-10):
+        self.X = X
+        self.nugget = nugget
+        self.thetas = []
+        self.alphas = []
+        for y in Y.T:
+            theta = self.fit(y)
+            K = sq_exp(X, X, theta) + nugget*np.exp(2.*theta[-1])*np.eye(len(X))
+            self.thetas.append(theta)
+            self.alphas.append(cho_solve(cho_factor(K, lower=True), y))
+
+    def fit(self, y):
+        n, d = self.X.shape
+        amp0 = np.log(np.std(y)) if np.std(y) > 0. else 0.
+
+        def nll(theta):
+            K = sq_exp(self.X, self.X, theta) + self.nugget*np.exp(2.*theta[-1])*np.eye(n)
+            try:
+                L = cho_factor(K, lower=True)
+            except LinAlgError:
+                return 1e25
+            return 0.5*y.dot(cho_solve(L, y)) + np.sum(np.log(np.diag(L[0])))
+
+        theta0 = np.append(np.zeros(d), amp0)
+        bounds = [(np.log(1e-2), np.log(1e2))]*d + [(amp0 - 10., amp0 + 10.)]
+        return minimize(nll, theta0, method='L-BFGS-B', bounds=bounds).x
+
+    def __call__(self, X):
+        return np.column_stack([sq_exp(X, self.X, theta).dot(alpha) for theta, alpha in zip(self.thetas, self.alphas)])
+
+
+class PolyInterpolator(object):
+    # Least squares quadratic polynomial of each column of Y in X
+
+    def __init__(self, X, Y):
+        self.coef = np.linalg.lstsq(self.design(X), Y, rcond=-1)[0]
+
+    def design(self, X):
+        d = X.shape[1]
+        cols = [np.ones(len(X))] + [X[:, i] for i in range(d)]
+        cols += [X[:, i]*X[:, j] for i in range(d) for j in range(i, d)]
+        return np.column_stack(cols)
+
+    def __call__(self, X):
+        return self.design(X).dot(self.coef)
+
+
+class Emulator(object):
+
+    def __init__(self, params, x, Y, method='gp', var_tol=1e-8, n_pca=None):
+        # params: (n, 3) training points (Nbrane, PressureFac, eCDM); x: output grid; Y: (n, len(x))
+        # positive outputs. The principal components kept carry all but var_tol of the variance of
+        # log Y (at most n_pca of them).
+        self.params = np.atleast_2d(np.asarray(params, dtype=float))
+        self.x = np.asarray(x, dtype=float)
+        self.Y = np.atleast_2d(np.asarray(Y, dtype=float))
+        self.method = method
+        self.var_tol = var_tol
+        self.n_pca = n_pca
+        self.train()
+
+    def train(self):
+        F = features(self.params)
+        self.f_mean = np.mean(F, axis=0)
+        self.f_scale = np.std(F, axis=0)
+        # a parameter held fixed by the sweep drops out of the distances
+        self.f_scale[self.f_scale == 0.] = 1.
+        X = (F - self.f_mean) / self.f_scale
+
+        Z = np.log(self.Y)
+        self.z_mean = np.mean(Z, axis=0)
+        U, S, Vt = np.linalg.svd(Z - self.z_mean, full_matrices=False)
+        frac = np.cumsum(S**2.) / max(np.sum(S**2.), 1e-300)
+        npc = int(np.searchsorted(frac, 1. - self.var_tol)) + 1
+        if self.n_pca is not None:
+            npc = min(npc, self.n_pca)
+        self.basis = Vt[:npc]
+        coeffs = (Z - self.z_mean).dot(self.basis.T)
+        if self.method == 'gp':
+            self.interp = GPInterpolator(X, coeffs)
+        elif self.method == 'poly':
+            self.interp = PolyInterpolator(X, coeffs)
+        else:
+            raise ValueError('Unknown emulator method: ' + self.method)
+        return
+
+    def predict(self, params):
+        # Outputs on x at params, (len(x),) for one point or (m, len(x)) for m points
+        single = np.ndim(params) == 1
+        X = (features(params) - self.f_mean) / self.f_scale
+        pred = np.exp(self.z_mean + self.interp(X).dot(self.basis))
+        return pred[0] if single else pred
+
+    def errors(self, params, Y):
+        # Relative errors (m, len(x)) of the prediction against exact outputs Y at params
+        return self.predict(np.atleast_2d(params)) / np.atleast_2d(Y) - 1.
+
+    def cross_validate(self):
+        # Leave-one-out relative errors (n, len(x)): each training point predicted by an emulator
+        # trained on the others
+        err = np.zeros_like(self.Y)
+        for i in range(len(self.params)):
+            keep = np.arange(len(self.params)) != i
+            emu = Emulator(self.params[keep], self.x, self.Y[keep], method=self.method, var_tol=self.var_tol,
+                           n_pca=self.n_pca)
+            err[i] = emu.errors(self.params[i], self.Y[i])[0]
+        report_errors(self.params, err, 'leave-one-out')
+        return err
+
+    def save(self, fileName):
+        # Training set and options; load retrains, which takes well under a second
+        np.savez(fileName, params=self.params, x=self.x, Y=self.Y, method=self.method, var_tol=self.var_tol,
+                 n_pca=(-1 if self.n_pca is None else self.n_pca))
+        return
+
+    @classmethod
+    def load(cls, fileName):
+        data = np.load(fileName)
+        n_pca = int(data['n_pca'])
+        return cls(data['params'], data['x'], data['Y'], method=str(data['method']), var_tol=float(data['var_tol']),
+                   n_pca=(None if n_pca < 0 else n_pca))
+
+
+def report_errors(params, err, label):
+    for p, e in zip(params, err):
+        print('Nbrane = {:.0e}, PressureFac = {:.2e}, eCDM = {:.2e}: max |error| {:.2e}, rms {:.2e}'.format(
+            p[0], p[1], p[2], np.max(np.abs(e)), np.sqrt(np.mean(e**2.))))
+    print('{} error over {:d} points: max {:.2e}, rms {:.2e}'.format(label, len(params), np.max(np.abs(err)),
+                                                                       np.sqrt(np.mean(err**2.))))
+    return
+
+
+def holdout_report(Ftag='MultiBrane', output='cl', z=0., holdout=0.2, seed=0, method='gp', **emu_opts):
+    # Trains on a random part of the completed sweep points and prints the relative errors against the
+    # exact runs of the rest. Returns the emulator and the errors of the held-out points.
+    params, x, Y = load_sweep(Ftag, output, z)
+    order = np.random.RandomState(seed).permutation(len(params))
+    ntest = max(int(round(holdout*len(params))), 1)
+    test, train = order[:ntest], order[ntest:]
+    emu = Emulator(params[train], x, Y[train], method=method, **emu_opts)
+    err = emu.errors(params[test], Y[test])
+    report_errors(params[test], err, 'Held-out')
+    return emu, err
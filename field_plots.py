@@ -10,6 +10,7 @@ import matplotlib as mpl
 import matplotlib.patheffects as PathEffects
 import matplotlib.gridspec as gridspec
 import glob
+from field_store import load_fields
 from matplotlib import rc
 rc('font',**{'family':'serif','serif':['Times','Palatino']})
 rc('text', usetex=True)
@@ -25,10 +26,10 @@ Nbrane = 1e7
 pressFac = 1e-6
 eCDM = 0.00
 
-Fname = 'StandardUniverse_FieldEvolution_{:.4e}.dat'.format(kval)
+Fname = 'StandardUniverse_FieldEvolution_{:.4e}'.format(kval)
 Svname = 'StandardField_kval_{:.4e}.pdf'.format(kval)
 
-#Fname = 'MultiBrane_FieldEvolution_{:.4e}_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.dat'.format(kval, Nbrane, pressFac, eCDM)
+#Fname = 'MultiBrane_FieldEvolution_{:.4e}_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}'.format(kval, Nbrane, pressFac, eCDM)
 #Svname = 'MultiverseField_kval_{:.4e}_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}.pdf'.format(kval, Nbrane, pressFac, eCDM)
 
 path = os.getcwd()
@@ -36,7 +37,7 @@ path = os.getcwd()
 pl.figure()
 ax = pl.gca()
 
-file = np.loadtxt(path + '/OutputFiles/' + Fname)
+file = load_fields(path + '/OutputFiles/' + Fname)
 
 time_table = np.loadtxt(path+'/precomputed/Times_Tables.dat')
 ct_to_scale = interp1d(np.log10(time_table[:,2]), np.log10(time_table[:,1]), kind='linear',
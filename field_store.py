@@ -0,0 +1,48 @@
+import numpy as np
+import os
+
+# Binary store for the per-k FieldEvolution tables written by Universe.save_system and
+# ManyBrane_Universe.save_system. A table lives at <fileroot>.npy, where fileroot is the old
+# text file name without '.dat', e.g.
+#   OutputFiles/StandardUniverse_FieldEvolution_1.0000e-01
+#   OutputFiles/MultiBrane_FieldEvolution_1.0000e-01_Nbrane_1e+07_PressFac_1.00e-06_eCDM_0.00e+00
+# Columns are unchanged: eta, the state vector, then psi. Tables from older runs that only exist
+# as <fileroot>.dat are still read. Other per-k tables (e.g. the line of sight sources of
+# CMB.los_source, kind='LOSSource', with a settings digest appended) use the same naming and loader.
+
+
+def field_root(directory, Ftag, k, tag='', kind='FieldEvolution'):
+    # tag: cosmology suffix, e.g. '_Nbrane_{:.0e}_PressFac_{:.2e}_eCDM_{:.2e}' filled in
+    return directory + '/' + Ftag + '_' + kind + '_{:.4e}'.format(k) + tag
+
+
+def save_fields(fileroot, table):
+    # Written to a temporary name and renamed: a reader (another worker, check_theta_RT) sees the
+    # complete table or none, and fields_exist never reports a half written one
+    tmpName = fileroot + '.{:d}.tmp.npy'.format(os.getpid())
+    np.save(tmpName, np.ascontiguousarray(table, dtype=np.float64))
+    os.rename(tmpName, fileroot + '.npy')
+    return
+
+
+def fields_exist(fileroot):
+    return os.path.isfile(fileroot + '.npy') or os.path.isfile(fileroot + '.dat')
+
+
+def load_fields(fileroot, mmap=True):
+    # mmap: memory-map the binary table, only the rows and columns used are read from disk
+    if os.path.isfile(fileroot + '.npy'):
+        if mmap:
+            return np.load(fileroot + '.npy', mmap_mode='r')
+        return np.load(fileroot + '.npy')
+    if os.path.isfile(fileroot + '.dat'):
+        return np.loadtxt(fileroot + '.dat')
+    raise IOError('No field evolution table at ' + fileroot + '.npy or .dat')
+
+
+def convert_fields(fileroot, remove=False):
+    # Rewrite an old text table in the binary format
+    save_fields(fileroot, np.loadtxt(fileroot + '.dat'))
+    if remove:
+        os.remove(fileroot + '.dat')
+    return
@@ -2,7 +2,7 @@ import numpy as np
 import os
 from scipy.integrate import odeint
 from constants import *
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d, InterpolatedUnivariateSpline
 from scipy.integrate import quad
 
 path = os.getcwd()
@@ -54,3 +54,71 @@ class Single_FRW(object):
         
         
         return
+
+
+class FRW_Background(object):
+    # Conformal time table eta(a) of a flat FRW background, built once per cosmology.
+    # conform_T, scale_a, ct_to_scale and scale_to_ct are all spline lookups on the same table,
+    # so they are consistent inverses of each other.
+
+    def __init__(self, omega_M, omega_R, omega_L, H_0, a_min=1e-14, a_max=1., n_a=10000, n_gauss=6):
+        self.omega_M = omega_M
+        self.omega_R = omega_R
+        self.omega_L = omega_L
+        self.H_0 = H_0
+
+        # Gauss-Legendre on each interval of a log-spaced grid, d eta / d ln(a) = 1 / (a H)
+        lna = np.linspace(np.log(a_min), np.log(a_max), n_a)
+        nodes, weights = np.polynomial.legendre.leggauss(n_gauss)
+        hstep = np.diff(lna)
+        lna_nodes = 0.5*(lna[1:] + lna[:-1])[:, np.newaxis] + 0.5*hstep[:, np.newaxis]*nodes
+        a_nodes = np.exp(lna_nodes)
+        d_eta = 0.5*hstep*np.sum(weights / (a_nodes*self.hubble(a_nodes)), axis=1)
+        eta_min = quad(lambda x: 1./self.H_0/np.sqrt(self.omega_R+self.omega_M*x+self.omega_L*x**4.), 0., a_min)[0]
+
+        self.a_tab = np.exp(lna)
+        self.eta_tab = eta_min + np.concatenate(([0.], np.cumsum(d_eta)))
+        self.eta_0 = self.eta_tab[-1]
+        self.build_splines()
+
+    def build_splines(self):
+        self.scale_to_ct = InterpolatedUnivariateSpline(np.log10(self.a_tab), np.log10(self.eta_tab), k=3)
+        self.ct_to_scale = InterpolatedUnivariateSpline(np.log10(self.eta_tab), np.log10(self.a_tab), k=3)
+        return
+
+    def __getstate__(self):
+        # Pickle the table only, the splines are rebuilt on load
+        state = self.__dict__.copy()
+        del state['scale_to_ct']
+        del state['ct_to_scale']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.build_splines()
+
+    def hubble(self, a):
+        return self.H_0*np.sqrt(self.omega_R*a**-4.+self.omega_M*a**-3.+self.omega_L)
+
+    def conform_T(self, a):
+        eta = 10.**self.scale_to_ct(np.log10(a))
+        if np.ndim(a) == 0:
+            return float(eta)
+        return eta
+
+    def scale_a(self, eta):
+        aval = 10.**self.ct_to_scale(np.log10(eta))
+        if np.ndim(eta) == 0:
+            return float(aval)
+        return aval
+
+
+_background_tables = {}
+
+
+def frw_background(omega_M, omega_R, omega_L, H_0):
+    # One FRW_Background per cosmology and process; every k mode of a run shares it.
+    key = (omega_M, omega_R, omega_L, H_0)
+    if key not in _background_tables:
+        _background_tables[key] = FRW_Background(omega_M, omega_R, omega_L, H_0)
+    return _background_tables[key]
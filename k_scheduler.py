@@ -0,0 +1,102 @@
+import numpy as np
+import os
+import time
+import traceback
+
+# Dynamic scheduling of per-k tasks over a multiprocessing Pool. The Boltzmann solve time grows
+# strongly with k (the a H / k limit on the step), so the tasks are handed out one at a time
+# (imap_unordered, chunksize 1), most expensive first: a worker that finishes early takes the next
+# task instead of waiting on a fixed chunk. The cost of a k is the time measured in an earlier run
+# when the timing log has it, otherwise it is taken proportional to k.
+#
+# Every finished task appends a line "k seconds ok [label]" (ok = 1, or 0 for a failure) to the timing
+# log, so the log survives a crash. Tasks are expected to skip work that is already on disk (as
+# CMB.runall does), so rerunning after a failure only redoes the missing k values.
+
+
+def timed_call(args):
+    func, label, k = args
+    t0 = time.time()
+    try:
+        if label is None:
+            func(k)
+        else:
+            func(label, k)
+        return label, k, time.time() - t0, ''
+    except Exception:
+        return label, k, time.time() - t0, traceback.format_exc().strip().splitlines()[-1]
+
+
+def load_timings(log_file):
+    # {'{:.4e}'.format(k): longest successful time} of earlier runs (reruns that skip finished work
+    # log ~0 s), keyed like the per-k file names
+    timings = {}
+    if log_file is None or not os.path.isfile(log_file):
+        return timings
+    tab = np.loadtxt(log_file, ndmin=2, usecols=(0, 1, 2))
+    for k, secs, ok in tab:
+        if ok:
+            key = '{:.4e}'.format(k)
+            timings[key] = max(secs, timings.get(key, 0.))
+    return timings
+
+
+def cost_index(kgrid, timings):
+    # Permutation of kgrid by decreasing estimated cost
+    kgrid = np.asarray(kgrid, dtype=float)
+    known = np.array([timings.get('{:.4e}'.format(k), np.nan) for k in kgrid])
+    have = ~np.isnan(known)
+    # unknown k: time per unit k of the measured ones, or k itself
+    rate = np.median(known[have] / kgrid[have]) if np.any(have) else 1.
+    cost = np.where(have, known, rate*kgrid)
+    return np.argsort(-cost, kind='mergesort')
+
+
+def cost_order(kgrid, timings):
+    # kgrid sorted by decreasing estimated cost
+    return np.asarray(kgrid, dtype=float)[cost_index(kgrid, timings)]
+
+
+def run_tasks(pool, func, tasks, log_file=None, retries=1, callback=None):
+    # Runs func(label, k) for every (label, k) of tasks on pool (func(k) for label None), most expensive
+    # k first whatever the label. Failed tasks are retried up to retries times after the first pass.
+    # callback(label, k, err) is called here for every finished task (err = '' on success). The label
+    # is written as a fourth column of the timing log. Returns the tasks that still fail.
+    def ordered(tasks):
+        timings = load_timings(log_file)
+        return [tasks[i] for i in cost_index([k for label, k in tasks], timings)]
+
+    todo = ordered(list(tasks))
+    timings = []
+    failed = []
+    for attempt in range(retries + 1):
+        failed = []
+        for label, k, secs, err in pool.imap_unordered(timed_call, [(func, label, k) for label, k in todo], chunksize=1):
+            timings.append(secs)
+            tag = '' if label is None else ' ' + str(label)
+            if log_file is not None:
+                with open(log_file, 'a') as f:
+                    f.write('{:.6e} {:.3f} {:d}{}\n'.format(k, secs, int(not err), tag))
+            if err:
+                print('k = {:.4e}{} failed after {:.1f} s: {}'.format(k, tag, secs, err))
+                failed.append((label, k))
+            else:
+                print('k = {:.4e}{} done in {:.1f} s'.format(k, tag, secs))
+            if callback is not None:
+                callback(label, k, err)
+        if not failed:
+            break
+        todo = ordered(failed)
+
+    if timings:
+        print('{:d} tasks, {:.1f} s total, mean {:.1f} s, longest {:.1f} s'.format(len(timings), np.sum(timings),
+                                                                                np.mean(timings), np.max(timings)))
+    if failed:
+        print('Failed tasks (rerun to resume): ' + ' '.join('{:.4e}'.format(k) + ('' if label is None else '/' + str(label))
+                                                         for label, k in failed))
+    return failed
+
+
+def run_kgrid(pool, func, kgrid, log_file=None, retries=1):
+    # Runs func(k) for every k of kgrid on pool, see run_tasks. Returns the k values that still fail.
+    return [k for label, k in run_tasks(pool, func, [(None, k) for k in kgrid], log_file, retries)]
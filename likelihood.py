@@ -0,0 +1,170 @@
+import numpy as np
+import os
+from scipy.interpolate import interp1d
+from scipy.optimize import minimize
+from CMB import brane_tag, output_files
+from param_sweep import ParamSweep
+from emulator import Emulator, features, from_features
+
+# chi^2 of measured D_l = l (l+1) C_l / 2 pi against the multiverse model at (Nbrane, PressureFac, eCDM),
+# for fits and samplers. A point is solved through ParamSweep, so its per-k fields, C_l table and
+# thermal history stay on disk (the sweep index lists it, e.g. as emulator training data) and an
+# evaluation at a point already solved, in this process or an earlier one, only reads the C_l table.
+# The points of one evaluation batch (e.g. a finite difference gradient) share one pool pass, the k
+# grid, the Bessel table and the cost ordering of the timing log.
+#
+# Points are named by their full parameters (ParamSweep tag_digits), so chi^2 is a smooth function of
+# the parameters and the finite difference neighbours, at fixed relative steps, are distinct runs.
+#
+# A gradient solves the point and its finite difference neighbours in one batch, 1 + 2 (free
+# parameters) runs. With an emulator (e.g. trained on an earlier sweep, see emulator) and
+# emulator_grad=True only the point itself is solved: the neighbours take its exact D_l times the
+# emulator ratio D_l(neighbour) / D_l(point), so the value is exact and the derivative is the
+# emulator's, and every exact solve joins the emulator training set, refining it along the path of
+# the fit. An optimizer step then costs one run. (The field histories of a nearby point cannot seed
+# a solve: the perturbations are an initial value problem from the same early-time initial
+# conditions.)
+
+
+class ClLikelihood(object):
+
+    def __init__(self, data, Ftag='MultiBrane', omega_cdm=0.258, processes=1, retries=1, emulator=None,
+                 emulator_grad=False, rel_step=1e-2, tag_digits=12, **cmb_opts):
+        # data: file or array with columns ell, D_l and optionally the D_l errors (default: cosmic
+        # variance of the data). emulator: Emulator of D_l on the ell grid of the runs, for the warm
+        # start of fit and, with emulator_grad, the gradients (see above). rel_step: finite difference
+        # step, relative for Nbrane and PressureFac and in units of omega_cdm for eCDM. cmb_opts go to
+        # every CMB run.
+        if isinstance(data, str):
+            data = np.loadtxt(data)
+        data = np.asarray(data, dtype=float)
+        self.ells = data[:, 0]
+        self.Dl = data[:, 1]
+        if data.shape[1] > 2:
+            self.sigma = data[:, 2]
+        else:
+            self.sigma = np.sqrt(2./(2.*self.ells + 1.)) * np.abs(self.Dl)
+        self.Ftag = Ftag
+        self.omega_cdm = omega_cdm
+        self.processes = processes
+        self.retries = retries
+        self.emulator = emulator
+        self.emulator_grad = emulator_grad
+        # steps in features(): log10 Nbrane, log10 PressureFac, eCDM
+        self.steps = np.array([np.log10(1. + rel_step), np.log10(1. + rel_step), rel_step*omega_cdm])
+        self.tag_digits = tag_digits
+        self.cmb_opts = cmb_opts
+        # parameters -> model D_l at the data ells
+        self.cl_cache = {}
+
+    def on_data(self, ells, Dl):
+        # Model D_l on the data ells (cubic in ell); the data must lie inside the model ell range
+        if np.min(self.ells) < np.min(ells) or np.max(self.ells) > np.max(ells):
+            raise ValueError('Data ells {:.0f} - {:.0f} outside the model range {:.0f} - {:.0f}'.format(
+                np.min(self.ells), np.max(self.ells), np.min(ells), np.max(ells)))
+        return interp1d(ells, Dl, kind='cubic')(self.ells)
+
+    def cl_batch(self, points):
+        # Model D_l at the data ells for every point; the points not yet solved run as one sweep
+        points = [tuple(float(v) for v in p) for p in points]
+        todo = [p for p in points if p not in self.cl_cache]
+        if todo:
+            sweep = ParamSweep(todo, Ftag=self.Ftag, omega_cdm=self.omega_cdm, compute_CMB=True, compute_MPS=False,
+                               tag_digits=self.tag_digits, **self.cmb_opts)
+            sweep.run(processes=self.processes, retries=self.retries)
+            for p in todo:
+                clFile = output_files(self.Ftag, brane_tag(*p, digits=self.tag_digits))[1]
+                if not os.path.isfile(clFile):
+                    raise IOError('No C_l table for Nbrane = {:.6e}, PressureFac = {:.6e}, eCDM = {:.6e}'.format(*p))
+                tab = np.loadtxt(clFile)
+                self.cl_cache[p] = self.on_data(tab[:, 0], tab[:, 1])
+                self.learn(p, tab[:, 0], tab[:, 1])
+        return [self.cl_cache[p] for p in points]
+
+    def learn(self, params, ells, Dl):
+        # Adds an exact solve to the emulator training set (retraining takes well under a second)
+        emu = self.emulator
+        if emu is None or len(ells) != len(emu.x) or not np.allclose(ells, emu.x):
+            return
+        if np.any(np.all(emu.params == np.array(params), axis=1)):
+            return
+        self.emulator = Emulator(np.vstack((emu.params, params)), emu.x, np.vstack((emu.Y, Dl)), method=emu.method,
+                                 var_tol=emu.var_tol, n_pca=emu.n_pca)
+        return
+
+    def cl(self, params):
+        return self.cl_batch([params])[0]
+
+    def chi2_of(self, Dl):
+        return np.sum(((Dl - self.Dl) / self.sigma)**2.)
+
+    def chi2(self, params):
+        return self.chi2_of(self.cl(params))
+
+    def neighbours(self, params, j):
+        # Points steps[j] below and above params along feature j (None outside 0 <= eCDM < omega_cdm)
+        x0 = features(params)[0]
+        out = []
+        for sign in (-1., 1.):
+            x = x0.copy()
+            x[j] += sign*self.steps[j]
+            out.append(None if (x[2] < 0. or x[2] >= self.omega_cdm) else tuple(from_features(x)[0]))
+        return out
+
+    def chi2_grad(self, params, free=(True, True, True)):
+        # chi^2 and its gradient in (log10 Nbrane, log10 PressureFac, eCDM) (0 for fixed parameters) by
+        # central differences, one-sided at the edge of the eCDM range. The neighbours are solved with
+        # the point in one batch, or taken from the emulator with emulator_grad (see above).
+        params = tuple(float(v) for v in params)
+        nbrs = [self.neighbours(params, j) if free[j] else [None, None] for j in range(3)]
+        points = [p for pair in nbrs for p in pair if p is not None]
+        if self.emulator is None or not self.emulator_grad:
+            chi = dict((p, self.chi2_of(Dl)) for p, Dl in zip([params] + points, self.cl_batch([params] + points)))
+        else:
+            D0 = self.cl(params)
+            emu = self.emulator
+            e0 = self.on_data(emu.x, emu.predict(np.array(params)))
+            chi = dict((p, self.chi2_of(D0 * self.on_data(emu.x, emu.predict(np.array(p))) / e0)) for p in points)
+            chi[params] = self.chi2_of(D0)
+        c0 = chi[params]
+        grad = np.zeros(3)
+        for j, (lo, hi) in enumerate(nbrs):
+            if lo is not None and hi is not None:
+                grad[j] = (chi[hi] - chi[lo]) / (2.*self.steps[j])
+            elif hi is not None:
+                grad[j] = (chi[hi] - c0) / self.steps[j]
+            elif lo is not None:
+                grad[j] = (c0 - chi[lo]) / self.steps[j]
+        return c0, grad
+
+    def fit(self, p0, free=(True, True, True), **opts):
+        # Best fit (Nbrane, PressureFac, eCDM) from p0 with L-BFGS-B in the features, one chi2_grad per
+        # iteration. With an emulator the exact fit starts from the emulator best fit within its
+        # training range. Returns the best point and the scipy result.
+        free = np.asarray(free, dtype=bool)
+        x0 = features(p0)[0]
+        bounds = [(None, None), (None, None), (0., self.omega_cdm)]
+        bounds = [b for b, f in zip(bounds, free) if f]
+
+        def point(xf):
+            x = x0.copy()
+            x[free] = xf
+            return tuple(from_features(x)[0])
+
+        if self.emulator is not None:
+            emu_chi2 = lambda xf: self.chi2_of(self.on_data(self.emulator.x, self.emulator.predict(np.array(point(xf)))))
+            # inside the training range, where the emulator interpolates
+            F = features(self.emulator.params)
+            box = [(lo, hi) for lo, hi, f in zip(F.min(axis=0), F.max(axis=0), free) if f]
+            start = minimize(emu_chi2, np.clip(x0[free], *zip(*box)), method='L-BFGS-B', bounds=box)
+            print('Emulator best fit: chi^2 = {:.4e} at Nbrane = {:.4e}, PressureFac = {:.4e}, eCDM = {:.4e}'.format(
+                start.fun, *point(start.x)))
+            x0[free] = start.x
+
+        def fun(xf):
+            c, g = self.chi2_grad(point(xf), free)
+            print('chi^2 = {:.6e} at Nbrane = {:.4e}, PressureFac = {:.4e}, eCDM = {:.4e}'.format(c, *point(xf)))
+            return c, g[free]
+
+        res = minimize(fun, x0[free], jac=True, method='L-BFGS-B', bounds=bounds, **opts)
+        return point(res.x), res
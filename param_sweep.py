@@ -0,0 +1,203 @@
+import numpy as np
+import os
+import itertools
+from multiprocessing import Pool
+from CMB import *
+from k_scheduler import run_tasks
+from table_cache import file_lock
+
+# Sweep of the multiverse parameters (Nbrane, PressureFac, extraCDM) on one process pool. Every point
+# is a CMB run with its own per-k tables and outputs (suffix brane_tag, see output_files); the
+# (point, k) tasks of all points are scheduled together, most expensive k first, so the pool stays
+# busy across points. Points whose outputs are complete are skipped, as are the k values whose fields
+# and Theta_l row are on disk, so rerunning a sweep resumes it. A point is finalised (Theta table,
+# C_l, matter power) as soon as its last k finishes, and the index file then lists it:
+#   OutputFiles/<Ftag>_SweepIndex.dat: Nbrane PressureFac eCDM tag_digits, one line per completed
+#   point of every sweep of Ftag (tag_digits -1: the default brane_tag names)
+
+_sweep = None
+
+
+def multiverse_densities(Nbrane, PressureFac, extraCDM, omega_cdm=0.258, OM_b=0.0484, OM_g=5.38e-5):
+    # CMB keyword arguments of a multiverse point: the dark matter omega_cdm is carried by Nbrane
+    # copies of the baryons (PressureFac times their photon to baryon ratio), except extraCDM in cold
+    # dark matter shared in proportion between the branes
+    if extraCDM == 0:
+        OM_c = 0.
+        OM_b2 = omega_cdm / Nbrane
+        OM_c2 = 0.
+    else:
+        OM_c = extraCDM / (1. + (omega_cdm - extraCDM)/OM_b)
+        OM_c2 = extraCDM / Nbrane * (1. - 1. / (1. + (omega_cdm - extraCDM)/OM_b))
+        OM_b2 = (omega_cdm - extraCDM) / Nbrane
+    OM_g2 = PressureFac*(OM_g/OM_b)*OM_b2
+    return dict(OM_b=OM_b, OM_c=OM_c, OM_g=OM_g, OM_L=0., OM_b2=OM_b2, OM_c2=OM_c2, OM_g2=OM_g2, OM_L2=0.,
+                Nbrane=Nbrane, multiverse=True)
+
+
+def sweep_grid(Nbranes, PressureFacs, extraCDMs):
+    # Every combination of the three lists
+    return list(itertools.product(Nbranes, PressureFacs, extraCDMs))
+
+
+def read_index(IndexFile):
+    # ((Nbrane, PressureFac, eCDM), tag_digits, brane_tag) of every point listed in a sweep index; the
+    # parameters are written in full so that the tags are reproduced exactly
+    if not os.path.isfile(IndexFile):
+        return []
+    tab = np.loadtxt(IndexFile, ndmin=2)
+    out = []
+    for row in tab:
+        digits = int(row[3]) if len(row) > 3 else -1
+        point = tuple(row[:3])
+        out.append((point, digits, brane_tag(*point, digits=(None if digits < 0 else digits))))
+    return out
+
+
+def sweep_task(index, k):
+    # Pool task: fields and Theta_l of the k batch keyed k (see CMB.k_batches) for point index of the
+    # active sweep (inherited at fork)
+    _sweep.cmbs[index].run_batch(k, compute_LP=True, compute_TH=_sweep.compute_CMB)
+    return
+
+
+class ParamSweep(object):
+
+    def __init__(self, points, Ftag='MultiBrane', omega_cdm=0.258, compute_CMB=True, compute_MPS=False,
+                 tag_digits=None, **cmb_opts):
+        # points: (Nbrane, PressureFac, extraCDM) tuples, e.g. from sweep_grid. cmb_opts go to every CMB
+        # (kmin, kmax, knum, lmax, lmax_Pert, mps_grid, z_out, kbatch, ...). tag_digits: name the files of
+        # a point by its parameters to that many decimals (see brane_tag), for points closer than the
+        # default names resolve, e.g. finite differences.
+        self.Ftag = Ftag
+        self.tag_digits = tag_digits
+        self.omega_cdm = omega_cdm
+        self.compute_CMB = compute_CMB
+        self.compute_MPS = compute_MPS
+        self.cmb_opts = cmb_opts
+        # points that share a file name suffix would share every output: keep the first
+        self.points = []
+        self.tags = []
+        for Nbrane, PressureFac, extraCDM in points:
+            tag = brane_tag(Nbrane, PressureFac, extraCDM, self.tag_digits)
+            if tag not in self.tags:
+                self.points.append((Nbrane, PressureFac, extraCDM))
+                self.tags.append(tag)
+        self.cmbs = [None]*len(self.points)
+        self.pending = {}
+        self.IndexFile = path + '/OutputFiles/' + self.Ftag + '_SweepIndex.dat'
+
+    def outputs(self, index):
+        # Output files of a point that the sweep produces
+        theta, cl, mps = output_files(self.Ftag, self.tags[index])
+        return [f for f, need in ((cl, self.compute_CMB), (mps, self.compute_MPS)) if need]
+
+    def complete(self, index):
+        return all(os.path.isfile(f) for f in self.outputs(index))
+
+    def setup(self):
+        # Builds the CMB run of every incomplete point in this process, before the Pool starts: the
+        # background and thermal history of a point are computed once (the thermal tables come from
+        # table_cache when an earlier sweep had the point, the others from one thermal_sweep over
+        # the new points), and the workers inherit them with the Theta tables and one mapping per
+        # distinct Bessel table. Returns the (point, k) tasks left.
+        new = [i for i in range(len(self.points)) if self.cmbs[i] is None and not self.complete(i)]
+        for i in new:
+            opts = multiverse_densities(*self.points[i], omega_cdm=self.omega_cdm)
+            opts.update(self.cmb_opts)
+            self.cmbs[i] = CMB(Ftag=self.Ftag, out_tag=self.tags[i], thermal=False, **opts)
+        # the thermal histories table_cache does not have yet are solved together, one integration
+        universes = [self.cmbs[i].background_universe(thermal=False) for i in new]
+        todo = [uni for uni in universes if not uni.load_thermal()]
+        if todo:
+            thermal_sweep(todo)
+        for i, uni in zip(new, universes):
+            self.cmbs[i].loadfiles(uni)
+
+        bessel = {}
+        tasks = []
+        for i in range(len(self.points)):
+            if self.complete(i):
+                continue
+            cmb = self.cmbs[i]
+            if self.compute_CMB:
+                table = cmb.load_bessel()
+                if table is not None:
+                    cmb.bessel = bessel.setdefault(table.fileName, table)
+                cmb.source_grid()
+                cmb.theta_table()
+            todo = [k for k in cmb.kgrid if not self.k_done(cmb, k)]
+            batches = cmb.k_batches(todo) if todo else []
+            self.pending[i] = len(batches)
+            tasks += [(i, k) for k in batches]
+        return tasks
+
+    def k_done(self, cmb, k):
+        if not cmb.solved(k):
+            return False
+        if not self.compute_CMB:
+            return True
+        if not cmb.has_theta_row(k):
+            return True
+        index = np.argmin(np.abs(cmb.kgrid_cmb/k - 1.))
+        return not np.isnan(cmb.theta_table()[index + 1, 1])
+
+    def finish(self, index):
+        # Outputs of a point whose k values are all done, and the updated index
+        cmb = self.cmbs[index]
+        if self.compute_CMB:
+            cmb.SaveThetaFile()
+            cmb.computeCMB()
+        if self.compute_MPS:
+            cmb.MatterPower()
+        self.write_index()
+        print('Sweep point Nbrane = {:.0e}, PressureFac = {:.2e}, eCDM = {:.2e} done'.format(*self.points[index]))
+        return
+
+    def task_done(self, index, k, err):
+        if err:
+            return
+        self.pending[index] -= 1
+        if self.pending[index] == 0:
+            self.finish(index)
+        return
+
+    def write_index(self):
+        # Completed points of this sweep added to the ones other sweeps of Ftag listed
+        with file_lock(self.IndexFile + '.lock'):
+            done = list(read_index(self.IndexFile))
+            tags = [tag for p, digits, tag in done]
+            digits = -1 if self.tag_digits is None else self.tag_digits
+            for i in range(len(self.points)):
+                if self.tags[i] not in tags and self.complete(i):
+                    done.append((self.points[i], digits, self.tags[i]))
+                    tags.append(self.tags[i])
+            tab = np.array([list(p) + [d] for p, d, tag in done]).reshape(-1, 4)
+            tmpName = self.IndexFile + '.{:d}.tmp'.format(os.getpid())
+            np.savetxt(tmpName, tab, fmt=['%.17e']*3 + ['%d'], header='Nbrane PressureFac eCDM tag_digits')
+            os.rename(tmpName, self.IndexFile)
+        return
+
+    def run(self, processes=1, log_file=None, retries=1):
+        # Returns the (point, k) tasks that failed; rerun to resume
+        global _sweep
+        if log_file is None:
+            log_file = path + '/OutputFiles/' + self.Ftag + '_SweepTimings.dat'
+        tasks = self.setup()
+        print('Sweep: {:d} of {:d} points to compute, {:d} (point, k) tasks'.format(len(self.pending), len(self.points),
+                                                                                    len(tasks)))
+        # points whose k values were all on disk only need their outputs
+        for i in [i for i in self.pending if self.pending[i] == 0]:
+            self.finish(i)
+        if not tasks:
+            return []
+        _sweep = self
+        pool = Pool(processes=processes)
+        try:
+            failed = run_tasks(pool, sweep_task, tasks, log_file, retries, callback=self.task_done)
+        finally:
+            pool.close()
+            pool.join()
+            _sweep = None
+        self.write_index()
+        return failed
@@ -0,0 +1,31 @@
+import numpy as np
+from param_sweep import *
+
+# Multiverse parameter sweep, see param_sweep. Rerun to resume an interrupted sweep.
+Nbranes = [1e6, 1e7]
+PressureFacs = [1e-4, 1e-3, 1e-2]
+extraCDMs = [0.]
+
+lmax_Pert = 10
+process_Num = 1
+# Neighbouring k values integrated together on one shared time grid per Pool task
+kbatch = 1
+
+compute_CMB = True
+compute_MPS = False
+
+kmin = 1e-3
+kmax = 1e-1
+knum = 1000
+
+mps_kgrid = np.logspace(-3., 0., 100)
+z_out = [0., 0.5, 1., 2.]
+
+lmax = 1500
+lvals = 10
+
+Sweep = ParamSweep(sweep_grid(Nbranes, PressureFacs, extraCDMs), Ftag='MultiBrane',
+                   compute_CMB=compute_CMB, compute_MPS=compute_MPS,
+                   kmin=kmin, kmax=kmax, knum=knum, lmax=lmax, lvals=lvals, lmax_Pert=lmax_Pert, kbatch=kbatch,
+                   mps_grid=(mps_kgrid if compute_MPS else None), z_out=z_out)
+Sweep.run(processes=process_Num)
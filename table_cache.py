@@ -0,0 +1,128 @@
+import numpy as np
+import os
+import hashlib
+import zipfile
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks (e.g. Windows): concurrent producers may duplicate work, never corrupt it
+    fcntl = None
+
+path = os.getcwd()
+
+
+@contextmanager
+def file_lock(lockName):
+    # Exclusive advisory lock on lockName for the duration of the block. Processes waiting for it
+    # sleep in the kernel instead of polling.
+    if fcntl is None:
+        yield
+        return
+    directory = os.path.dirname(lockName)
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+    f = open(lockName, 'a')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+
+def canonical(value):
+    # Hashable, platform independent form of a parameter value (floats, ints, strings, sequences)
+    if isinstance(value, dict):
+        return tuple((key, canonical(value[key])) for key in sorted(value))
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(canonical(v) for v in value)
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return float(value)
+    return str(value)
+
+
+class TableCache(object):
+    # Content-addressed store for precomputed tables (thermal history, optical depth, ...). A set of
+    # named arrays is saved as one .npz whose name is the md5 of every input parameter, so tables of
+    # different cosmologies never collide and a stale table cannot be picked up. Files are written to
+    # a temporary name and renamed. A load refreshes the file time; store() evicts the least recently
+    # used files once the directory exceeds max_bytes. Producers hold lock(kind, params) so that one
+    # process builds a table while the others wait for it.
+
+    def __init__(self, directory=None, max_bytes=2**30):
+        if directory is None:
+            directory = path + '/precomputed/cache'
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def fileName(self, kind, params):
+        key = hashlib.md5(repr(canonical(params)).encode()).hexdigest()[:16]
+        return self.directory + '/' + kind + '_' + key + '.npz'
+
+    def lock(self, kind, params):
+        return file_lock(self.fileName(kind, params)[:-4] + '.lock')
+
+    def load(self, kind, params):
+        # dict of the stored arrays, or None
+        fileName = self.fileName(kind, params)
+        try:
+            with np.load(fileName) as data:
+                tables = dict((name, data[name]) for name in data.files)
+        except (IOError, OSError, ValueError, EOFError, zipfile.BadZipfile):
+            # missing, or truncated / corrupt (writer killed, disk full): a miss, and a bad file is
+            # dropped so that the next producer rebuilds it
+            if os.path.isfile(fileName):
+                try:
+                    os.remove(fileName)
+                except OSError:
+                    pass
+            return None
+        try:
+            os.utime(fileName, None)
+        except OSError:
+            pass
+        return tables
+
+    def store(self, kind, params, tables):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # created by another process in the meantime
+                pass
+        fileName = self.fileName(kind, params)
+        tmpName = fileName[:-4] + '.{:d}.tmp.npz'.format(os.getpid())
+        np.savez(tmpName, **tables)
+        os.rename(tmpName, fileName)
+        self.evict(keep=fileName)
+        return fileName
+
+    def evict(self, keep=None):
+        entries = []
+        for name in os.listdir(self.directory):
+            full = self.directory + '/' + name
+            if not name.endswith('.npz') or '.tmp' in name or full == keep:
+                continue
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, full))
+        total = sum(e[1] for e in entries)
+        if keep is not None and os.path.isfile(keep):
+            total += os.path.getsize(keep)
+        for mtime, size, full in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(full)
+            except OSError:
+                pass
+            total -= size
+        return